@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+#------------------------------------------------------------------------------
+# DFU throughput benchmark.
+#
+# Runs the real BleDfuServer sequence against a SimulatedBootloader over a
+# matrix of link and protocol settings and reports update times as a table
+# and as JSON, so tuning changes can be compared and regressions caught.
+#
+#   payload      - packet payload; the target offers an ATT MTU of payload+3
+#                  and the server negotiates it as it would on a real link
+#   dle          - longest link layer payload the target accepts (27 without
+#                  Data Length Extension)
+#   interval     - pkt_receipt_interval
+#   conn         - connection interval (ms) requested for the transfer; the
+#                  link carries pkts_per_event packets per connection event
+#   latency      - one-way latency (ms) on top of the connection interval
+#   loss         - link layer retransmission probability
+#   size/format  - generated image size and file type (bin or hex)
+#------------------------------------------------------------------------------
+import os
+import sys
+import json
+import random
+import shutil
+import struct
+import optparse
+import tempfile
+import itertools
+
+from crc16     import crc16_compute
+from dfu       import BleDfuServer
+from intelhex  import IntelHex
+from metrics   import monotonic
+from simulator import SimulatedBootloader, SimTransport
+
+#------------------------------------------------------------------------------
+# Write a random image of 'size' bytes as .bin or .hex plus its .dat init
+# packet into 'directory'.  Returns (image_path, dat_path).
+#------------------------------------------------------------------------------
+def make_image(directory, size, fmt, seed=0):
+
+    data = bytearray(random.Random(seed).getrandbits(8) for i in xrange(size))
+
+    base = os.path.join(directory, "image_{0}".format(size))
+
+    if fmt == "hex":
+        path = base + ".hex"
+        ih = IntelHex()
+        ih.frombytes(data, offset=0x18000)
+        with open(path, "w") as f:
+            ih.write_hex_file(f)
+    else:
+        path = base + ".bin"
+        with open(path, "wb") as f:
+            f.write(data)
+
+    # dfu_init_t: device type, revision, app version, softdevice list, crc
+    dat_path = base + ".dat"
+    with open(dat_path, "wb") as f:
+        f.write(struct.pack('<HHIHHHH', 0xffff, 0xffff, 0xffffffff,
+                            2, 0x005a, 0x0064, crc16_compute(data)))
+
+    return path, dat_path
+
+#------------------------------------------------------------------------------
+# Output is muted while the server runs; it prints a lot.
+#------------------------------------------------------------------------------
+class _Quiet(object):
+
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+
+    def __exit__(self, *exc):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+#------------------------------------------------------------------------------
+# One update with the given settings.  Returns a result dict.
+#------------------------------------------------------------------------------
+def run_case(image, datfile, case, window=2, pkts_per_event=4, seed=0):
+
+    bootloader = SimulatedBootloader(att_mtu=case["payload"] + 3)
+    transport  = SimTransport(bootloader,
+                              latency=case["latency"] / 1000.0,
+                              seed=seed,
+                              conn_interval=case["conn"] / 1000.0,
+                              pkts_per_event=pkts_per_event,
+                              link_loss=case["loss"],
+                              max_data_length=case["dle"])
+
+    server = BleDfuServer("00:00:00:00:00:00", image, datfile, transport)
+    server.att_mtu              = case["payload"] + 3
+    server.fast_conn_params     = (case["conn"], case["conn"], 0, 4000)
+    server.pkt_receipt_interval = case["interval"]
+    server.pkt_receipt_window   = window
+
+    result = dict(case)
+    error  = None
+    start  = monotonic()
+
+    try:
+        with _Quiet():
+            server.input_setup()
+            server.scan_and_connect()
+            server.dfu_send_image()
+    except Exception, e:
+        error = str(e)
+    finally:
+        transport.disconnect()
+
+    phases = server.metrics.phase_seconds()
+
+    result.update({
+        "ok"              : error is None and bootloader.activated,
+        "error"           : error,
+        "seconds"         : monotonic() - start,
+        "transfer_seconds": phases.get("transfer", 0.0),
+        "bytes_per_second": server.metrics.throughput(),
+        "retransmits"     : transport.link_retransmits,
+    })
+
+    return result
+
+#------------------------------------------------------------------------------
+# Run the full matrix.  'matrix' maps each case key to a list of values.
+#------------------------------------------------------------------------------
+def run_matrix(matrix, window=2, pkts_per_event=4, repeat=1):
+
+    keys = ["size", "format", "payload", "dle", "interval", "conn", "latency", "loss"]
+
+    directory = tempfile.mkdtemp(prefix="dfu_bench_")
+    results = []
+
+    try:
+        images = {}
+        for size, fmt in itertools.product(matrix["size"], matrix["format"]):
+            images[(size, fmt)] = make_image(directory, size, fmt)
+
+        for values in itertools.product(*[matrix[key] for key in keys]):
+            case = dict(zip(keys, values))
+            image, datfile = images[(case["size"], case["format"])]
+
+            for run in xrange(repeat):
+                result = run_case(image, datfile, case, window, pkts_per_event, seed=run)
+                result["run"] = run
+                results.append(result)
+                print format_row(result)
+                sys.stdout.flush()
+
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return results
+
+#------------------------------------------------------------------------------
+# Table output.
+#------------------------------------------------------------------------------
+header = "{0:>7} {1:>4} {2:>7} {3:>4} {4:>8} {5:>7} {6:>7} {7:>5} {8:>8} {9:>8} {10:>9} {11}".format(
+         "size", "fmt", "payload", "dle", "interval", "conn_ms", "lat_ms", "loss",
+         "total_s", "xfer_s", "bytes/s", "result")
+
+def format_row(r):
+    return "{0:>7} {1:>4} {2:>7} {3:>4} {4:>8} {5:>7} {6:>7} {7:>5.2f} {8:>8.2f} {9:>8.2f} {10:>9.0f} {11}".format(
+           r["size"], r["format"], r["payload"], r["dle"], r["interval"], r["conn"], r["latency"], r["loss"],
+           r["seconds"], r["transfer_seconds"], r["bytes_per_second"],
+           "ok" if r["ok"] else "FAIL " + (r["error"] or ""))
+
+#------------------------------------------------------------------------------
+#
+#------------------------------------------------------------------------------
+def main():
+
+    parser = optparse.OptionParser(usage='%prog [options]\n\nExample:\n\tbenchmark.py --interval 5,10,20 --conn 7.5,30 --json bench.json',
+                                   version='0.5')
+
+    def add_list(name, default, kind, help):
+        parser.add_option('--' + name,
+                  action='store',
+                  dest=name,
+                  type="string",
+                  default=default,
+                  help=help + ' (comma separated, default %default).'
+                  )
+        return kind
+
+    kinds = {
+        "size"     : add_list("size",     "16384",      int,   'image sizes in bytes'),
+        "format"   : add_list("format",   "bin,hex",    str,   'image file formats'),
+        "payload"  : add_list("payload",  "20",         int,   'packet payload sizes'),
+        "dle"      : add_list("dle",      "27",         int,   'link layer data lengths'),
+        "interval" : add_list("interval", "5,10,20",    int,   'packet receipt intervals'),
+        "conn"     : add_list("conn",     "7.5,30",     float, 'connection intervals in ms'),
+        "latency"  : add_list("latency",  "0,20",       float, 'one-way latencies in ms'),
+        "loss"     : add_list("loss",     "0,0.05",     float, 'link layer retransmission rates'),
+    }
+
+    parser.add_option('-w', '--window',
+              action='store',
+              dest="window",
+              type="int",
+              default=2,
+              help='PKT_RCPT notifications in flight (default %default).'
+              )
+
+    parser.add_option('--pkts-per-event',
+              action='store',
+              dest="pkts_per_event",
+              type="int",
+              default=4,
+              help='packets per connection event (default %default).'
+              )
+
+    parser.add_option('--repeat',
+              action='store',
+              dest="repeat",
+              type="int",
+              default=1,
+              help='runs per case (default %default).'
+              )
+
+    parser.add_option('--json',
+              action='store',
+              dest="json",
+              type="string",
+              default=None,
+              help='write the results to this JSON file.'
+              )
+
+    options, args = parser.parse_args()
+
+    matrix = {}
+    for name, kind in kinds.items():
+        matrix[name] = [kind(value) for value in getattr(options, name).split(',') if value]
+
+    print header
+    results = run_matrix(matrix, options.window, options.pkts_per_event, options.repeat)
+
+    if options.json:
+        with open(options.json, "w") as f:
+            json.dump({"window"        : options.window,
+                       "pkts_per_event": options.pkts_per_event,
+                       "results"       : results}, f, indent=2, sort_keys=True)
+
+    failed = len([r for r in results if not r["ok"]])
+    print "{0} cases, {1} failed".format(len(results), failed)
+
+    if failed:
+        sys.exit(1)
+
+#------------------------------------------------------------------------------
+#
+#------------------------------------------------------------------------------
+if __name__ == '__main__':
+
+    # Do not litter the world with broken .pyc files.
+    sys.dont_write_bytecode = True
+
+    main()
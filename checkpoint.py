@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+#------------------------------------------------------------------------------
+# Transfer checkpoints for resuming an interrupted DFU session.
+#
+# One small JSON file per target address records which image was being sent
+# and how many bytes the target had confirmed with PKT_RCPT.
+#------------------------------------------------------------------------------
+import os
+import json
+import time
+import tempfile
+
+checkpoint_dir = os.path.join(tempfile.gettempdir(), "dfu_checkpoints")
+
+def _path(address):
+    return os.path.join(checkpoint_dir, address.replace(':', '').upper() + ".json")
+
+#------------------------------------------------------------------------------
+# Record the confirmed byte count of 'image' for 'address'.
+#------------------------------------------------------------------------------
+def save_checkpoint(address, image, confirmed):
+
+    if not os.path.isdir(checkpoint_dir):
+        os.makedirs(checkpoint_dir)
+
+    record = {
+        "address"   : address,
+        "image"     : image.digest(),
+        "size"      : image.size,
+        "confirmed" : confirmed,
+        "time"      : time.time(),
+    }
+
+    # write-then-rename so a crash never leaves a torn checkpoint behind
+    path = _path(address)
+    with open(path + ".tmp", "w") as f:
+        json.dump(record, f)
+    os.rename(path + ".tmp", path)
+
+#------------------------------------------------------------------------------
+# Return the checkpoint for 'address' if it matches 'image', else None.
+#------------------------------------------------------------------------------
+def load_checkpoint(address, image):
+
+    try:
+        with open(_path(address)) as f:
+            record = json.load(f)
+    except (IOError, ValueError):
+        return None
+
+    if record.get("image") != image.digest() or record.get("size") != image.size:
+        return None
+
+    return record
+
+def clear_checkpoint(address):
+    try:
+        os.remove(_path(address))
+    except OSError:
+        pass
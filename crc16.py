@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+#------------------------------------------------------------------------------
+# CRC16 of the legacy DFU init packet.
+#
+# The SDK 8 bootloader checks the received image against the CRC16 in the
+# .dat file (see crc16_compute in gen_dat.c).  That routine is CRC-16/CCITT
+# (polynomial 0x1021, no reflection, initial value 0xffff), the same CRC
+# binascii.crc_hqx computes, so the check runs at C speed.
+#------------------------------------------------------------------------------
+import struct
+import binascii
+
+#------------------------------------------------------------------------------
+# CRC16 of 'data' (str, bytearray or buffer), continuing from 'crc', as
+# crc16_compute in gen_dat.c and the bootloader compute it.
+#------------------------------------------------------------------------------
+def crc16_compute(data, crc=0xffff):
+
+    if isinstance(data, bytearray):
+        data = buffer(data)
+    elif isinstance(data, memoryview):
+        data = data.tobytes()
+
+    return binascii.crc_hqx(data, crc)
+
+#------------------------------------------------------------------------------
+# Image CRC16 held by a legacy init packet (dfu_init_t in gen_dat.c: device
+# type, device revision, app version, softdevice list, crc), or None if the
+# packet is too short to hold one.
+#------------------------------------------------------------------------------
+def init_packet_crc(init):
+
+    init = str(init)
+
+    if len(init) < 10:
+        return None
+
+    sd_len = struct.unpack('<H', init[8:10])[0]
+    crc_offset = 10 + 2 * sd_len
+
+    if len(init) < crc_offset + 2:
+        return None
+
+    return struct.unpack('<H', init[crc_offset:crc_offset + 2])[0]
@@ -5,13 +5,21 @@
 #------------------------------------------------------------------------------
 import os
 import sys
-import pexpect
-import optparse
+import math
 import time
-
-from intelhex import IntelHex
-from array    import array
-from unpacker import Unpacker
+import optparse
+import itertools
+
+from array       import array
+from collections import deque
+from binascii    import hexlify
+from crc16       import init_packet_crc
+from firmware    import FirmwareImage, load_image
+from checkpoint  import save_checkpoint, load_checkpoint, clear_checkpoint
+from metrics     import SessionMetrics, monotonic, write_json, write_prometheus
+from events      import EventSource, EventKinds, print_event
+from unpacker    import Unpacker, ImageTypes
+from transport   import create_transport, transports, ATT_DEFAULT_MTU
 
 # DFU Opcodes
 class Commands:
@@ -21,39 +29,41 @@ class Commands:
     VALIDATE_FIRMWARE_IMAGE      = 4
     ACTIVATE_FIRMWARE_AND_RESET  = 5
     SYSTEM_RESET                 = 6
+    IMAGE_SIZE_REQ               = 7
     PKT_RCPT_NOTIF_REQ           = 8
 
 # DFU Procedures values
 DFU_proc_to_str = {
-    "01" : "START",
-    "02" : "INIT",
-    "03" : "RECEIVE_APP",
-    "04" : "VALIDATE",
-    "08" : "PKT_RCPT_REQ",
+    0x01 : "START",
+    0x02 : "INIT",
+    0x03 : "RECEIVE_APP",
+    0x04 : "VALIDATE",
+    0x07 : "IMAGE_SIZE",
+    0x08 : "PKT_RCPT_REQ",
 }
 
 # DFU Operations values
 DFU_oper_to_str = {
-    "01" : "START_DFU",
-    "02" : "RECEIVE_INIT",
-    "03" : "RECEIVE_FW",
-    "04" : "VALIDATE",
-    "05" : "ACTIVATE_N_RESET",
-    "06" : "SYS_RESET",
-    "07" : "IMAGE_SIZE_REQ",
-    "08" : "PKT_RCPT_REQ",
-    "10" : "RESPONSE",
-    "11" : "PKT_RCPT_NOTIF",
+    0x01 : "START_DFU",
+    0x02 : "RECEIVE_INIT",
+    0x03 : "RECEIVE_FW",
+    0x04 : "VALIDATE",
+    0x05 : "ACTIVATE_N_RESET",
+    0x06 : "SYS_RESET",
+    0x07 : "IMAGE_SIZE_REQ",
+    0x08 : "PKT_RCPT_REQ",
+    0x10 : "RESPONSE",
+    0x11 : "PKT_RCPT_NOTIF",
 }
 
 # DFU Status values
 DFU_status_to_str = {
-    "01" : "SUCCESS",
-    "02" : "INVALID_STATE",
-    "03" : "NOT_SUPPORTED",
-    "04" : "DATA_SIZE",
-    "05" : "CRC_ERROR",
-    "06" : "OPER_FAILED",
+    0x01 : "SUCCESS",
+    0x02 : "INVALID_STATE",
+    0x03 : "NOT_SUPPORTED",
+    0x04 : "DATA_SIZE",
+    0x05 : "CRC_ERROR",
+    0x06 : "OPER_FAILED",
 }
 
 #------------------------------------------------------------------------------
@@ -68,6 +78,15 @@ def convert_uint32_to_array(value):
            (value >> 24 & 0xFF)
     ]
 
+#------------------------------------------------------------------------------
+# START_DFU image sizes: SoftDevice, bootloader and application, 4 bytes
+# each (LSB).
+#------------------------------------------------------------------------------
+def convert_sizes_to_array(sd_size, bl_size, app_size):
+    return (convert_uint32_to_array(sd_size)[8:] +
+            convert_uint32_to_array(bl_size)[8:] +
+            convert_uint32_to_array(app_size)[8:])
+
 #------------------------------------------------------------------------------
 # Convert a number into an array of 2 bytes (LSB).
 #------------------------------------------------------------------------------
@@ -77,17 +96,20 @@ def convert_uint16_to_array(value):
         (value >> 8 & 0xFF)
     ]
 
+#------------------------------------------------------------------------------
+# Convert an array of 4 bytes (LSB) into a number.
+#------------------------------------------------------------------------------
+def convert_array_to_uint32(arr):
+    return (arr[0] << 0) + (arr[1] << 8) + (arr[2] << 16) + (arr[3] << 24)
+
 #------------------------------------------------------------------------------
 #
 #------------------------------------------------------------------------------
 def convert_array_to_hex_string(arr):
-    hex_str = ""
-    for val in arr:
-        if val > 255:
-            raise Exception("Value is greater than it is possible to represent with one byte")
-        hex_str += "%02x" % val
-
-    return hex_str
+    try:
+        return hexlify(bytearray(arr))
+    except ValueError:
+        raise Exception("Value is greater than it is possible to represent with one byte")
 
 #------------------------------------------------------------------------------
 # Define the BleDfuServer class
@@ -102,20 +124,124 @@ class BleDfuServer(object):
     data_handle        = 0x17
 
     pkt_receipt_interval = 10
+    pkt_receipt_window   = 2
     pkt_payload_size     = 20
 
+    #--------------------------------------------------------------------------
+    # ATT MTU asked for after connecting.  Packets then carry MTU-3 bytes
+    # (rounded down to whole words, which the bootloader writes to flash),
+    # and the link layer is asked for packets that fit one whole.  Legacy
+    # targets keep the MTU at 23 and with it the 20 byte payload.  An
+    # att_mtu of 23 skips the exchange.
+    #--------------------------------------------------------------------------
+    att_mtu = 247
+
+    #--------------------------------------------------------------------------
+    # Adaptive receipt interval: the transfer starts with calibration_receipts
+    # receipts at the minimum interval and as many at twice that, measuring
+    # receipt round trips, then settles on an interval within the min/max.
+    #--------------------------------------------------------------------------
+    adaptive_receipt         = False
+    pkt_receipt_interval_min = 4
+    pkt_receipt_interval_max = 32
+    calibration_receipts     = 4
+
+    #--------------------------------------------------------------------------
+    # Resume: the confirmed byte count is checkpointed every checkpoint_period
+    # seconds and when the transfer fails.  With resume set, a later session
+    # asks the bootloader how much it holds (IMAGE_SIZE_REQ) and continues
+    # from there instead of erasing and starting over.
+    #--------------------------------------------------------------------------
+    resume            = False
+    resume_timeout    = 3
+    checkpoint_period = 5
+
+    #--------------------------------------------------------------------------
+    # Connection parameters: fast_conn_params for the image transfer, where
+    # the connection interval sets the pace, relaxed_conn_params once it is
+    # done.  (interval min ms, interval max ms, slave latency, supervision
+    # timeout ms); None leaves the link as it is.  The controller's grant
+    # is logged and recorded in the session metrics.
+    #--------------------------------------------------------------------------
+    fast_conn_params    = (7.5, 15, 0, 4000)
+    relaxed_conn_params = (50, 100, 0, 4000)
+
+    #--------------------------------------------------------------------------
+    # Upper bounds on the waits at the end of an update: the VALIDATE
+    # response (CRC check of the image) and the peer dropping the link as
+    # it resets after ACTIVATE.
+    #--------------------------------------------------------------------------
+    validate_timeout = 30
+    reset_timeout    = 10
+
+    #--------------------------------------------------------------------------
+    # Between the images of a package the target resets; it is given
+    # reconnect_timeout seconds to come back.
+    #--------------------------------------------------------------------------
+    reconnect_timeout = 30
+
     #--------------------------------------------------------------------------
     #
     #--------------------------------------------------------------------------
-    def __init__(self, target_mac, hexfile_path, datfile_path):
+    def __init__(self, target_mac, hexfile_path, datfile_path, transport='gatttool'):
 
+        self.target_mac   = target_mac
         self.hexfile_path = hexfile_path
         self.datfile_path = datfile_path
 
-        self.ble_conn = pexpect.spawn("gatttool -b '%s' -t random --interactive" % target_mac)
+        if isinstance(transport, basestring):
+            transport = create_transport(transport, target_mac)
+
+        self.transport = transport
+
+        # Set from another thread (threading.Event) to stop the session.
+        self.cancel_event = None
 
-        # remove next line comment for pexpect detail tracing.
-        #self.ble_conn.logfile = sys.stdout
+        self.resume_attempts = 0
+        self.resumed_from    = 0
+
+        self.bytes_sent      = 0
+        self.bytes_confirmed = 0
+        self.transfer_start  = 0.0
+        self.transfer_offset = 0
+        self.hex_size        = 0
+
+        # Image being sent: START_DFU image type, package entry name (None
+        # for a lone hex/bin file) and, for SoftDevice and bootloader
+        # images, the size of each part.
+        self.image_type = ImageTypes.APPLICATION
+        self.image_name = None
+        self.sd_size    = 0
+        self.bl_size    = 0
+
+        # SessionMetrics of each image sent by dfu_send_package
+        self.image_metrics = []
+
+        # Phase timings, throughput and PKT_RCPT round trips of this session.
+        self.metrics = SessionMetrics(target_mac)
+
+        # Phase, progress and error events for frontends (see events.py).
+        self.events = EventSource(target_mac)
+
+    #--------------------------------------------------------------------------
+    # Register a callable or queue to receive this session's DfuEvents.
+    #--------------------------------------------------------------------------
+    def add_listener(self, listener):
+        self.events.add_listener(listener)
+
+    #--------------------------------------------------------------------------
+    # Enter a new phase: timed by the metrics and announced to listeners.
+    #--------------------------------------------------------------------------
+    def _dfu_phase(self, name):
+        self.metrics.start_phase(name)
+        self.events.emit_phase(name)
+
+    #--------------------------------------------------------------------------
+    # Stop the session at the next wait point if it has been cancelled.
+    #--------------------------------------------------------------------------
+    def _dfu_check_cancel(self):
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise Exception("Session cancelled")
 
     #--------------------------------------------------------------------------
     # Connect to peripheral device.
@@ -124,61 +250,69 @@ class BleDfuServer(object):
 
         print "scan_and_connect"
 
-        try:
-            self.ble_conn.expect('\[LE\]>', timeout=10)
-        except pexpect.TIMEOUT, e:
-            print "Connect timeout"
+        self._dfu_phase("connect")
+        self.transport.connect()
+        self._dfu_negotiate_mtu()
+        self.metrics.end_phase()
 
-        self.ble_conn.sendline('connect')
+    #--------------------------------------------------------------------------
+    # Exchange the MTU and size the data packets from it.
+    #--------------------------------------------------------------------------
+    def _dfu_negotiate_mtu(self):
 
-        try:
-            res = self.ble_conn.expect('\[CON\].*>', timeout=10)
-        except pexpect.TIMEOUT, e:
-            print "Connect timeout"
+        if self.att_mtu <= ATT_DEFAULT_MTU:
+            return
+
+        mtu = self.transport.exchange_mtu(self.att_mtu)
+
+        if mtu > ATT_DEFAULT_MTU:
+            self.pkt_payload_size = (mtu - 3) & ~3
+            # ATT opcode and handle plus the L2CAP header
+            self.metrics.data_length = self.transport.set_data_length(self.pkt_payload_size + 7)
+        else:
+            self.pkt_payload_size = ATT_DEFAULT_MTU - 3
+
+        self.metrics.att_mtu      = mtu
+        self.metrics.payload_size = self.pkt_payload_size
+
+        print "ATT MTU {0}, packet payload {1} bytes, data length {2}".format(
+              mtu, self.pkt_payload_size, self.metrics.data_length or "default")
 
     #--------------------------------------------------------------------------
-    # Wait for notification to arrive.
-    # Example format: "Notification handle = 0x0019 value: 10 01 01"
+    # Wait for notification to arrive on the control point.
+    # Returns the notification value (bytearray) or None on timeout.
     #--------------------------------------------------------------------------
-    def _dfu_wait_for_notify(self):
+    def _dfu_wait_for_notify(self, timeout=30):
 
-        while True:
-            #print "dfu_wait_for_notify"
+        #print "dfu_wait_for_notify"
 
-            if not self.ble_conn.isalive():
-                print "connection not alive"
-                return None
+        self._dfu_check_cancel()
 
-            try:
-                index = self.ble_conn.expect('Notification handle = .*? \r\n', timeout=30)
-
-            except pexpect.TIMEOUT:
-                #
-                # The gatttool does not report link-lost directly.
-                # The only way found to detect it is monitoring the prompt '[CON]'
-                # and if it goes to '[   ]' this indicates the connection has
-                # been broken.
-                # In order to get a updated prompt string, issue an empty
-                # sendline('').  If it contains the '[   ]' string, then
-                # raise an exception. Otherwise, if not a link-lost condition,
-                # continue to wait.
-                #
-                self.ble_conn.sendline('')
-                string = self.ble_conn.before
-                if '[   ]' in string:
-                    print 'Connection lost! {0}.{1}'.format(name, os.getpid())
-                    raise Exception('Connection Lost')
-                return None
-
-            if index == 0:
-                after = self.ble_conn.after
-                hxstr = after.split()[3:]
-                handle = long(float.fromhex(hxstr[0]))
-                return hxstr[2:]
+        notify = self.transport.wait_notify(timeout, self.ctrlpt_handle)
+        if notify == None:
+            return None
 
-            else:
-                print "unexpeced index: {0}".format(index)
-                return None
+        return notify.value
+
+    #--------------------------------------------------------------------------
+    # Wait for the RESPONSE to control point procedure 'procedure'; raises
+    # unless it reports SUCCESS.
+    #--------------------------------------------------------------------------
+    def _dfu_wait_for_response(self, procedure, timeout=30):
+
+        deadline = monotonic() + timeout
+
+        while True:
+            notify = self._dfu_wait_for_notify(max(deadline - monotonic(), 0))
+
+            if notify == None:
+                raise Exception("no {0} response".format(DFU_proc_to_str.get(procedure, procedure)))
+
+            if len(notify) >= 3 and DFU_oper_to_str.get(notify[0]) == "RESPONSE" and notify[1] == procedure:
+                if self._dfu_parse_notify(notify) != "OK":
+                    raise Exception("{0} failed: {1}".format(DFU_proc_to_str.get(procedure, procedure),
+                                                             DFU_status_to_str.get(notify[2], notify[2])))
+                return
 
     #--------------------------------------------------------------------------
     # Parse notification status results
@@ -208,97 +342,142 @@ class BleDfuServer(object):
                 return "FAIL"
 
         if oper_str == "PKT_RCPT_NOTIF":
+            return "OK"
 
-            byte1 = int(notify[4], 16)
-            byte2 = int(notify[3], 16)
-            byte3 = int(notify[2], 16)
-            byte4 = int(notify[1], 16)
-
-            receipt = 0
-            receipt = receipt + (byte1 << 24)
-            receipt = receipt + (byte2 << 16)
-            receipt = receipt + (byte3 << 8)
-            receipt = receipt + (byte4 << 0)
 
-            print "PKT_RCPT: {0:8}".format(receipt)
+    #--------------------------------------------------------------------------
+    # Wait for the oldest outstanding PKT_RCPT and check its byte count
+    # against the offset sent at that point.
+    # Returns True once the peer reports the whole image received.
+    #--------------------------------------------------------------------------
+    def _dfu_wait_for_receipt(self, outstanding):
 
-            return "OK"
+        while True:
+            notify = self._dfu_wait_for_notify()
+
+            if notify == None:
+                raise Exception("no notification received: sent {0}, peer confirmed {1}".format(
+                                self.bytes_sent, self.bytes_confirmed))
+
+            dfu_status = self._dfu_parse_notify(notify)
+
+            if dfu_status == None or dfu_status != "OK":
+                raise Exception("bad notification status")
+
+            if DFU_oper_to_str[notify[0]] == "PKT_RCPT_NOTIF":
+                receipt = convert_array_to_uint32(notify[1:5])
+                expected, sent_time, interval = outstanding.popleft()
+                if receipt != expected:
+                    raise Exception("PKT_RCPT mismatch: sent {0}, peer has {1}".format(expected, receipt))
+                self.bytes_confirmed = receipt
+                arrived = monotonic()
+                self.receipt_log.append((arrived, receipt, sent_time, interval))
+                self.metrics.receipt(arrived - sent_time)
+                self._dfu_progress(arrived)
+                return False
+
+            # The RECEIVE_APP response follows the last packet of the image.
+            # Any other response (INIT complete) carries no flow control.
+            if notify[1] == Commands.RECEIVE_FIRMWARE_IMAGE:
+                outstanding.clear()
+                self.bytes_confirmed = self.hex_size
+                self._dfu_progress(monotonic(), True)
+                return True
 
+    #--------------------------------------------------------------------------
+    # Tell listeners how far the transfer has got.
+    #--------------------------------------------------------------------------
+    def _dfu_progress(self, now, force=False):
+        sent = self.bytes_confirmed - self.transfer_offset
+        throughput = sent / max(now - self.transfer_start, 1e-6)
+        self.events.emit_progress(self.bytes_confirmed, self.hex_size, throughput, force)
 
     #--------------------------------------------------------------------------
     # Send two bytes: command + option
     #--------------------------------------------------------------------------
     def _dfu_state_set(self, opcode):
-        self.ble_conn.sendline('char-write-req 0x%04x %04x' % (self.ctrlpt_handle, opcode))
 
         # Verify that command was successfully written
-        try:
-            res = self.ble_conn.expect('.* Characteristic value was written successfully', timeout=10)
-        except pexpect.TIMEOUT, e:
+        if not self.transport.write_req(self.ctrlpt_handle, [opcode >> 8, opcode & 0xFF]):
             print "State timeout"
 
     #--------------------------------------------------------------------------
     # Send one byte: command
     #--------------------------------------------------------------------------
     def _dfu_state_set_byte(self, opcode):
-        self.ble_conn.sendline('char-write-req 0x%04x %02x' % (self.ctrlpt_handle, opcode))
 
         # Verify that command was successfully written
-        try:
-            res = self.ble_conn.expect('.* Characteristic value was written successfully', timeout=10)
-        except pexpect.TIMEOUT, e:
+        if not self.transport.write_req(self.ctrlpt_handle, [opcode]):
             print "State timeout"
 
     #--------------------------------------------------------------------------
-    # Send 3 bytes: PKT_RCPT_NOTIF_REQ with interval of 10 (0x0a)
+    # Pick the receipt interval from the receipts logged during calibration.
+    # The send-to-receipt time at two different intervals gives the time per
+    # packet on the link and the fixed round trip latency; the interval is
+    # sized so the rest of the receipt window covers that latency.
     #--------------------------------------------------------------------------
-    def _dfu_pkt_rcpt_notif_req(self):
+    def _dfu_tune_receipt_interval(self):
+
+        samples = {}
+        for arrived, receipt, sent, interval in self.receipt_log:
+            samples.setdefault(interval, []).append(arrived - sent)
+
+        medians = []
+        for interval in sorted(samples.keys()):
+            rtts = sorted(samples[interval])
+            medians.append((interval, rtts[len(rtts) // 2]))
+
+        if len(medians) < 2 or self.pkt_receipt_window < 2:
+            return self.pkt_receipt_interval_max
 
-        opcode = 0x080000
-        opcode = opcode + (self.pkt_receipt_interval << 8)
+        (interval_a, rtt_a), (interval_b, rtt_b) = medians[0], medians[-1]
 
-        self.ble_conn.sendline('char-write-req 0x%04x %06x' % (self.ctrlpt_handle, opcode))
+        pkt_time = (rtt_b - rtt_a) / (interval_b - interval_a)
+        if pkt_time <= 0:
+            return self.pkt_receipt_interval_max
+
+        latency  = max(rtt_a - interval_a * pkt_time, 0.0)
+        interval = int(math.ceil(latency / ((self.pkt_receipt_window - 1) * pkt_time)))
+
+        return max(self.pkt_receipt_interval_min, min(self.pkt_receipt_interval_max, interval))
+
+    #--------------------------------------------------------------------------
+    # Send 3 bytes: PKT_RCPT_NOTIF_REQ with interval (default 10, 0x0a)
+    #--------------------------------------------------------------------------
+    def _dfu_pkt_rcpt_notif_req(self, interval=None):
+
+        if interval == None:
+            interval = self.pkt_receipt_interval
+
+        request = [Commands.PKT_RCPT_NOTIF_REQ] + convert_uint16_to_array(interval)
 
         # Verify that command was successfully written
-        try:
-            res = self.ble_conn.expect('.* Characteristic value was written successfully', timeout=10)
-        except pexpect.TIMEOUT, e:
+        if not self.transport.write_req(self.ctrlpt_handle, request):
             print "Send PKT_RCPT_NOTIF_REQ timeout"
 
     #--------------------------------------------------------------------------
     # Send an array of bytes: request mode
     #--------------------------------------------------------------------------
     def _dfu_data_send_req(self, data_arr):
-        hex_str = convert_array_to_hex_string(data_arr)
-        #print hex_str
-        self.ble_conn.sendline('char-write-req 0x%04x %s' % (self.data_handle, hex_str))
 
         # Verify that data was successfully written
-        try:
-            res = self.ble_conn.expect('.* Characteristic value was written successfully', timeout=10)
-        except pexpect.TIMEOUT, e:
+        if not self.transport.write_req(self.data_handle, data_arr):
             print "Data timeout"
 
     #--------------------------------------------------------------------------
     # Send an array of bytes: command mode
     #--------------------------------------------------------------------------
     def _dfu_data_send_cmd(self, data_arr):
-        hex_str = convert_array_to_hex_string(data_arr)
-        #print hex_str
-        self.ble_conn.sendline('char-write-cmd 0x%04x %s' % (self.data_handle, hex_str))
+        self.transport.write_cmd(self.data_handle, data_arr)
 
     #--------------------------------------------------------------------------
     # Enable DFU Control Point CCCD (Notifications)
     #--------------------------------------------------------------------------
     def _dfu_enable_cccd(self):
         cccd_enable_value_array_lsb = convert_uint16_to_array(0x0001)
-        cccd_enable_value_hex_string = convert_array_to_hex_string(cccd_enable_value_array_lsb)
-        self.ble_conn.sendline('char-write-req 0x%04x %s' % (self.ctrlpt_cccd_handle, cccd_enable_value_hex_string))
 
         # Verify that CCCD was successfully written
-        try:
-            res = self.ble_conn.expect('.* Characteristic value was written successfully', timeout=10)
-        except pexpect.TIMEOUT, e:
+        if not self.transport.write_req(self.ctrlpt_cccd_handle, cccd_enable_value_array_lsb):
             print "CCCD timeout"
 
     #--------------------------------------------------------------------------
@@ -308,8 +487,8 @@ class BleDfuServer(object):
 
         print "dfu_send_info"
 
-        # Open the DAT file and create array of its contents
-        bin_array = array('B', open(self.datfile_path, 'rb').read())
+        # Create array of the DAT file contents
+        bin_array = array('B', self._dfu_read_init())
 
         # Transmit Init info
         self._dfu_data_send_req(bin_array)
@@ -318,6 +497,7 @@ class BleDfuServer(object):
     # Initialize: 
     #    Hex: read and convert hexfile into bin_array 
     #    Bin: read binfile into bin_array
+    # The image is shared with any other session flashing the same file.
     #--------------------------------------------------------------------------
     def input_setup(self):
 
@@ -326,22 +506,111 @@ class BleDfuServer(object):
         if self.hexfile_path == None:
             raise Exception("input invalid")
 
-        name, extent = os.path.splitext(self.hexfile_path)
+        if isinstance(self.hexfile_path, FirmwareImage):
+            self.image = self.hexfile_path
+        else:
+            self.image = load_image(self.hexfile_path)
+        self.bin_array = self.image.data
+        self.hex_size = self.image.size
+        print "bin array size: ", self.hex_size
+
+        self._dfu_check_init()
+
+    #--------------------------------------------------------------------------
+    # Init packet contents.  datfile_path is the path of the *.dat file, or
+    # the packet itself as a bytearray (Unpacker reads it from the zip).
+    #--------------------------------------------------------------------------
+    def _dfu_read_init(self):
+
+        if isinstance(self.datfile_path, bytearray):
+            return self.datfile_path
+
+        return bytearray(open(self.datfile_path, 'rb').read())
+
+    #--------------------------------------------------------------------------
+    # Check the image against the CRC16 in the init packet, so a mismatched
+    # hex/dat pair is caught here rather than at VALIDATE, after the transfer.
+    #--------------------------------------------------------------------------
+    def _dfu_check_init(self):
+
+        if self.datfile_path == None:
+            raise Exception("input invalid")
+
+        init_crc = init_packet_crc(self._dfu_read_init())
 
-        if extent == ".bin":
-            self.bin_array = array('B', open(self.hexfile_path, 'rb').read())
-            self.hex_size = len(self.bin_array)
-            print "bin array size: ", self.hex_size
-            return
+        if init_crc == None:
+            raise Exception("init packet invalid")
 
-        if extent == ".hex":
-            intelhex = IntelHex(self.hexfile_path)
-            self.bin_array = intelhex.tobinarray()
-            self.hex_size = len(self.bin_array)
-            print "bin array size: ", self.hex_size
-            return
+        image_crc = self.image.crc16()
+
+        if image_crc != init_crc:
+            raise Exception("image CRC 0x{0:04x} does not match init packet CRC 0x{1:04x}".format(image_crc, init_crc))
 
-        raise Exception("input invalid")
+        print "image CRC: 0x{0:04x}".format(image_crc)
+
+    #--------------------------------------------------------------------------
+    # Find out whether an interrupted transfer of this image can be resumed.
+    # Returns the byte offset to continue from, or 0 for a fresh transfer.
+    # The bootloader is asked even without a checkpoint: it may hold bytes
+    # of a session that dropped before anything was checkpointed.
+    #--------------------------------------------------------------------------
+    def _dfu_try_resume(self):
+
+        checkpoint = load_checkpoint(self.target_mac, self.image)
+
+        self._dfu_phase("resume")
+        if checkpoint != None:
+            self.resume_attempts += 1
+            self.metrics.resume_attempts += 1
+            print "resume: checkpoint at {0}".format(checkpoint["confirmed"])
+
+        # Ask the bootloader how many image bytes it holds.
+        self._dfu_state_set_byte(Commands.IMAGE_SIZE_REQ)
+
+        notify = self._dfu_wait_for_notify(self.resume_timeout)
+
+        if notify == None or len(notify) < 7 or DFU_oper_to_str.get(notify[0]) != "RESPONSE" or \
+           notify[1] != Commands.IMAGE_SIZE_REQ or DFU_status_to_str.get(notify[2]) != "SUCCESS":
+            if checkpoint != None:
+                print "resume: not supported by bootloader, starting over"
+                clear_checkpoint(self.target_mac)
+            return 0
+
+        received = convert_array_to_uint32(notify[3:7])
+
+        if received == 0:
+            if checkpoint != None:
+                print "resume: bootloader holds no image, starting over"
+                clear_checkpoint(self.target_mac)
+            return 0
+
+        if checkpoint == None:
+            # The bytes cannot be matched to this image.
+            self._dfu_reject_resume("peer holds {0} bytes of a transfer with no checkpoint".format(received))
+
+        if received < checkpoint["confirmed"] or received > self.hex_size:
+            # The bootloader is mid-transfer of something else.
+            self._dfu_reject_resume("peer has {0} bytes".format(received))
+
+        print "resume: continuing at {0}".format(received)
+        return received
+
+    #--------------------------------------------------------------------------
+    # Reset a bootloader that is mid-transfer of something this session
+    # cannot continue, so the next connection starts from a clean state.
+    #--------------------------------------------------------------------------
+    def _dfu_reject_resume(self, reason):
+
+        clear_checkpoint(self.target_mac)
+
+        # The peer may reset before it acknowledges the write.
+        try:
+            self._dfu_state_set_byte(Commands.SYSTEM_RESET)
+        except Exception, e:
+            if not str(e).startswith('Connection Lost'):
+                raise
+
+        raise Exception("Resume rejected: {0}; bootloader reset, run the update again".format(reason))
 
     #--------------------------------------------------------------------------
     # Send the binary firmware image to peripheral device.
@@ -350,14 +619,150 @@ class BleDfuServer(object):
 
         print "dfu_send_image"
 
+        try:
+            self._dfu_send_image()
+        except Exception, e:
+            self.events.emit(EventKinds.ERROR, self.bytes_confirmed, self.hex_size, error=str(e))
+            raise
+
+        self.events.emit(EventKinds.DONE, self.hex_size, self.hex_size)
+
+    def _dfu_send_image(self):
+
         # Enable Notifications
+        self._dfu_phase("enable_cccd")
         self._dfu_enable_cccd()
 
-        # Send 'START DFU' + Application Command
-        self._dfu_state_set(0x0104)
+        offset = 0
+        if self.resume:
+            offset = self._dfu_try_resume()
+
+        # Send packet receipt notification interval (default 10)
+        calibration = []
+        if self.adaptive_receipt:
+            calibration = [self.pkt_receipt_interval_min, 2 * self.pkt_receipt_interval_min]
+
+        interval = self.pkt_receipt_interval
+        if calibration:
+            interval = calibration.pop(0)
+
+        if offset == 0:
+            self._dfu_start(interval)
+        else:
+            # The bootloader is still in its receive state; just restart
+            # its receipt count.
+            self._dfu_pkt_rcpt_notif_req(interval)
+            self.resumed_from = offset
+            self.metrics.resumed_from = offset
+
+        self._dfu_send_firmware(offset, interval, calibration)
+
+        # Send Validate Command and wait for the peer to check the image.
+        self._dfu_phase("validate")
+        self._dfu_state_set_byte(Commands.VALIDATE_FIRMWARE_IMAGE)
+        self._dfu_wait_for_response(Commands.VALIDATE_FIRMWARE_IMAGE, self.validate_timeout)
+
+        # Send Activate and Reset Command.  The peer may reset before it
+        # acknowledges the write, so a lost link here is expected.
+        self._dfu_phase("activate")
+        try:
+            self._dfu_state_set_byte(Commands.ACTIVATE_FIRMWARE_AND_RESET)
+        except Exception, e:
+            if not str(e).startswith('Connection Lost'):
+                raise
+
+        # The peer drops the link as it resets into the new firmware.
+        self._dfu_phase("reset")
+        if not self.transport.wait_disconnect(self.reset_timeout):
+            print "no disconnect {0}s after activate".format(self.reset_timeout)
+        self.metrics.end_phase()
+
+    #--------------------------------------------------------------------------
+    # Send the PackageImages of a zip package (see unpacker.py) in order, in
+    # one session.  All images are checked against their init packets before
+    # connecting.  The target resets after each image, and the link is
+    # opened again for the next.  Each image is timed by a SessionMetrics of
+    # its own (image_metrics) and its events carry its name.
+    #--------------------------------------------------------------------------
+    def dfu_send_package(self, images):
+
+        for item in images:
+            self._dfu_select_image(item)
+            self.input_setup()
+
+        for index, item in enumerate(images):
+            self._dfu_select_image(item)
+
+            if index:
+                self.metrics.finish()
+                self.metrics = SessionMetrics(self.target_mac)
+            self.metrics.image = item.name
+            self.image_metrics.append(self.metrics)
+            self.events.image = item.name
+
+            print "image {0} of {1}: {2}, {3} bytes".format(index + 1, len(images), item.name, item.image.size)
+
+            if index:
+                self._dfu_reconnect()
+            else:
+                self.scan_and_connect()
+
+            self.dfu_send_image()
+
+    def _dfu_select_image(self, item):
+        self.image_name   = item.name
+        self.image_type   = item.image_type
+        self.sd_size      = item.sd_size
+        self.bl_size      = item.bl_size
+        self.hexfile_path = item.image
+        self.datfile_path = item.init
+        self.image        = item.image
+        self.bin_array    = item.image.data
+        self.hex_size     = item.image.size
+
+    #--------------------------------------------------------------------------
+    # Connect again once the target is back from the reset that activated
+    # the previous image.  The old transport is done with; a new one to the
+    # same target is opened until one connects.
+    #--------------------------------------------------------------------------
+    def _dfu_reconnect(self):
+
+        print "reconnect"
+
+        self._dfu_phase("connect")
+        self.transport.disconnect()
+
+        deadline = monotonic() + self.reconnect_timeout
+
+        while True:
+            self._dfu_check_cancel()
+
+            self.transport = self.transport.reopen()
+            if self.transport.connect():
+                break
+            self.transport.disconnect()
+
+            if monotonic() >= deadline:
+                raise Exception("target not back {0}s after reset".format(self.reconnect_timeout))
+            time.sleep(1)
+
+        self._dfu_negotiate_mtu()
+        self.metrics.end_phase()
+
+    #--------------------------------------------------------------------------
+    # START, image size, INIT and RECEIVE: everything before the image data.
+    #--------------------------------------------------------------------------
+    def _dfu_start(self, interval):
+
+        # Send 'START DFU' + image type (Application unless sending a package)
+        self._dfu_phase("start")
+        self._dfu_state_set(0x0100 | self.image_type)
 
         # Transmit binary image size
-        hex_size_array_lsb = convert_uint32_to_array(len(self.bin_array))
+        app_size = 0
+        if self.image_type == ImageTypes.APPLICATION:
+            app_size = len(self.bin_array)
+        hex_size_array_lsb = convert_sizes_to_array(self.sd_size, self.bl_size, app_size)
 
         print hex_size_array_lsb
         self._dfu_data_send_req(hex_size_array_lsb)
@@ -367,6 +772,7 @@ class BleDfuServer(object):
         self._dfu_state_set(0x0200)
 
         # Wait for INIT DFU notification (indicates flash erase completed)
+        self._dfu_phase("erase")
         notify = self._dfu_wait_for_notify()
 
         # Check the notify status.
@@ -375,59 +781,187 @@ class BleDfuServer(object):
             raise Exception("bad notification status")
 
         # Transmit the Init image (DAT).
+        self._dfu_phase("init")
         self._dfu_send_init()
 
         # Send 'INIT DFU' + Complete Command
         self._dfu_state_set(0x0201)
 
-        # Send packet receipt notification interval (currently 10)
-        self._dfu_pkt_rcpt_notif_req()
+        # Send packet receipt notification interval
+        self._dfu_pkt_rcpt_notif_req(interval)
 
         # Send 'RECEIVE FIRMWARE IMAGE' command to set DFU in firmware receive state. 
         self._dfu_state_set_byte(Commands.RECEIVE_FIRMWARE_IMAGE)
 
+        # From here on the bootloader holds image bytes, so a dropped link
+        # can be resumed even before the first PKT_RCPT.
+        save_checkpoint(self.target_mac, self.image, 0)
+
+    #--------------------------------------------------------------------------
+    # Transfer the image from 'offset' on.
+    #--------------------------------------------------------------------------
+    def _dfu_send_firmware(self, offset, interval, calibration):
+
         '''
         Send bin_array contents as as series of packets (burst mode).
-        Each segment is pkt_payload_size bytes long.
-        For every pkt_receipt_interval sends, wait for notification.
+        Each segment is pkt_payload_size bytes long, pre-encoded by the
+        image's packet plan for this transport.
+        A PKT_RCPT is expected for every receipt interval sends; up to
+        pkt_receipt_window of them may be outstanding before the sender
+        waits.  The last packet is answered by the RECEIVE_APP response.
+        In adaptive mode the interval is re-requested during calibration and
+        once tuned; each time the peer restarts its packet count there,
+        right after a receipt point.
+        A resumed transfer starts with whatever is left of the segment
+        holding 'offset', then carries on with the plan's own packets.
         '''
-        segment_count = 1
-        for i in range(0, self.hex_size, self.pkt_payload_size):
+        plan = self.image.packet_plan(self.transport, self.data_handle, self.pkt_payload_size)
 
-            segment = self.bin_array[i:i + self.pkt_payload_size]
-            self._dfu_data_send_cmd(segment)
+        # packet n sent from here on completes plan segment base + n
+        base  = offset // self.pkt_payload_size
+        wires = itertools.islice(plan.wire, base, None)
+        if offset % self.pkt_payload_size:
+            tail  = plan.segments[base][offset % self.pkt_payload_size:]
+            wires = itertools.chain([self.transport.encode_cmd(self.data_handle, tail)],
+                                    itertools.islice(wires, 1, None))
 
-            #print "segment #", segment_count
+        outstanding = deque()
+        complete    = (offset >= self.hex_size)
 
-            if (segment_count % self.pkt_receipt_interval) == 0:
-                notify = self._dfu_wait_for_notify()
+        self.bytes_sent      = offset
+        self.bytes_confirmed = offset
+        self.receipt_log     = []
 
-                if notify == None:
-                    raise Exception("no notification received")
+        self.metrics.conn_params = self._dfu_update_conn_params(self.fast_conn_params)
 
-                dfu_status = self._dfu_parse_notify(notify)
+        self._dfu_phase("transfer")
+        transfer_start = monotonic()
 
-                if dfu_status == None or dfu_status != "OK":
-                    raise Exception("bad notification status")
+        self.transfer_start  = transfer_start
+        self.transfer_offset = offset
 
-            segment_count += 1
+        done = False
+        try:
+            try:
+                self._dfu_send_packets(plan, wires, base, interval, calibration, outstanding, complete)
+            except Exception:
+                self.metrics.end_phase()
+                if self.bytes_confirmed:
+                    save_checkpoint(self.target_mac, self.image, self.bytes_confirmed)
+                raise
 
-        # Send Validate Command
-        self._dfu_state_set_byte(Commands.VALIDATE_FIRMWARE_IMAGE)
+            clear_checkpoint(self.target_mac)
+
+            transfer_time = monotonic() - transfer_start
+            self.metrics.transfer(self.hex_size - offset, transfer_time)
+            self.throughput = (self.hex_size - offset) / max(transfer_time, 1e-6)
+
+            conn_params = self.metrics.conn_params
+            print "PKT_RCPT interval: {0} ({1}), connection interval: {2}, throughput: {3:.0f} bytes/s".format(
+                  self.receipt_interval, "adaptive" if self.adaptive_receipt else "fixed",
+                  "{0} ms".format(conn_params.interval) if conn_params else "unknown", self.throughput)
+            done = True
+
+        finally:
+            self._dfu_relax_conn_params(done)
+
+    #--------------------------------------------------------------------------
+    # Go back to relaxed_conn_params once the transfer is over, whether it
+    # got through or not: a resume or retry may carry on over the same
+    # link.  After a failed transfer the link may well be gone; an error
+    # here is then only logged, so that the transfer's own error comes out.
+    #--------------------------------------------------------------------------
+    def _dfu_relax_conn_params(self, done):
+
+        if self.relaxed_conn_params is None:
+            return
+
+        try:
+            self._dfu_update_conn_params(self.relaxed_conn_params)
+        except Exception, e:
+            if done:
+                raise
+            print "connection parameter update failed: {0}".format(e)
+
+    #--------------------------------------------------------------------------
+    # Request connection parameters (see fast_conn_params) and report what
+    # was granted.  Returns the transport's ConnParams or None.
+    #--------------------------------------------------------------------------
+    def _dfu_update_conn_params(self, params):
+
+        if params is None:
+            return None
+
+        self._dfu_phase("conn_update")
+        granted = self.transport.update_conn_params(*params)
+
+        if granted is None:
+            print "connection interval {0}-{1} ms requested, grant not confirmed".format(params[0], params[1])
+        else:
+            print "connection interval {0} ms granted ({1}-{2} ms requested), latency {3}, timeout {4} ms".format(
+                  granted.interval, params[0], params[1], granted.latency, granted.timeout)
+
+        return granted
+
+    #--------------------------------------------------------------------------
+    # Packet loop of _dfu_send_firmware.
+    #--------------------------------------------------------------------------
+    def _dfu_send_packets(self, plan, wires, base, interval, calibration, outstanding, complete):
+
+        write_encoded = self.transport.write_encoded
+        last_segment  = len(plan) - base
+
+        calibrating  = self.adaptive_receipt
+        calibrated   = 0
+        next_receipt = interval
 
-        # Wait a bit for copy on the peer to be finished
-        time.sleep(1)
+        checkpoint_time = monotonic()
 
-        # Send Activate and Reset Command
-        self._dfu_state_set_byte(Commands.ACTIVATE_FIRMWARE_AND_RESET)
+        segment_count = 1
+        for wire in wires:
+
+            write_encoded(wire)
+
+            #print "segment #", segment_count
 
+            if segment_count == next_receipt and segment_count != last_segment:
+                self.bytes_sent = plan.offset_after(base + segment_count)
+                outstanding.append((self.bytes_sent, monotonic(), interval))
+                next_receipt += interval
+
+                if len(outstanding) >= self.pkt_receipt_window:
+                    complete = self._dfu_wait_for_receipt(outstanding)
+
+                    if monotonic() - checkpoint_time >= self.checkpoint_period:
+                        save_checkpoint(self.target_mac, self.image, self.bytes_confirmed)
+                        checkpoint_time = monotonic()
+
+                if calibrating and len(self.receipt_log) - calibrated >= self.calibration_receipts:
+                    calibrated = len(self.receipt_log)
+                    if calibration:
+                        tuned = calibration.pop(0)
+                    else:
+                        tuned = self._dfu_tune_receipt_interval()
+                        calibrating = False
+                    if tuned != interval:
+                        interval = tuned
+                        self._dfu_pkt_rcpt_notif_req(interval)
+                        next_receipt = segment_count + interval
+
+            segment_count += 1
+
+        self.bytes_sent = self.hex_size
+
+        while not complete:
+            complete = self._dfu_wait_for_receipt(outstanding)
+
+        self.receipt_interval = interval
 
     #--------------------------------------------------------------------------
     # Disconnect from peer device if not done already and clean up. 
     #--------------------------------------------------------------------------
     def disconnect(self):
-        self.ble_conn.sendline('exit')
-        self.ble_conn.close()
+        self.transport.disconnect()
 
 #------------------------------------------------------------------------------
 #
@@ -472,6 +1006,75 @@ def main():
                   help='zip file to be used.'
                   )
 
+        parser.add_option('-w', '--window',
+                  action='store',
+                  dest="window",
+                  type="int",
+                  default=BleDfuServer.pkt_receipt_window,
+                  help='packet receipts allowed in flight (1 = stop-and-wait).'
+                  )
+
+        parser.add_option('--adaptive',
+                  action='store_true',
+                  dest="adaptive",
+                  default=False,
+                  help='tune the packet receipt interval from measured round trips.'
+                  )
+
+        parser.add_option('--mtu',
+                  action='store',
+                  dest="mtu",
+                  type="int",
+                  default=BleDfuServer.att_mtu,
+                  help='ATT MTU to negotiate; packets carry MTU-3 bytes (23 = no exchange, default %default).'
+                  )
+
+        parser.add_option('--no-conn-update',
+                  action='store_true',
+                  dest="no_conn_update",
+                  default=False,
+                  help='keep the connection parameters the link came up with.'
+                  )
+
+        parser.add_option('-r', '--resume',
+                  action='store_true',
+                  dest="resume",
+                  default=False,
+                  help='continue an interrupted transfer of the same image.'
+                  )
+
+        parser.add_option('--metrics-json',
+                  action='store',
+                  dest="metrics_json",
+                  type="string",
+                  default=None,
+                  help='write per-phase timings of the session to this JSON file.'
+                  )
+
+        parser.add_option('--prometheus',
+                  action='store',
+                  dest="prometheus",
+                  type="string",
+                  default=None,
+                  help='write session metrics to this Prometheus textfile (*.prom).'
+                  )
+
+        parser.add_option('--secure',
+                  action='store_true',
+                  dest="secure",
+                  default=False,
+                  help='use Secure DFU (nRF5 SDK 12 and later) instead of SDK 8 legacy DFU.'
+                  )
+
+        parser.add_option('-t', '--transport',
+                  action='store',
+                  dest="transport",
+                  type="choice",
+                  choices=sorted(transports.keys()),
+                  default='gatttool',
+                  help='link to the target: gatttool (default) or att (L2CAP socket).'
+                  )
+
         options, args = parser.parse_args()
 
     except Exception, e:
@@ -488,8 +1091,10 @@ def main():
             exit(2)
 
         unpacker = None
+        ble_dfu  = None
         hexfile  = None
         datfile  = None
+        images   = None
 
         if options.zipfile != None:
 
@@ -499,7 +1104,7 @@ def main():
 
             unpacker = Unpacker()
 
-            hexfile, datfile = unpacker.unpack_zipfile(options.zipfile)
+            images = unpacker.unpack_package(options.zipfile)
 
         else:
             if (not options.hexfile) or (not options.datfile):
@@ -520,26 +1125,44 @@ def main():
 
         ''' Start of Device Firmware Update processing '''
 
-        ble_dfu = BleDfuServer(options.address.upper(), hexfile, datfile)
+        server_class = BleDfuServer
+        if options.secure:
+            # secure_dfu builds on this module, so it is only loaded here
+            from secure_dfu import SecureDfuServer as server_class
+
+        ble_dfu = server_class(options.address.upper(), hexfile, datfile, options.transport)
+        ble_dfu.pkt_receipt_window = max(1, options.window)
+        ble_dfu.adaptive_receipt   = options.adaptive
+        ble_dfu.resume             = options.resume
+        ble_dfu.att_mtu            = options.mtu
+        if options.no_conn_update:
+            ble_dfu.fast_conn_params    = None
+            ble_dfu.relaxed_conn_params = None
+        ble_dfu.add_listener(print_event)
+
+        if images != None:
+            # Check, connect and transmit each image of the package.
+            ble_dfu.dfu_send_package(images)
 
-        # Initialize inputs
-        ble_dfu.input_setup()
-
-        # Connect to peer device.
-        ble_dfu.scan_and_connect()
+        else:
+            # Initialize inputs
+            ble_dfu.input_setup()
 
-        # Transmit the hex image to peer device.
-        ble_dfu.dfu_send_image()
+            # Connect to peer device.
+            ble_dfu.scan_and_connect()
 
-        # Wait to receive the disconnect event from peripheral device.
-        time.sleep(1)
+            # Transmit the hex image to peer device.
+            ble_dfu.dfu_send_image()
 
         # Disconnect from peer device if not done already and clean up. 
         ble_dfu.disconnect()
 
+        ble_dfu.metrics.finish()
+
     except Exception, e:
         print e
-        pass
+        if ble_dfu != None:
+            ble_dfu.metrics.finish(str(e))
 
     except:
         pass
@@ -548,6 +1171,13 @@ def main():
     if unpacker != None:
         unpacker.delete()
 
+    if ble_dfu != None:
+        sessions = ble_dfu.image_metrics or [ble_dfu.metrics]
+        if options.metrics_json:
+            write_json(options.metrics_json, sessions)
+        if options.prometheus:
+            write_prometheus(options.prometheus, sessions)
+
     print "DFU Server done"
 
 #------------------------------------------------------------------------------
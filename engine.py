@@ -0,0 +1,417 @@
+#!/usr/bin/env python
+#------------------------------------------------------------------------------
+# Concurrent DFU engine: run many BleDfuServer sessions from one process.
+#
+# Every session runs the usual START/INIT/RECEIVE/VALIDATE/ACTIVATE sequence
+# on its own thread.  The engine bounds how many sessions are active at once,
+# enforces a per-session timeout and lets any session be cancelled.  Sessions
+# flashing the same file share one FirmwareImage and its packet plans.
+#------------------------------------------------------------------------------
+import sys
+import time
+import optparse
+import threading
+
+from dfu        import BleDfuServer
+from secure_dfu import SecureDfuServer
+from metrics    import SessionMetrics, write_json, write_prometheus
+from transport  import create_transport, transports
+from unpacker   import Unpacker
+
+# Session states
+class SessionStates:
+    PENDING    = "PENDING"
+    RUNNING    = "RUNNING"
+    DONE       = "DONE"
+    FAILED     = "FAILED"
+    CANCELLED  = "CANCELLED"
+
+#------------------------------------------------------------------------------
+# One device update.
+#------------------------------------------------------------------------------
+class DfuSession(object):
+
+    def __init__(self, address, hexfile, datfile, transport, timeout=None):
+
+        self.address   = address
+        self.hexfile   = hexfile
+        self.datfile   = datfile
+        self.transport = transport
+        self.timeout   = timeout
+
+        self.state     = SessionStates.PENDING
+        self.error     = None
+        self.started   = None
+        self.finished  = None
+        self.server    = None
+
+        # connection attempts, and the offset the last attempt resumed from
+        self.attempts     = 0
+        self.resumed_from = 0
+
+        # shared by every attempt's BleDfuServer
+        self.metrics = SessionMetrics(address)
+
+        self.cancel_event = threading.Event()
+        self.done_event   = threading.Event()
+
+    #--------------------------------------------------------------------------
+    # Stop the session; a running session is interrupted at its next wait.
+    #--------------------------------------------------------------------------
+    def cancel(self, reason="cancelled"):
+
+        if self.done_event.is_set():
+            return
+
+        if self.error is None:
+            self.error = reason
+        self.cancel_event.set()
+
+        # Tearing down the link unblocks a session waiting on the peer.
+        server = self.server
+        if server is not None:
+            try:
+                server.disconnect()
+            except Exception:
+                pass
+
+    #--------------------------------------------------------------------------
+    # Block until the session has finished.  Returns False on timeout.
+    #--------------------------------------------------------------------------
+    def wait(self, timeout=None):
+        self.done_event.wait(timeout)
+        return self.done_event.is_set()
+
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+    def __repr__(self):
+        return "<DfuSession {0} {1}{2}>".format(self.address, self.state,
+                                                ": " + self.error if self.error else "")
+
+#------------------------------------------------------------------------------
+# Run sessions on worker threads, at most 'concurrency' at a time.
+#
+#   transport  - transport name (see transport.transports) or a callable
+#                taking the target address and returning a Transport.
+#   timeout    - seconds a session may run before it is cancelled.
+#   retries    - reconnects after a failed attempt; each one resumes the
+#                transfer from the bootloader's confirmed byte count.
+#   listener   - callable or queue receiving every session's DfuEvents.
+#   server_class - BleDfuServer (SDK 8 legacy DFU) or SecureDfuServer.
+#------------------------------------------------------------------------------
+class DfuEngine(object):
+
+    def __init__(self, concurrency=4, transport='gatttool', timeout=300, retries=0, listener=None,
+                 server_class=BleDfuServer):
+
+        self.concurrency  = concurrency
+        self.transport    = transport
+        self.timeout      = timeout
+        self.retries      = retries
+        self.listener     = listener
+        self.server_class = server_class
+
+        self.slots    = threading.Semaphore(concurrency)
+        self.sessions = []
+        self.threads  = []
+
+    #--------------------------------------------------------------------------
+    # Queue one device update and return its DfuSession.
+    #--------------------------------------------------------------------------
+    def submit(self, address, hexfile, datfile, transport=None, timeout=None):
+
+        if transport is None:
+            transport = self.transport
+        if timeout is None:
+            timeout = self.timeout
+
+        session = DfuSession(address, hexfile, datfile, transport, timeout)
+
+        thread = threading.Thread(target=self._run, args=(session,),
+                                  name="dfu-{0}".format(address))
+        thread.daemon = True
+
+        self.sessions.append(session)
+        self.threads.append(thread)
+        thread.start()
+
+        return session
+
+    #--------------------------------------------------------------------------
+    # Wait for a free slot, staying responsive to cancellation.
+    #--------------------------------------------------------------------------
+    def _acquire_slot(self, session):
+        while not self.slots.acquire(False):
+            if session.cancel_event.wait(0.05):
+                return False
+        return True
+
+    #--------------------------------------------------------------------------
+    # Session thread body.
+    #--------------------------------------------------------------------------
+    def _run(self, session):
+
+        if not self._acquire_slot(session):
+            session.state = SessionStates.CANCELLED
+            session.metrics.finish(session.error)
+            session.done_event.set()
+            return
+
+        timer = None
+
+        try:
+            session.state   = SessionStates.RUNNING
+            session.started = time.time()
+
+            if session.timeout:
+                timer = threading.Timer(session.timeout, session.cancel, ("timeout",))
+                timer.daemon = True
+                timer.start()
+
+            while True:
+                try:
+                    self._attempt(session)
+                    break
+                except Exception:
+                    if session.cancel_event.is_set() or session.attempts > self.retries:
+                        raise
+                    print "{0}: attempt {1} failed, reconnecting".format(session.address,
+                                                                         session.attempts)
+                    session.server.disconnect()
+
+            session.state = SessionStates.DONE
+
+        except Exception, e:
+            if session.cancel_event.is_set():
+                session.state = SessionStates.CANCELLED
+            else:
+                session.state = SessionStates.FAILED
+                session.error = str(e)
+
+        finally:
+            if timer is not None:
+                timer.cancel()
+            session.metrics.finish(session.error if session.state != SessionStates.DONE else None)
+            session.finished = time.time()
+            self.slots.release()
+            session.done_event.set()
+
+    #--------------------------------------------------------------------------
+    # One connection to the target.  Retries resume where the last one
+    # stopped.
+    #--------------------------------------------------------------------------
+    def _attempt(self, session):
+
+        transport = session.transport
+        if isinstance(transport, basestring):
+            transport = create_transport(transport, session.address)
+        elif callable(transport):
+            transport = transport(session.address)
+
+        session.attempts += 1
+
+        server = self.server_class(session.address, session.hexfile, session.datfile, transport)
+        server.cancel_event = session.cancel_event
+        server.resume = session.attempts > 1
+        server.metrics = session.metrics
+        if self.listener is not None:
+            server.add_listener(self.listener)
+        session.server = server
+
+        server.input_setup()
+        server._dfu_check_cancel()
+
+        server.scan_and_connect()
+        server._dfu_check_cancel()
+
+        server.dfu_send_image()
+        session.resumed_from = server.resumed_from
+
+        server.disconnect()
+
+    #--------------------------------------------------------------------------
+    # Wait for every submitted session.  Returns the sessions.
+    #--------------------------------------------------------------------------
+    def wait_all(self):
+        for session in self.sessions:
+            # short waits keep the main thread responsive to Ctrl-C
+            while not session.wait(0.5):
+                pass
+        return self.sessions
+
+    def cancel_all(self, reason="cancelled"):
+        for session in self.sessions:
+            session.cancel(reason)
+
+    #--------------------------------------------------------------------------
+    # Forget finished sessions, so a long-lived engine does not keep every
+    # session it ever ran.  Returns the sessions dropped.
+    #--------------------------------------------------------------------------
+    def prune(self):
+
+        finished = [session for session in self.sessions if session.done_event.is_set()]
+
+        self.sessions = [session for session in self.sessions if not session.done_event.is_set()]
+        self.threads  = [thread for thread in self.threads if thread.is_alive()]
+
+        return finished
+
+#------------------------------------------------------------------------------
+#
+#------------------------------------------------------------------------------
+def main():
+
+    print "DFU Engine start"
+
+    parser = optparse.OptionParser(usage='%prog -z <zip_file> -a <address> [-a <address> ...]\n\nExample:\n\tengine.py -z application.zip -a cd:e3:4a:47:1c:e4 -a ef:ff:d2:92:9c:2a -j 2',
+                                   version='0.5')
+
+    parser.add_option('-a', '--address',
+              action='append',
+              dest="addresses",
+              default=[],
+              help='DFU target address (repeat for each device).'
+              )
+
+    parser.add_option('-f', '--file',
+              action='store',
+              dest="hexfile",
+              type="string",
+              default=None,
+              help='hex file to be uploaded.'
+              )
+
+    parser.add_option('-d', '--dat',
+              action='store',
+              dest="datfile",
+              type="string",
+              default=None,
+              help='dat file to be uploaded.'
+              )
+
+    parser.add_option('-z', '--zip',
+              action='store',
+              dest="zipfile",
+              type="string",
+              default=None,
+              help='zip file to be used.'
+              )
+
+    parser.add_option('-j', '--jobs',
+              action='store',
+              dest="jobs",
+              type="int",
+              default=4,
+              help='sessions allowed to run at the same time.'
+              )
+
+    parser.add_option('--timeout',
+              action='store',
+              dest="timeout",
+              type="int",
+              default=300,
+              help='seconds before a session is abandoned.'
+              )
+
+    parser.add_option('--retries',
+              action='store',
+              dest="retries",
+              type="int",
+              default=0,
+              help='reconnect and resume this many times after a failure.'
+              )
+
+    parser.add_option('--metrics-json',
+              action='store',
+              dest="metrics_json",
+              type="string",
+              default=None,
+              help='write per-phase timings of every session to this JSON file.'
+              )
+
+    parser.add_option('--prometheus',
+              action='store',
+              dest="prometheus",
+              type="string",
+              default=None,
+              help='write session metrics to this Prometheus textfile (*.prom).'
+              )
+
+    parser.add_option('--secure',
+              action='store_true',
+              dest="secure",
+              default=False,
+              help='use Secure DFU (nRF5 SDK 12 and later) instead of SDK 8 legacy DFU.'
+              )
+
+    parser.add_option('-t', '--transport',
+              action='store',
+              dest="transport",
+              type="choice",
+              choices=sorted(transports.keys()),
+              default='gatttool',
+              help='link to the targets: gatttool (default) or att (L2CAP socket).'
+              )
+
+    options, args = parser.parse_args()
+
+    if not options.addresses:
+        parser.print_help()
+        sys.exit(2)
+
+    unpacker = None
+
+    if options.zipfile != None:
+        unpacker = Unpacker()
+        hexfile, datfile = unpacker.unpack_zipfile(options.zipfile)
+    elif options.hexfile and options.datfile:
+        hexfile, datfile = options.hexfile, options.datfile
+    else:
+        parser.print_help()
+        sys.exit(2)
+
+    server_class = BleDfuServer
+    if options.secure:
+        server_class = SecureDfuServer
+
+    engine = DfuEngine(options.jobs, options.transport, options.timeout, options.retries,
+                       server_class=server_class)
+
+    try:
+        for address in options.addresses:
+            engine.submit(address.upper(), hexfile, datfile)
+        engine.wait_all()
+
+    except KeyboardInterrupt:
+        engine.cancel_all("interrupted")
+        engine.wait_all()
+
+    finally:
+        if unpacker != None:
+            unpacker.delete()
+
+    for session in engine.sessions:
+        print "{0}: {1} {2:.1f}s attempts {3} {4}".format(session.address, session.state,
+                                                          session.elapsed(), session.attempts,
+                                                          session.error or "")
+
+    metrics = [session.metrics for session in engine.sessions]
+    if options.metrics_json:
+        write_json(options.metrics_json, metrics)
+    if options.prometheus:
+        write_prometheus(options.prometheus, metrics)
+
+    print "DFU Engine done"
+
+#------------------------------------------------------------------------------
+#
+#------------------------------------------------------------------------------
+if __name__ == '__main__':
+
+    # Do not litter the world with broken .pyc files.
+    sys.dont_write_bytecode = True
+
+    main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+#------------------------------------------------------------------------------
+# Progress events of a DFU session.
+#
+# BleDfuServer hands DfuEvents to its listeners: callables, or queues (any
+# object with put()), so a GUI or another process can consume them on its
+# own thread.  Progress events are sent at receipt points, at most once
+# every progress_period seconds, never per packet.
+#------------------------------------------------------------------------------
+import time
+
+from collections import namedtuple
+
+# Event kinds
+class EventKinds:
+    PHASE     = "phase"       # a new phase started (event.phase)
+    PROGRESS  = "progress"    # bytes confirmed by the target
+    DONE      = "done"        # image activated
+    ERROR     = "error"       # session failed (event.error)
+
+#------------------------------------------------------------------------------
+#   kind        - one of EventKinds
+#   address     - target address
+#   image       - package image being sent (see BleDfuServer.dfu_send_package),
+#                 or None
+#   phase       - current phase name (see metrics.SessionMetrics)
+#   confirmed   - image bytes confirmed by the target
+#   total       - image size
+#   throughput  - bytes/s since the transfer started
+#   eta         - seconds left in the transfer, or None
+#   error       - error text for ERROR events
+#   time        - time.time() when the event was raised
+#------------------------------------------------------------------------------
+DfuEvent = namedtuple('DfuEvent', 'kind address phase confirmed total throughput eta error time image')
+
+#------------------------------------------------------------------------------
+# Listener list with the delivery rules above.
+#------------------------------------------------------------------------------
+class EventSource(object):
+
+    progress_period = 0.25
+
+    def __init__(self, address):
+        self.address   = address
+        self.image     = None
+        self.listeners = []
+        self.phase     = None
+        self.last_progress = 0.0
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self.listeners.remove(listener)
+
+    def emit(self, kind, confirmed=0, total=0, throughput=0.0, eta=None, error=None):
+
+        event = DfuEvent(kind, self.address, self.phase, confirmed, total,
+                         throughput, eta, error, time.time(), self.image)
+
+        for listener in self.listeners:
+            if hasattr(listener, 'put'):
+                listener.put(event)
+            else:
+                listener(event)
+
+    def emit_phase(self, phase):
+        self.phase = phase
+        if self.listeners:
+            self.emit(EventKinds.PHASE)
+
+    #--------------------------------------------------------------------------
+    # Progress through the transfer; throttled unless 'force' is set.
+    #--------------------------------------------------------------------------
+    def emit_progress(self, confirmed, total, throughput, force=False):
+
+        if not self.listeners:
+            return
+
+        now = time.time()
+        if not force and now - self.last_progress < self.progress_period:
+            return
+        self.last_progress = now
+
+        eta = None
+        if throughput > 0:
+            eta = (total - confirmed) / throughput
+
+        self.emit(EventKinds.PROGRESS, confirmed, total, throughput, eta)
+
+#------------------------------------------------------------------------------
+# Listener printing events to the console, as dfu.py does.
+#------------------------------------------------------------------------------
+def print_event(event):
+
+    source = event.address
+    if event.image is not None:
+        source = "{0} {1}".format(event.address, event.image)
+
+    if event.kind == EventKinds.PHASE:
+        print "{0} phase: {1}".format(source, event.phase)
+
+    elif event.kind == EventKinds.PROGRESS:
+        eta = "--" if event.eta is None else "{0:.1f}s".format(event.eta)
+        print "{0} progress: {1:8} / {2} bytes, {3:.0f} bytes/s, eta {4}".format(
+              source, event.confirmed, event.total, event.throughput, eta)
+
+    elif event.kind == EventKinds.ERROR:
+        print "{0} error: {1}".format(source, event.error)
+
+    elif event.kind == EventKinds.DONE:
+        print "{0} done".format(source)
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+#------------------------------------------------------------------------------
+# Firmware image handling for the DFU server.
+#
+# A FirmwareImage holds the flattened image bytes once and hands out packet
+# plans: the image cut into pkt_payload_size memoryview segments (kept within
+# Secure DFU objects if an object size is given), each one already encoded
+# for the wire by the transport that will send it.  Plans are cached on the
+# image, so flashing the same image to many devices encodes it only once.
+#
+# Parsing a hex file is slow, so the flattened image is also kept in an
+# on-disk cache keyed by the content hash of the hex file: one file per
+# image, the raw image followed by its SHA-1, least recently used entries
+# evicted once the cache outgrows image_cache_size bytes.
+#------------------------------------------------------------------------------
+import os
+import zlib
+import hashlib
+import tempfile
+import threading
+
+from cStringIO import StringIO
+
+from crc16    import crc16_compute
+from intelhex import IntelHex
+
+#------------------------------------------------------------------------------
+# Image segmented and pre-encoded for one transport, handle and payload size.
+#------------------------------------------------------------------------------
+class PacketPlan(object):
+
+    def __init__(self, image, transport, handle, payload_size, object_size=None):
+
+        view = memoryview(image.data)
+
+        self.payload_size = payload_size
+        self.object_size  = object_size
+        self.size         = image.size
+
+        # Secure DFU sends the image as objects; no packet may cross from
+        # one object into the next.
+        step = object_size or max(image.size, 1)
+
+        # zero-copy views into the image, one per packet
+        self.segments = [view[i:min(i + payload_size, start + step)]
+                         for start in xrange(0, image.size, step)
+                         for i in xrange(start, min(start + step, image.size), payload_size)]
+
+        # what the transport actually puts on the wire for each packet
+        encode = transport.encode_cmd
+        self.wire = [encode(handle, segment) for segment in self.segments]
+
+    def __len__(self):
+        return len(self.segments)
+
+    #--------------------------------------------------------------------------
+    # Image offset just after packet number 'count' (1-based) has been sent
+    # (plans without objects).
+    #--------------------------------------------------------------------------
+    def offset_after(self, count):
+        return min(count * self.payload_size, self.size)
+
+#------------------------------------------------------------------------------
+# Flattened firmware image.
+#------------------------------------------------------------------------------
+class FirmwareImage(object):
+
+    def __init__(self, data):
+        self.data  = bytearray(data)
+        self.size  = len(self.data)
+        self.plans = {}
+        self.lock  = threading.Lock()
+        self.hash  = None
+        self.crc   = None
+
+    #--------------------------------------------------------------------------
+    # Content hash identifying the image (e.g. in transfer checkpoints).
+    #--------------------------------------------------------------------------
+    def digest(self):
+        if self.hash is None:
+            self.hash = hashlib.sha1(self.data).hexdigest()
+        return self.hash
+
+    #--------------------------------------------------------------------------
+    # CRC16 of the whole image, as the legacy init packet carries it.
+    #--------------------------------------------------------------------------
+    def crc16(self):
+        if self.crc is None:
+            self.crc = crc16_compute(self.data)
+        return self.crc
+
+    #--------------------------------------------------------------------------
+    # CRC32 of the image bytes [start, end), continuing from 'crc', as the
+    # Secure DFU bootloader reports it.
+    #--------------------------------------------------------------------------
+    def crc32(self, start=0, end=None, crc=0):
+        if end is None:
+            end = self.size
+        return zlib.crc32(buffer(self.data, start, end - start), crc) & 0xffffffff
+
+    #--------------------------------------------------------------------------
+    # Read a .hex or .bin file.
+    #--------------------------------------------------------------------------
+    @classmethod
+    def from_file(cls, path):
+
+        name, extent = os.path.splitext(path)
+
+        if extent not in (".bin", ".hex"):
+            raise Exception("input invalid")
+
+        return cls.from_bytes(open(path, 'rb').read(), extent)
+
+    #--------------------------------------------------------------------------
+    # Image from the contents of a .hex or .bin file ('extent' tells which),
+    # e.g. a member read straight out of a zip package.
+    #--------------------------------------------------------------------------
+    @classmethod
+    def from_bytes(cls, source, extent):
+
+        if extent == ".bin":
+            return cls(source)
+
+        if extent == ".hex":
+            key = hashlib.sha1(source).hexdigest()
+
+            data = _cached_image(key)
+            if data is None:
+                data = IntelHex(StringIO(source)).tobinstr()
+                _cache_image(key, data)
+
+            return cls(data)
+
+        raise Exception("input invalid")
+
+    #--------------------------------------------------------------------------
+    # Return the packet plan for this transport, building it on first use.
+    #--------------------------------------------------------------------------
+    def packet_plan(self, transport, handle, payload_size, object_size=None):
+
+        key = (transport.name, handle, payload_size, object_size)
+
+        with self.lock:
+            plan = self.plans.get(key)
+            if plan is None:
+                plan = PacketPlan(self, transport, handle, payload_size, object_size)
+                self.plans[key] = plan
+
+        return plan
+
+#------------------------------------------------------------------------------
+# On-disk cache of flattened hex images.  A size of 0 disables it.
+#------------------------------------------------------------------------------
+image_cache_dir  = os.path.join(tempfile.gettempdir(), "dfu_images")
+image_cache_size = 64 * 1024 * 1024
+
+# every entry ends with the SHA-1 of the image before it
+DIGEST_SIZE = hashlib.sha1().digest_size
+
+def _image_path(key):
+    return os.path.join(image_cache_dir, key + ".bin")
+
+#------------------------------------------------------------------------------
+# Image bytes cached under 'key', or None.  An entry whose SHA-1 does not
+# match (e.g. a torn or truncated file) is a miss.  A hit marks the entry
+# as recently used.
+#------------------------------------------------------------------------------
+def _cached_image(key):
+
+    if not image_cache_size:
+        return None
+
+    path = _image_path(key)
+
+    try:
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < DIGEST_SIZE:
+                return None
+            data = bytearray(size)
+            if f.readinto(data) != size:
+                return None
+        os.utime(path, None)
+    except (IOError, OSError):
+        return None
+
+    digest = str(data[-DIGEST_SIZE:])
+    del data[-DIGEST_SIZE:]
+    if hashlib.sha1(data).digest() != digest:
+        return None
+
+    return data
+
+#------------------------------------------------------------------------------
+# Store image bytes under 'key', then evict least recently used entries
+# until the cache fits image_cache_size.  Failures only cost the cache.
+#------------------------------------------------------------------------------
+def _cache_image(key, data):
+
+    if not image_cache_size or len(data) > image_cache_size:
+        return
+
+    path = _image_path(key)
+
+    try:
+        if not os.path.isdir(image_cache_dir):
+            os.makedirs(image_cache_dir)
+
+        # write-then-rename to a name of its own, so that neither another
+        # thread or process caching the same image nor a reader sees a torn
+        # file
+        fd, tmp = tempfile.mkstemp(suffix=".tmp", prefix=key, dir=image_cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+                f.write(hashlib.sha1(data).digest())
+            os.rename(tmp, path)
+        except (IOError, OSError):
+            os.remove(tmp)
+            raise
+
+        entries = []
+        for name in os.listdir(image_cache_dir):
+            if name.endswith(".bin"):
+                entry = os.path.join(image_cache_dir, name)
+                st = os.stat(entry)
+                entries.append((st.st_mtime, st.st_size, entry))
+
+        total = sum(size for mtime, size, entry in entries)
+
+        for mtime, size, entry in sorted(entries):
+            if total <= image_cache_size:
+                break
+            if entry != path:
+                os.remove(entry)
+                total -= size
+
+    except (IOError, OSError):
+        pass
+
+#------------------------------------------------------------------------------
+# Images already loaded by this process, keyed by path, size and mtime, so
+# that sessions flashing the same file share one image and its plans.
+#------------------------------------------------------------------------------
+_images      = {}
+_images_lock = threading.Lock()
+
+def load_image(path):
+
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_size, st.st_mtime)
+
+    with _images_lock:
+        image = _images.get(key)
+        if image is None:
+            image = FirmwareImage.from_file(path)
+            _images[key] = image
+
+    return image
@@ -0,0 +1,380 @@
+#!/usr/bin/env python
+#------------------------------------------------------------------------------
+# Fleet orchestrator: keep every local Bluetooth controller busy.
+#
+# One worker process is started per controller (hci0, hci1, ...).  Workers
+# pull (address, package) jobs from a shared queue, run the update through a
+# DfuEngine bound to their controller and post the outcome back.  A package
+# is either a zip file or a (hexfile, datfile) pair.
+#------------------------------------------------------------------------------
+import os
+import sys
+import time
+import Queue
+import optparse
+import threading
+import multiprocessing
+
+from engine    import DfuEngine, SessionStates
+from events    import print_event
+from transport import create_transport, find_adapters, transports
+from unpacker  import Unpacker
+
+#------------------------------------------------------------------------------
+# Worker process body: one per adapter.
+#
+# Every job is announced on 'results' as RUNNING as soon as it is taken, so
+# the orchestrator knows which job a worker held if it dies.
+#
+#   transport  - transport name, or a callable(address, adapter) returning a
+#                Transport (e.g. a simulator standing in for the adapter).
+#   events     - queue for the sessions' DfuEvents, or None.
+#------------------------------------------------------------------------------
+def _worker(adapter, jobs, results, transport, timeout, events=None):
+
+    if callable(transport):
+        factory = lambda address: transport(address, adapter)
+    else:
+        factory = lambda address: create_transport(transport, address, adapter)
+
+    engine    = DfuEngine(1, factory, timeout, listener=events)
+    unpackers = {}
+
+    try:
+        while True:
+            job = jobs.get()
+            if job is None:
+                break
+
+            address, package = job
+            results.put((adapter, address, SessionStates.RUNNING, None, 0.0))
+
+            try:
+                if isinstance(package, basestring):
+                    if package not in unpackers:
+                        unpacker = Unpacker()
+                        unpackers[package] = (unpacker, unpacker.unpack_zipfile(package))
+                    hexfile, datfile = unpackers[package][1]
+                else:
+                    hexfile, datfile = package
+
+            except Exception, e:
+                results.put((adapter, address, SessionStates.FAILED, str(e), 0.0))
+                continue
+
+            session = engine.submit(address, hexfile, datfile)
+            session.wait()
+
+            results.put((adapter, address, session.state, session.error, session.elapsed()))
+
+            engine.prune()
+
+    except KeyboardInterrupt:
+        engine.cancel_all("interrupted")
+        engine.wait_all()
+
+    finally:
+        for unpacker, files in unpackers.values():
+            unpacker.delete()
+        results.put((adapter, None, None, None, None))
+
+#------------------------------------------------------------------------------
+# Orchestrate workers across adapters.
+#
+#   listener  - callable receiving the DfuEvents of every session, called
+#               on a thread of the orchestrator's process.
+#------------------------------------------------------------------------------
+class FleetOrchestrator(object):
+
+    def __init__(self, adapters=None, transport='gatttool', timeout=300, listener=None):
+
+        if adapters is None:
+            adapters = find_adapters()
+
+        if not adapters:
+            raise Exception("No bluetooth adapters found")
+
+        self.adapters  = adapters
+        self.transport = transport
+        self.timeout   = timeout
+
+        # finish() checks on the workers this often, and gives up on one
+        # that has taken no job for stall_timeout seconds after the queue
+        # was closed (e.g. stuck on a queue lock left by a killed worker).
+        self.poll_period   = 1.0
+        self.stall_timeout = 30.0
+
+        self.jobs      = multiprocessing.Queue()
+        self.results   = multiprocessing.Queue()
+        self.workers   = []
+        self.outcomes  = []
+
+        self.listener  = listener
+        self.events    = None
+        self.relay     = None
+        if listener is not None:
+            self.events = multiprocessing.Queue()
+
+        self.submitted = 0
+        self.queued    = []                 # addresses not yet taken by a worker
+        self.started   = None
+        self.finished  = None
+
+    #--------------------------------------------------------------------------
+    # Start one worker process per adapter.
+    #--------------------------------------------------------------------------
+    def start(self):
+
+        self.started = time.time()
+
+        if self.events is not None:
+            self.relay = threading.Thread(target=self._relay_events, name="dfu-events")
+            self.relay.daemon = True
+            self.relay.start()
+
+        for adapter in self.adapters:
+            worker = multiprocessing.Process(target=_worker,
+                                             name="dfu-{0}".format(adapter),
+                                             args=(adapter, self.jobs, self.results,
+                                                   self.transport, self.timeout, self.events))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    #--------------------------------------------------------------------------
+    # Hand the workers' events to the listener until finish() ends it.
+    #--------------------------------------------------------------------------
+    def _relay_events(self):
+        while True:
+            event = self.events.get()
+            if event is None:
+                break
+            self.listener(event)
+
+    #--------------------------------------------------------------------------
+    # Queue one device update.  Jobs may be added while the fleet runs.
+    #--------------------------------------------------------------------------
+    def submit(self, address, package):
+        self.jobs.put((address, package))
+        self.queued.append(address)
+        self.submitted += 1
+
+    #--------------------------------------------------------------------------
+    # Let the workers drain the queue, collect every outcome and stop them.
+    # A worker which dies (or stalls) is recorded as a FAILED session for the
+    # job it held; jobs no worker is left to take fail too.
+    # Returns the list of (adapter, address, state, error, seconds).
+    #--------------------------------------------------------------------------
+    def finish(self):
+
+        for worker in self.workers:
+            self.jobs.put(None)
+
+        running = dict(zip(self.adapters, self.workers))
+        current = {}                        # adapter -> (address, started)
+        idle    = dict.fromkeys(running, time.time())
+        checked = time.time()
+
+        while running:
+            try:
+                self._collect(self.results.get(timeout=self.poll_period), running, current, idle)
+            except Queue.Empty:
+                pass
+
+            now = time.time()
+            if now - checked < self.poll_period:
+                continue
+            checked = now
+
+            for adapter, worker in running.items():
+                if worker.is_alive():
+                    if adapter in current or now - idle[adapter] < self.stall_timeout:
+                        continue
+                    worker.terminate()
+                    worker.join()
+                    reason = "worker stalled"
+                else:
+                    reason = "worker exited with code {0}".format(worker.exitcode)
+
+                # whatever it posted before it went is already in the queue
+                self._drain(running, current, idle)
+                if adapter not in running:
+                    continue
+                del running[adapter]
+
+                if adapter in current:
+                    address, started = current.pop(adapter)
+                    self._record((adapter, address, SessionStates.FAILED, reason, now - started))
+
+        # jobs left behind by dead workers
+        for address in self.queued:
+            self._record((None, address, SessionStates.FAILED, "no worker left", 0.0))
+        self.queued = []
+
+        for worker in self.workers:
+            worker.join()
+
+        if self.relay is not None:
+            self.events.put(None)
+            self.relay.join()
+
+        self.finished = time.time()
+
+        return self.outcomes
+
+    #--------------------------------------------------------------------------
+    # Handle one message from a worker.
+    #--------------------------------------------------------------------------
+    def _collect(self, outcome, running, current, idle):
+
+        adapter, address, state = outcome[:3]
+
+        if address is None:
+            running.pop(adapter, None)
+        elif state == SessionStates.RUNNING:
+            current[adapter] = (address, time.time())
+            if address in self.queued:
+                self.queued.remove(address)
+        else:
+            current.pop(adapter, None)
+            idle[adapter] = time.time()
+            self._record(outcome)
+
+    def _drain(self, running, current, idle):
+        while True:
+            try:
+                outcome = self.results.get_nowait()
+            except Queue.Empty:
+                break
+            self._collect(outcome, running, current, idle)
+
+    def _record(self, outcome):
+
+        self.outcomes.append(outcome)
+
+        adapter, address, state, error, elapsed = outcome
+        print "{0} {1}: {2} {3:.1f}s {4}".format(adapter, address, state, elapsed, error or "")
+
+    #--------------------------------------------------------------------------
+    # Aggregate rate of successful updates.
+    #--------------------------------------------------------------------------
+    def devices_per_hour(self):
+
+        if self.started is None:
+            return 0.0
+
+        elapsed = (self.finished or time.time()) - self.started
+        done = len([o for o in self.outcomes if o[2] == SessionStates.DONE])
+
+        return done * 3600.0 / max(elapsed, 1e-6)
+
+    def summary(self):
+
+        done   = len([o for o in self.outcomes if o[2] == SessionStates.DONE])
+        failed = len(self.outcomes) - done
+
+        return "{0} adapters, {1} done, {2} failed, {3:.0f} devices/hour".format(
+               len(self.adapters), done, failed, self.devices_per_hour())
+
+#------------------------------------------------------------------------------
+#
+#------------------------------------------------------------------------------
+def main():
+
+    print "DFU Fleet start"
+
+    parser = optparse.OptionParser(usage='%prog -z <zip_file> [-a <address> ...] [-l <address_file>]\n\nExample:\n\tfleet.py -z application.zip -l addresses.txt',
+                                   version='0.5')
+
+    parser.add_option('-a', '--address',
+              action='append',
+              dest="addresses",
+              default=[],
+              help='DFU target address (repeat for each device).'
+              )
+
+    parser.add_option('-l', '--list',
+              action='store',
+              dest="listfile",
+              type="string",
+              default=None,
+              help='file with one DFU target address per line.'
+              )
+
+    parser.add_option('-z', '--zip',
+              action='store',
+              dest="zipfile",
+              type="string",
+              default=None,
+              help='zip file to be used.'
+              )
+
+    parser.add_option('-i', '--adapter',
+              action='append',
+              dest="adapters",
+              default=None,
+              help='controller to use, e.g. hci1 (default: all).'
+              )
+
+    parser.add_option('--timeout',
+              action='store',
+              dest="timeout",
+              type="int",
+              default=300,
+              help='seconds before a session is abandoned.'
+              )
+
+    parser.add_option('-t', '--transport',
+              action='store',
+              dest="transport",
+              type="choice",
+              choices=sorted(transports.keys()),
+              default='gatttool',
+              help='link to the targets: gatttool (default) or att (L2CAP socket).'
+              )
+
+    parser.add_option('--progress',
+              action='store_true',
+              dest="progress",
+              default=False,
+              help='print phase and progress events of every session.'
+              )
+
+    options, args = parser.parse_args()
+
+    addresses = list(options.addresses)
+    if options.listfile:
+        addresses += [line.strip() for line in open(options.listfile) if line.strip()]
+
+    if not addresses or not options.zipfile:
+        parser.print_help()
+        sys.exit(2)
+
+    if not os.path.isfile(options.zipfile):
+        print "Error: zip file doesn't exist"
+        sys.exit(2)
+
+    listener = None
+    if options.progress:
+        listener = print_event
+
+    fleet = FleetOrchestrator(options.adapters, options.transport, options.timeout, listener)
+    fleet.start()
+
+    for address in addresses:
+        fleet.submit(address.upper(), os.path.abspath(options.zipfile))
+
+    fleet.finish()
+
+    print fleet.summary()
+    print "DFU Fleet done"
+
+#------------------------------------------------------------------------------
+#
+#------------------------------------------------------------------------------
+if __name__ == '__main__':
+
+    # Do not litter the world with broken .pyc files.
+    sys.dont_write_bytecode = True
+
+    main()
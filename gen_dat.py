@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+#------------------------------------------------------------------------------
+# Generate a legacy DFU init packet (*.dat file) from a *.bin or *.hex file.
+#
+# Python counterpart of gen_dat.c: with the default fields the output is
+# byte-identical to it, but every dfu_init_t field can be set.  Packets are
+# cached on disk keyed by the image's content hash and the fields, and the
+# hash of each image file is remembered by path, size and mtime, so
+# regenerating packets for unchanged images reads neither the images nor
+# their CRC again.
+#
+#   USAGE:  gen_dat.py [options] <bin or hex file> <dat file>
+#------------------------------------------------------------------------------
+import os
+import sys
+import json
+import struct
+import hashlib
+import optparse
+import tempfile
+
+from crc16    import crc16_compute
+from firmware import FirmwareImage
+
+# dfu_init_t defaults, as in gen_dat.c
+DEVICE_TYPE  = 0xffff
+DEVICE_REV   = 0xffff
+APP_VERSION  = 0xffffffff
+SOFTDEVICES  = (0x005a, 0x0064)    # SoftDevice 7.1, SoftDevice 8.0
+
+cache_dir = os.path.join(tempfile.gettempdir(), "dfu_gen_dat")
+
+#------------------------------------------------------------------------------
+# Pack a dfu_init_t: device type, device revision, app version, softdevice
+# list (count, then ids) and the image CRC16.
+#------------------------------------------------------------------------------
+def pack_init_packet(crc,
+                     device_type=DEVICE_TYPE,
+                     device_rev=DEVICE_REV,
+                     app_version=APP_VERSION,
+                     softdevices=SOFTDEVICES):
+
+    softdevices = list(softdevices)
+
+    return struct.pack('<HHIH{0}HH'.format(len(softdevices)),
+                       device_type, device_rev, app_version, len(softdevices),
+                       *(softdevices + [crc]))
+
+#------------------------------------------------------------------------------
+# Init packet for the image bytes 'data'.
+#------------------------------------------------------------------------------
+def init_packet(data, **fields):
+    return pack_init_packet(crc16_compute(data), **fields)
+
+#------------------------------------------------------------------------------
+# Write 'data' to 'path' via a temporary file, so readers (or another build
+# writing the same cache entry) never see a torn file.
+#------------------------------------------------------------------------------
+def _write_file(path, data):
+
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    tmp = "{0}.{1}.tmp".format(path, os.getpid())
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.rename(tmp, path)
+
+def _cache_path(key, extent):
+    return os.path.join(cache_dir, hashlib.sha1(key).hexdigest() + extent)
+
+#------------------------------------------------------------------------------
+# Content hash of the image in 'path'.  The hash is remembered along with the
+# file's size and mtime; 'image' is only loaded when they have changed.
+# Returns (digest, image or None).
+#------------------------------------------------------------------------------
+def _image_digest(path):
+
+    st = os.stat(path)
+    stamp = [st.st_size, st.st_mtime]
+    index = _cache_path(os.path.abspath(path), ".json")
+
+    try:
+        with open(index) as f:
+            record = json.load(f)
+        if record.get("stamp") == stamp:
+            return record["digest"], None
+    except (IOError, ValueError):
+        pass
+
+    image = FirmwareImage.from_file(path)
+    _write_file(index, json.dumps({"path": os.path.abspath(path), "stamp": stamp, "digest": image.digest()}))
+
+    return image.digest(), image
+
+#------------------------------------------------------------------------------
+# Generate the init packet for the image in 'image_path', write it to
+# 'dat_path' (if given) and return it.  'fields' are the dfu_init_t fields
+# of pack_init_packet().
+#------------------------------------------------------------------------------
+def gen_dat(image_path, dat_path=None, cache=True, **fields):
+
+    if cache:
+        digest, image = _image_digest(image_path)
+
+        params = [fields.get("device_type", DEVICE_TYPE),
+                  fields.get("device_rev",  DEVICE_REV),
+                  fields.get("app_version", APP_VERSION),
+                  list(fields.get("softdevices", SOFTDEVICES))]
+        cached = _cache_path(json.dumps([digest, params]), ".dat")
+
+        try:
+            packet = open(cached, 'rb').read()
+        except IOError:
+            if image is None:
+                image = FirmwareImage.from_file(image_path)
+            packet = pack_init_packet(image.crc16(), **fields)
+            _write_file(cached, packet)
+
+    else:
+        packet = pack_init_packet(FirmwareImage.from_file(image_path).crc16(), **fields)
+
+    if dat_path:
+        _write_file(dat_path, packet)
+
+    return packet
+
+#------------------------------------------------------------------------------
+#
+#------------------------------------------------------------------------------
+def main():
+
+    parser = optparse.OptionParser(usage='%prog [options] <bin or hex file> <dat file>\n\nExample:\n\tgen_dat.py --app-version 3 --softdevice 0x64 application.bin application.dat',
+                                   version='0.5')
+
+    parser.add_option('--device-type',
+              action='store',
+              dest="device_type",
+              type="string",
+              default=hex(DEVICE_TYPE),
+              help='device type (default %default).'
+              )
+
+    parser.add_option('--device-rev',
+              action='store',
+              dest="device_rev",
+              type="string",
+              default=hex(DEVICE_REV),
+              help='device revision (default %default).'
+              )
+
+    parser.add_option('--app-version',
+              action='store',
+              dest="app_version",
+              type="string",
+              default=hex(APP_VERSION),
+              help='application version (default %default).'
+              )
+
+    parser.add_option('--softdevice',
+              action='store',
+              dest="softdevices",
+              type="string",
+              default=",".join(hex(sd) for sd in SOFTDEVICES),
+              help='accepted SoftDevice ids (comma separated, default %default).'
+              )
+
+    parser.add_option('--no-cache',
+              action='store_false',
+              dest="cache",
+              default=True,
+              help='do not use or update the packet cache.'
+              )
+
+    options, args = parser.parse_args()
+
+    if len(args) != 2:
+        parser.print_help()
+        sys.exit(2)
+
+    try:
+        gen_dat(args[0], args[1], options.cache,
+                device_type=int(options.device_type, 0),
+                device_rev=int(options.device_rev, 0),
+                app_version=int(options.app_version.rstrip('L'), 0),
+                softdevices=[int(sd, 0) for sd in options.softdevices.split(',') if sd])
+
+    except Exception, e:
+        print e
+        sys.exit(1)
+
+#------------------------------------------------------------------------------
+#
+#------------------------------------------------------------------------------
+if __name__ == '__main__':
+
+    # Do not litter the world with broken .pyc files.
+    sys.dont_write_bytecode = True
+
+    main()
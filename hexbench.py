@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+#------------------------------------------------------------------------------
+# Intel HEX storage benchmark.
+#
+# Loads hex images with each IntelHex storage backend and decoder and reports
+# load time, tobinarray() time and memory, as a table and as JSON:
+#
+#   segments     - sorted contiguous segments, start address plus bytearray
+#                  (the default)
+#   dict         - the former per-byte dict
+#
+#   bulk         - the whole file decoded at once (the default)
+#   records      - one record at a time, as before the bulk decoder
+#
+# dict with records is the former parser; every load time is also given as
+# a speedup over it.
+#
+# Every run happens in a fresh interpreter, so the memory figure (growth of
+# the resident set size over loading, with the image kept) is not skewed by
+# earlier runs.
+#
+#   USAGE:  hexbench.py [options] [hex file ...]
+#------------------------------------------------------------------------------
+import gc
+import os
+import sys
+import json
+import random
+import shutil
+import optparse
+import resource
+import tempfile
+import subprocess
+
+from cStringIO import StringIO
+from intelhex  import IntelHex, _SegmentBuffer, _DictBuffer
+from metrics   import monotonic
+
+backends = {
+    "segments" : _SegmentBuffer,
+    "dict"     : _DictBuffer,
+}
+
+decoders = {
+    "bulk"     : IntelHex._decode_bulk,
+    "records"  : lambda self, text: False,
+}
+
+baseline = ("dict", "records")
+
+#------------------------------------------------------------------------------
+# Write a random hex image of 'size' bytes, split into 'segments' equal parts
+# with 4 KB gaps between them, into 'directory'.  Returns its path.
+#------------------------------------------------------------------------------
+def make_hex(directory, size, segments=1, seed=0):
+
+    rand = random.Random(seed)
+    ih = IntelHex()
+
+    part = size // segments
+    address = 0x18000
+    for i in xrange(segments):
+        ih.frombytes(bytearray(rand.getrandbits(8) for j in xrange(part)), offset=address)
+        address += part + 0x1000
+
+    path = os.path.join(directory, "image_{0}_{1}.hex".format(size, segments))
+    with open(path, "w") as f:
+        ih.write_hex_file(f)
+
+    return path
+
+#------------------------------------------------------------------------------
+# Resident set size of this process, in KB.  Where there is no /proc, the
+# peak size is the best there is.
+#------------------------------------------------------------------------------
+def rss():
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * resource.getpagesize() // 1024
+    except (IOError, IndexError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == "darwin":
+            peak //= 1024
+        return peak
+
+#------------------------------------------------------------------------------
+# One measurement, run in the child interpreter: load 'path' with 'backend'
+# and 'decoder'.
+#------------------------------------------------------------------------------
+def measure(path, backend, decoder):
+
+    IntelHex._buffer_class = backends[backend]
+    IntelHex._decode_bulk  = decoders[decoder]
+
+    with open(path) as f:
+        text = StringIO(f.read())
+
+    gc.collect()
+    rss_before = rss()
+
+    start = monotonic()
+    ih = IntelHex(text)
+    load_seconds = monotonic() - start
+
+    gc.collect()
+    rss_kb = rss() - rss_before
+
+    start = monotonic()
+    data = ih.tobinarray()
+    bin_seconds = monotonic() - start
+
+    return {
+        "file"        : os.path.basename(path),
+        "backend"     : backend,
+        "decoder"     : decoder,
+        "bytes"       : len(ih),
+        "segments"    : len(ih._buf.segments()),
+        "load_s"      : load_seconds,
+        "tobinarray_s": bin_seconds,
+        "rss_kb"      : rss_kb,
+    }
+
+#------------------------------------------------------------------------------
+# Run measure() in a fresh interpreter.
+#------------------------------------------------------------------------------
+def run_case(path, backend, decoder):
+
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+                                      "--child", backend, "--decoder", decoder, path])
+    return json.loads(output)
+
+#------------------------------------------------------------------------------
+# Table output.
+#------------------------------------------------------------------------------
+header = "{0:<24} {1:<9} {2:<8} {3:>8} {4:>5} {5:>8} {6:>8} {7:>8} {8:>8}".format(
+         "file", "backend", "decoder", "bytes", "segs", "load_s", "speedup", "tobin_s", "rss_kb")
+
+def format_row(r):
+    speedup = "--" if r["speedup"] is None else "{0:.1f}x".format(r["speedup"])
+    return "{0:<24} {1:<9} {2:<8} {3:>8} {4:>5} {5:>8.3f} {6:>8} {7:>8.3f} {8:>8}".format(
+           r["file"], r["backend"], r["decoder"], r["bytes"], r["segments"],
+           r["load_s"], speedup, r["tobinarray_s"], r["rss_kb"])
+
+#------------------------------------------------------------------------------
+#
+#------------------------------------------------------------------------------
+def main():
+
+    parser = optparse.OptionParser(usage='%prog [options] [hex file ...]\n\nExample:\n\thexbench.py --size 65536,262144 --segments 1,8 --json hex.json',
+                                   version='0.5')
+
+    parser.add_option('--size',
+              action='store',
+              dest="size",
+              type="string",
+              default="262144",
+              help='generated image sizes in bytes (comma separated, default %default).'
+              )
+
+    parser.add_option('--segments',
+              action='store',
+              dest="segments",
+              type="string",
+              default="1",
+              help='segments per generated image (comma separated, default %default).'
+              )
+
+    parser.add_option('--backend',
+              action='store',
+              dest="backend",
+              type="string",
+              default=",".join(sorted(backends)),
+              help='storage backends (comma separated, default %default).'
+              )
+
+    parser.add_option('--decoder',
+              action='store',
+              dest="decoder",
+              type="string",
+              default=",".join(sorted(decoders)),
+              help='decoders (comma separated, default %default).'
+              )
+
+    parser.add_option('--repeat',
+              action='store',
+              dest="repeat",
+              type="int",
+              default=5,
+              help='runs per case; the fastest load is kept (default %default).'
+              )
+
+    parser.add_option('--json',
+              action='store',
+              dest="json",
+              type="string",
+              default=None,
+              help='write the results to this JSON file.'
+              )
+
+    parser.add_option('--child',
+              action='store',
+              dest="child",
+              type="string",
+              default=None,
+              help=optparse.SUPPRESS_HELP
+              )
+
+    options, args = parser.parse_args()
+
+    if options.child:
+        print json.dumps(measure(args[0], options.child, options.decoder))
+        return
+
+    selected = [name for name in options.backend.split(',') if name]
+    for name in selected:
+        if name not in backends:
+            parser.error("unknown backend: {0}".format(name))
+
+    selected_decoders = [name for name in options.decoder.split(',') if name]
+    for name in selected_decoders:
+        if name not in decoders:
+            parser.error("unknown decoder: {0}".format(name))
+
+    # the baseline goes first, so every other case can be compared with it
+    cases = [(backend, decoder) for backend in selected for decoder in selected_decoders]
+    if baseline in cases:
+        cases.remove(baseline)
+        cases.insert(0, baseline)
+
+    directory = tempfile.mkdtemp(prefix="dfu_hexbench_")
+    results = []
+
+    try:
+        paths = list(args)
+        if not paths:
+            for size in [int(value) for value in options.size.split(',') if value]:
+                for segments in [int(value) for value in options.segments.split(',') if value]:
+                    paths.append(make_hex(directory, size, segments))
+
+        print header
+        for path in paths:
+            base = None
+            for backend, decoder in cases:
+                runs = [run_case(path, backend, decoder) for i in xrange(max(1, options.repeat))]
+                result = min(runs, key=lambda r: r["load_s"])
+
+                if (backend, decoder) == baseline:
+                    base = result["load_s"]
+                result["speedup"] = None
+                if base:
+                    result["speedup"] = base / max(result["load_s"], 1e-9)
+
+                results.append(result)
+                print format_row(result)
+                sys.stdout.flush()
+
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if options.json:
+        with open(options.json, "w") as f:
+            json.dump({"results": results}, f, indent=2, sort_keys=True)
+
+#------------------------------------------------------------------------------
+#
+#------------------------------------------------------------------------------
+if __name__ == '__main__':
+
+    # Do not litter the world with broken .pyc files.
+    sys.dont_write_bytecode = True
+
+    main()
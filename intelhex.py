@@ -44,6 +44,7 @@ __docformat__ = "javadoc"
 
 
 from array import array
+import audioop
 from binascii import hexlify, unhexlify
 from bisect import bisect_right
 import os
@@ -58,9 +59,328 @@ class _DeprecatedParam(object):
 _DEPRECATED = _DeprecatedParam()
 
 
+class _SegmentBuffer(object):
+    ''' Sparse byte storage of IntelHex: sorted, non-overlapping and
+    non-adjacent segments, each a start address and a bytearray.
+    Has the mapping interface (address -> byte) of the per-byte dict it
+    replaces, plus operations on whole runs of bytes.
+    '''
+
+    def __init__(self):
+        self._starts = []   # segment start addresses, ascending
+        self._blocks = []   # segment data, bytearray per segment
+        self._hint = 0      # segment of the last lookup
+
+    def _index(self, addr):
+        '''Index of the segment holding addr, or -1.'''
+        starts = self._starts
+        i = self._hint
+        if i < len(starts) and 0 <= addr - starts[i] < len(self._blocks[i]):
+            return i
+        i = bisect_right(starts, addr) - 1
+        if i >= 0 and addr - starts[i] < len(self._blocks[i]):
+            self._hint = i
+            return i
+        return -1
+
+    def get(self, addr, default=None):
+        i = self._index(addr)
+        if i < 0:
+            return default
+        return self._blocks[i][addr - self._starts[i]]
+
+    def __getitem__(self, addr):
+        i = self._index(addr)
+        if i < 0:
+            raise KeyError(addr)
+        return self._blocks[i][addr - self._starts[i]]
+
+    def __contains__(self, addr):
+        return self._index(addr) >= 0
+
+    has_key = __contains__
+
+    def __setitem__(self, addr, byte):
+        i = self._index(addr)
+        if i >= 0:
+            self._blocks[i][addr - self._starts[i]] = byte
+        else:
+            self.write(addr, (byte,))
+
+    def __delitem__(self, addr):
+        i = self._index(addr)
+        if i < 0:
+            raise KeyError(addr)
+        start = self._starts[i]
+        block = self._blocks[i]
+        offset = addr - start
+        if len(block) == 1:
+            del self._starts[i]
+            del self._blocks[i]
+        elif offset == 0:
+            self._starts[i] = start + 1
+            del block[0]
+        elif offset == len(block) - 1:
+            del block[-1]
+        else:
+            self._starts.insert(i+1, addr+1)
+            self._blocks.insert(i+1, block[offset+1:])
+            del block[offset:]
+        self._hint = 0
+
+    def __len__(self):
+        return sum(len(block) for block in self._blocks)
+
+    def __nonzero__(self):
+        return len(self._starts) != 0
+
+    def __iter__(self):
+        for start, block in zip(self._starts, self._blocks):
+            for addr in xrange(start, start + len(block)):
+                yield addr
+
+    iterkeys = __iter__
+
+    def keys(self):
+        '''All addresses holding data, in ascending order.'''
+        return list(self)
+
+    def iteritems(self):
+        for start, block in zip(self._starts, self._blocks):
+            addr = start
+            for byte in block:
+                yield addr, byte
+                addr += 1
+
+    def items(self):
+        return list(self.iteritems())
+
+    def write(self, addr, data):
+        '''Store the bytes data from addr on, replacing what is there.'''
+        data = bytearray(data)
+        if not data:
+            return
+        end = addr + len(data)
+        starts = self._starts
+        blocks = self._blocks
+
+        # segments lo..hi-1 overlap or touch [addr, end)
+        lo = bisect_right(starts, addr) - 1
+        if lo < 0 or starts[lo] + len(blocks[lo]) < addr:
+            lo += 1
+        hi = bisect_right(starts, end)
+
+        if lo == hi:
+            starts.insert(lo, addr)
+            blocks.insert(lo, data)
+        elif hi - lo == 1 and starts[lo] <= addr:
+            # within or appending to one segment
+            offset = addr - starts[lo]
+            blocks[lo][offset:offset+len(data)] = data
+        else:
+            last = hi - 1
+            tail = None
+            if starts[last] + len(blocks[last]) > end:
+                tail = blocks[last][end - starts[last]:]
+            if starts[lo] <= addr:
+                start = starts[lo]
+                merged = blocks[lo]
+                del merged[addr - start:]
+                merged += data
+            else:
+                start = addr
+                merged = data
+            if tail is not None:
+                merged += tail
+            starts[lo:hi] = [start]
+            blocks[lo:hi] = [merged]
+        self._hint = lo
+
+    def overlaps(self, addr, length):
+        '''First address in [addr, addr+length) holding data, or None.'''
+        if length <= 0:
+            return None
+        starts = self._starts
+        i = bisect_right(starts, addr) - 1
+        if i >= 0 and starts[i] + len(self._blocks[i]) > addr:
+            return addr
+        i += 1
+        if i < len(starts) and starts[i] < addr + length:
+            return starts[i]
+        return None
+
+    def update(self, other):
+        '''Store every address -> byte of a mapping, runs at a time.'''
+        if isinstance(other, _SegmentBuffer):
+            for start, block in other.segments():
+                self.write(start, block)
+            return
+        run_start = None
+        run = bytearray()
+        for addr in sorted(other.keys()):
+            if run_start is not None and addr != run_start + len(run):
+                self.write(run_start, run)
+                run_start = None
+            if run_start is None:
+                run_start = addr
+                run = bytearray()
+            run.append(other[addr])
+        if run_start is not None:
+            self.write(run_start, run)
+
+    def copy(self):
+        other = _SegmentBuffer()
+        other._starts = list(self._starts)
+        other._blocks = [bytearray(block) for block in self._blocks]
+        return other
+
+    def segments(self):
+        '''(start address, bytearray) of every segment, in ascending order.
+        The bytearrays are the storage itself.'''
+        return zip(self._starts, self._blocks)
+
+    def minaddr(self):
+        if not self._starts:
+            return None
+        return self._starts[0]
+
+    def maxaddr(self):
+        if not self._starts:
+            return None
+        return self._starts[-1] + len(self._blocks[-1]) - 1
+
+
+class _DictBuffer(dict):
+    ''' The former storage of IntelHex, one dict entry per byte, with the
+    run operations of _SegmentBuffer.  Kept as the reference the segment
+    storage is measured against (see hexbench.py).
+    '''
+
+    def write(self, addr, data):
+        for byte in bytearray(data):
+            self[addr] = byte
+            addr += 1
+
+    def overlaps(self, addr, length):
+        for i in xrange(addr, addr+length):
+            if i in self:
+                return i
+        return None
+
+    def copy(self):
+        return _DictBuffer(self)
+
+    def segments(self):
+        result = []
+        for addr in sorted(self.keys()):
+            if result and addr == result[-1][0] + len(result[-1][1]):
+                result[-1][1].append(self[addr])
+            else:
+                result.append((addr, bytearray([self[addr]])))
+        return result
+
+    def minaddr(self):
+        if not self:
+            return None
+        return min(self)
+
+    def maxaddr(self):
+        if not self:
+            return None
+        return max(self)
+
+
+# high and low byte of every 16-bit record offset: slices of these give the
+# offsets of a group of data records that follow each other
+_OFFSET_HI = bytearray(''.join(chr(i) * 256 for i in xrange(256)))
+_OFFSET_LO = bytearray(xrange(256)) * 256
+
+
+def _run_length(hi, lo, k, count, length):
+    '''Number of data records from record k on (of count) whose offsets
+    step by the record length, so that they make up one block.  The run is
+    found by doubling its length and then halving the gap, comparing slices
+    of the offsets with slices of _OFFSET_HI and _OFFSET_LO, so finding a
+    run costs a few times its own length.
+    '''
+    first = hi[k]*256 + lo[k]
+    if k + 1 == count or hi[k+1]*256 + lo[k+1] != first + length:
+        return 1
+
+    def steps(n):
+        last = first + (n-1)*length
+        return (last <= 0xFFFF and
+                hi[k:k+n] == _OFFSET_HI[first:last+1:length] and
+                lo[k:k+n] == _OFFSET_LO[first:last+1:length])
+
+    if k == 0 and steps(count):
+        return count
+    good = 1                    # records known to step
+    bad = count - k             # records known not to
+    n = 2
+    while n < bad and steps(n):
+        good = n
+        n *= 2
+    bad = min(n, bad)
+    while bad - good > 1:
+        n = (good + bad) // 2
+        if steps(n):
+            good = n
+        else:
+            bad = n
+    return good
+
+
+def _group_length(blob, pos, size):
+    '''Number of records of size bytes each from blob[pos] on which have
+    the same record length byte as the first; 0 if the first runs past the
+    end of blob.  The length bytes are compared a slice at a time, the
+    slices doubling in length.
+    '''
+    limit = (len(blob) - pos) // size
+    mark = blob[pos:pos+1]
+    count = 0
+    width = 64
+    while count < limit:
+        width = min(width, limit - count)
+        column = blob[pos+count*size:pos+(count+width)*size:size]
+        rest = len(column.lstrip(mark))
+        count += width - rest
+        if rest:
+            break
+        width *= 2
+    return count
+
+
+def _checksums_ok(blob, start, end, size):
+    '''Check the checksums of the records of size bytes each in
+    blob[start:end] at once: every record must add up to 0 modulo 256.
+    Column j of the records is spread into 16-bit (or 32-bit) samples and
+    the columns are added up with audioop.add, so every record is added up
+    in its own sample.
+    '''
+    count = (end - start) // size
+    if size*255 <= 0x7FFF:
+        width = 2       # 16-bit samples cannot overflow
+    else:
+        width = 4
+    low = 0             # index of the low byte of a sample
+    if sys.byteorder == 'big':
+        low = width - 1
+    column = bytearray(width*count)
+    total = asbytes('\0') * (width*count)
+    for j in xrange(size):
+        column[low::width] = blob[start+j:end:size]
+        total = audioop.add(total, buffer(column), width)
+    return bytearray(total)[low::width] == bytearray(count)
+
+
 class IntelHex(object):
     ''' Intel HEX file reader. '''
 
+    # storage of the data bytes (address -> byte)
+    _buffer_class = _SegmentBuffer
+
     def __init__(self, source=None):
         ''' Constructor. If source specified, object will be initialized
         with the contents of source. Otherwise the object will be empty.
@@ -75,7 +395,7 @@ class IntelHex(object):
         self.start_addr = None
 
         # private members
-        self._buf = {}
+        self._buf = self._buffer_class()
         self._offset = 0
 
         if source is not None:
@@ -134,13 +454,13 @@ class IntelHex(object):
         if record_type == 0:
             # data record
             addr += self._offset
-            for i in xrange(4, 4+record_length):
-                if not self._buf.get(addr, None) is None:
-                    raise AddressOverlapError(address=addr, line=line)
-                self._buf[addr] = bin[i]
-                addr += 1   # FIXME: addr should be wrapped 
-                            # BUT after 02 record (at 64K boundary)
-                            # and after 04 record (at 4G boundary)
+            overlap = self._buf.overlaps(addr, record_length)
+            if overlap is not None:
+                raise AddressOverlapError(address=overlap, line=line)
+            self._buf.write(addr, bin[4:4+record_length])
+            # FIXME: addr should be wrapped
+            # BUT after 02 record (at 64K boundary)
+            # and after 04 record (at 4G boundary)
 
         elif record_type == 1:
             # end of file record
@@ -182,6 +502,172 @@ class IntelHex(object):
                                        bin[7]),
                               }
 
+    def _decode_bulk(self, text):
+        '''Decode a whole HEX file at once: the records are unhexlified
+        in one call and runs of consecutive data records are stored as one
+        block each.  Records are taken in groups of the same length, and the
+        ':' and line end of every record of a group are checked with one
+        slice each.  Nothing is stored unless the whole file is valid.
+
+        @param  text    content of HEX file.
+
+        @return True if the file was loaded, False if it has to be decoded
+                record by record by _decode_record (which reports what is
+                wrong with it, and where).
+        '''
+        if '\r' in text:
+            text = text.replace('\r\n', '\n')
+            if '\r' in text:
+                return False
+        text = text.rstrip('\n')
+        if not text:
+            return True
+        if text[0] == '\n' or '\n\n' in text:
+            # empty lines are skipped
+            text = '\n'.join([s for s in text.split('\n') if s])
+
+        # every line must be ':' followed by hex digits; where the ':' and
+        # line ends go is checked group by group below
+        try:
+            blob = bytearray(unhexlify(asbytes(text.translate(None, ':\n'))))
+        except (TypeError, ValueError):
+            return False
+
+        runs = []           # (start address, data) of contiguous data
+
+        def store(addr, data):
+            if runs and runs[-1][0] + len(runs[-1][1]) == addr:
+                runs[-1][1].extend(data)
+            else:
+                runs.append((addr, data))
+
+        offset = 0
+        start_addr = None
+        eof = False
+        pos = 0             # in blob
+        line = 0            # start of the group's first line in text
+
+        # records with the same length byte make a group; each group is
+        # checked with slices across all of its records
+        while pos < len(blob):
+            length = blob[pos]                  # data bytes per record
+            size = length + 5                   # bytes per record
+            count = _group_length(blob, pos, size)
+            if not count:
+                return False
+            end = pos + count*size
+
+            # line i of the group is ':', 2*size hex digits and '\n' (but
+            # for the last line of the file)
+            step = 2*size + 2
+            stop = line + count*step
+            if text[line:stop:step] != ':' * count:
+                return False
+            ends = text[line+step-1:stop:step]
+            if ends != '\n' * count and (ends != '\n' * (count-1) or
+                                         stop - 1 != len(text)):
+                return False
+            line = stop
+
+            if eof:
+                # the rest of the file is ignored once it is known to be
+                # made of records
+                pos = end
+                continue
+            if not _checksums_ok(blob, pos, end, size):
+                return False
+            hi = blob[pos+1:end:size]
+            lo = blob[pos+2:end:size]
+            types = blob[pos+3:end:size]
+
+            if types == bytearray(count) and length:
+                # data records only: each run of records whose offsets step
+                # by the record length is stored as one block
+                k = 0
+                while k < count:
+                    n = _run_length(hi, lo, k, count, length)
+                    p = pos + k*size
+                    addr = offset + hi[k]*256 + lo[k]
+                    if n == 1:
+                        store(addr, blob[p+4:p+size-1])
+                    else:
+                        data = bytearray(n*length)
+                        for j in xrange(length):
+                            data[j::length] = blob[p+4+j:p+n*size:size]
+                        store(addr, data)
+                    k += n
+                pos = end
+                continue
+
+            # one record at a time
+            for k in xrange(count):
+                p = pos + k*size
+                record_type = types[k]
+                addr = hi[k]*256 + lo[k]
+
+                if record_type == 0:
+                    # data record
+                    store(offset + addr, blob[p+4:p+size-1])
+
+                elif record_type == 1:
+                    # end of file record: the rest of the file is ignored
+                    if length != 0:
+                        return False
+                    eof = True
+                    break
+
+                elif record_type in (2, 4):
+                    # Extended Segment / Linear Address Record
+                    if length != 2 or addr != 0:
+                        return False
+                    offset = blob[p+4]*256 + blob[p+5]
+                    if record_type == 2:
+                        offset *= 16
+                    else:
+                        offset *= 65536
+
+                elif record_type in (3, 5):
+                    # Start Segment / Linear Address Record
+                    if length != 4 or addr != 0:
+                        return False
+                    if self.start_addr or start_addr is not None:
+                        return False
+                    if record_type == 3:
+                        start_addr = {'CS': blob[p+4]*256 + blob[p+5],
+                                      'IP': blob[p+6]*256 + blob[p+7],
+                                     }
+                    else:
+                        start_addr = {'EIP': (blob[p+4]*16777216 +
+                                              blob[p+5]*65536 +
+                                              blob[p+6]*256 +
+                                              blob[p+7]),
+                                     }
+
+                else:
+                    return False
+            pos = end
+
+        # every ':' and '\n' of the file was one of those checked above
+        if line != len(text) + 1:
+            return False
+
+        # runs must not overlap each other or data already loaded
+        runs.sort(key=lambda r: r[0])
+        prev_end = None
+        for addr, data in runs:
+            if prev_end is not None and addr < prev_end:
+                return False
+            if self._buf.overlaps(addr, len(data)) is not None:
+                return False
+            prev_end = addr + len(data)
+
+        for addr, data in runs:
+            self._buf.write(addr, data)
+        self._offset = offset
+        if start_addr is not None:
+            self.start_addr = start_addr
+        return True
+
     def loadhex(self, fobj):
         """Load hex file into internal buffer. This is not necessary
         if object was initialized with source set. This will overwrite
@@ -195,21 +681,28 @@ class IntelHex(object):
         else:
             fclose = None
 
-        self._offset = 0
-        line = 0
-
         try:
-            decode = self._decode_record
-            try:
-                for s in fobj:
-                    line += 1
-                    decode(s, line)
-            except _EndOfFile:
-                pass
+            text = fobj.read()
         finally:
             if fclose:
                 fclose()
 
+        self._offset = 0
+
+        if self._decode_bulk(text):
+            return
+
+        # something is wrong with the file: decode it record by record,
+        # which raises the error for the offending line
+        line = 0
+        decode = self._decode_record
+        try:
+            for s in text.split('\n'):
+                line += 1
+                decode(s, line)
+        except _EndOfFile:
+            pass
+
     def loadbin(self, fobj, offset=0):
         """Load bin file into internal buffer. Not needed if source set in
         constructor. This will overwrite addresses without warning
@@ -276,16 +769,14 @@ class IntelHex(object):
         """Load data from array or list of bytes.
         Similar to loadbin() method but works directly with iterable bytes.
         """
-        for b in bytes:
-            self._buf[offset] = b
-            offset += 1
+        self._buf.write(offset, bytes)
 
     def _get_start_end(self, start=None, end=None, size=None):
         """Return default values for start and end if they are None.
         If this IntelHex object is empty then it's error to
         invoke this method with both start and end as None. 
         """
-        if (start,end) == (None,None) and self._buf == {}:
+        if (start,end) == (None,None) and not self._buf:
             raise EmptyIntelHexError
         if size is not None:
             if None not in (start, end):
@@ -332,23 +823,76 @@ class IntelHex(object):
         return self._tobinarray_really(start, end, pad, size)
 
     def _tobinarray_really(self, start, end, pad, size):
+        return array('B', bytes(self._tobinbytes_really(start, end, pad, size)))
+
+    def _tobinbytes_really(self, start, end, pad, size):
         if pad is None:
             pad = self.padding
 
-        bin = array('B')
-
-        if self._buf == {} and None in (start, end):
-            return bin
+        if not self._buf and None in (start, end):
+            return bytearray()
 
         if size is not None and size <= 0:
             raise ValueError("tobinarray: wrong value for size")
 
         start, end = self._get_start_end(start, end, size)
 
-        for i in xrange(start, end+1):
-            bin.append(self._buf.get(i, pad))
+        data = bytearray(end - start + 1)
+        self._flatten(data, 0, start, end, pad)
+        return data
 
-        return bin
+    def _flatten(self, buf, offset, start, end, pad):
+        '''Write the bytes of addresses start..end (inclusive) into buf
+        from offset on: unless data covers all of it, the range is filled
+        with pad, then every segment of data in it is copied with one slice
+        assignment.
+        '''
+        pieces = []
+        covered = 0
+        for seg_start, block in self._buf.segments():
+            lo = max(seg_start, start)
+            hi = min(seg_start + len(block), end + 1)
+            if lo < hi:
+                pieces.append((lo, buffer(block, lo - seg_start, hi - lo)))
+                covered += hi - lo
+
+        length = end - start + 1
+        if covered < length:
+            buf[offset:offset+length] = bytes(bytearray([pad])) * length
+
+        # mmap (and the like) only take strings
+        to_bytes = not isinstance(buf, bytearray)
+        for lo, piece in pieces:
+            if to_bytes:
+                piece = bytes(piece)
+            buf[offset+lo-start:offset+lo-start+len(piece)] = piece
+
+    def tobinbuffer(self, buf, start=None, end=None, size=None, offset=0):
+        ''' Convert to binary form straight into a writable buffer,
+        e.g. a bytearray or an mmap, without an intermediate copy.
+        Empty spaces are filled with self.padding.
+        @param  buf     bytearray, mmap or other buffer taking string slices.
+        @param  start   start address of output bytes.
+        @param  end     end address of output bytes (inclusive).
+        @param  size    size of the block, used with start or end parameter.
+        @param  offset  position in buf of the first output byte.
+        @return         number of bytes written.
+        '''
+        if not self._buf and None in (start, end):
+            return 0
+
+        if size is not None and size <= 0:
+            raise ValueError("tobinbuffer: wrong value for size")
+
+        start, end = self._get_start_end(start, end, size)
+
+        length = end - start + 1
+        if offset < 0 or offset + length > len(buf):
+            raise ValueError("tobinbuffer: %d bytes do not fit in buffer "
+                             "of %d bytes at offset %d" % (length, len(buf), offset))
+
+        self._flatten(buf, offset, start, end, self.padding)
+        return length
 
     def tobinstr(self, start=None, end=None, pad=_DEPRECATED, size=None):
         ''' Convert to binary form and return as a string.
@@ -372,7 +916,7 @@ class IntelHex(object):
         return self._tobinstr_really(start, end, pad, size)
 
     def _tobinstr_really(self, start, end, pad, size):
-        return asstr(self._tobinarray_really(start, end, pad, size).tostring())
+        return asstr(bytes(self._tobinbytes_really(start, end, pad, size)))
 
     def tobinfile(self, fobj, start=None, end=None, pad=_DEPRECATED, size=None):
         '''Convert to binary and write to file.
@@ -411,7 +955,7 @@ class IntelHex(object):
         @return         dict suitable for initializing another IntelHex object.
         '''
         r = {}
-        r.update(self._buf)
+        r.update(self._buf.iteritems())
         if self.start_addr:
             r['start_addr'] = self.start_addr
         return r
@@ -428,21 +972,13 @@ class IntelHex(object):
         '''Get minimal address of HEX content.
         @return         minimal address or None if no data
         '''
-        aa = self._buf.keys()
-        if aa == []:
-            return None
-        else:
-            return min(aa)
+        return self._buf.minaddr()
 
     def maxaddr(self):
         '''Get maximal address of HEX content.
         @return         maximal address or None if no data
         '''
-        aa = self._buf.keys()
-        if aa == []:
-            return None
-        else:
-            return max(aa)
+        return self._buf.maxaddr()
 
     def __getitem__(self, addr):
         ''' Get requested byte from address.
@@ -456,12 +992,10 @@ class IntelHex(object):
                 raise TypeError('Address should be >= 0.')
             return self._buf.get(addr, self.padding)
         elif t == slice:
-            addresses = self._buf.keys()
             ih = IntelHex()
-            if addresses:
-                addresses.sort()
-                start = addr.start or addresses[0]
-                stop = addr.stop or (addresses[-1]+1)
+            if self._buf:
+                start = addr.start or self._buf.minaddr()
+                stop = addr.stop or (self._buf.maxaddr()+1)
                 step = addr.step or 1
                 for i in xrange(start, stop, step):
                     x = self._buf.get(i)
@@ -514,11 +1048,9 @@ class IntelHex(object):
                 raise TypeError('Address should be >= 0.')
             del self._buf[addr]
         elif t == slice:
-            addresses = self._buf.keys()
-            if addresses:
-                addresses.sort()
-                start = addr.start or addresses[0]
-                stop = addr.stop or (addresses[-1]+1)
+            if self._buf:
+                start = addr.start or self._buf.minaddr()
+                stop = addr.stop or (self._buf.maxaddr()+1)
                 step = addr.step or 1
                 for i in xrange(start, stop, step):
                     x = self._buf.get(i)
@@ -529,7 +1061,7 @@ class IntelHex(object):
 
     def __len__(self):
         """Return count of bytes with real values."""
-        return len(self._buf.keys())
+        return len(self._buf)
 
     def write_hex_file(self, f, write_start_addr=True):
         """Write data to file f in HEX format.
@@ -602,86 +1134,52 @@ class IntelHex(object):
                 raise InvalidStartAddressValueError(start_addr=self.start_addr)
 
         # data
-        addresses = self._buf.keys()
-        addresses.sort()
-        addr_len = len(addresses)
-        if addr_len:
-            minaddr = addresses[0]
-            maxaddr = addresses[-1]
-
-            if maxaddr > 65535:
+        if self._buf:
+            if self._buf.maxaddr() > 65535:
                 need_offset_record = True
             else:
                 need_offset_record = False
-            high_ofs = 0
-
-            cur_addr = minaddr
-            cur_ix = 0
-
-            while cur_addr <= maxaddr:
-                if need_offset_record:
-                    bin = array('B', asbytes('\0'*7))
-                    bin[0] = 2      # reclen
-                    bin[1] = 0      # offset msb
-                    bin[2] = 0      # offset lsb
-                    bin[3] = 4      # rectyp
-                    high_ofs = int(cur_addr>>16)
-                    b = divmod(high_ofs, 256)
-                    bin[4] = b[0]   # msb of high_ofs
-                    bin[5] = b[1]   # lsb of high_ofs
-                    bin[6] = (-sum(bin)) & 0x0FF    # chksum
-                    fwrite(':' +
-                           asstr(hexlify(bin.tostring()).translate(table)) +
-                           '\n')
-
-                while True:
-                    # produce one record
+            high_ofs = None
+
+            for start, block in self._buf.segments():
+                cur_addr = start
+                end_addr = start + len(block)
+
+                while cur_addr < end_addr:
+                    if need_offset_record and (cur_addr>>16) != high_ofs:
+                        bin = array('B', asbytes('\0'*7))
+                        bin[0] = 2      # reclen
+                        bin[1] = 0      # offset msb
+                        bin[2] = 0      # offset lsb
+                        bin[3] = 4      # rectyp
+                        high_ofs = int(cur_addr>>16)
+                        b = divmod(high_ofs, 256)
+                        bin[4] = b[0]   # msb of high_ofs
+                        bin[5] = b[1]   # lsb of high_ofs
+                        bin[6] = (-sum(bin)) & 0x0FF    # chksum
+                        fwrite(':' +
+                               asstr(hexlify(bin.tostring()).translate(table)) +
+                               '\n')
+
+                    # produce one record: up to 16 bytes of the segment,
+                    # not crossing a 64K boundary
                     low_addr = cur_addr & 0x0FFFF
-                    # chain_len off by 1
-                    chain_len = min(15, 65535-low_addr, maxaddr-cur_addr)
-
-                    # search continuous chain
-                    stop_addr = cur_addr + chain_len
-                    if chain_len:
-                        ix = bisect_right(addresses, stop_addr,
-                                          cur_ix,
-                                          min(cur_ix+chain_len+1, addr_len))
-                        chain_len = ix - cur_ix     # real chain_len
-                        # there could be small holes in the chain
-                        # but we will catch them by try-except later
-                        # so for big continuous files we will work
-                        # at maximum possible speed
-                    else:
-                        chain_len = 1               # real chain_len
+                    chain_len = min(16, 65536-low_addr, end_addr-cur_addr)
 
-                    bin = array('B', asbytes('\0'*(5+chain_len)))
+                    bin = array('B', asbytes('\0'*4))
                     b = divmod(low_addr, 256)
+                    bin[0] = chain_len
                     bin[1] = b[0]   # msb of low_addr
                     bin[2] = b[1]   # lsb of low_addr
                     bin[3] = 0          # rectype
-                    try:    # if there is small holes we'll catch them
-                        for i in range(chain_len):
-                            bin[4+i] = self._buf[cur_addr+i]
-                    except KeyError:
-                        # we catch a hole so we should shrink the chain
-                        chain_len = i
-                        bin = bin[:5+i]
-                    bin[0] = chain_len
-                    bin[4+chain_len] = (-sum(bin)) & 0x0FF    # chksum
+                    offset = cur_addr - start
+                    bin.extend(block[offset:offset+chain_len])
+                    bin.append((-sum(bin)) & 0x0FF)    # chksum
                     fwrite(':' +
                            asstr(hexlify(bin.tostring()).translate(table)) +
                            '\n')
 
-                    # adjust cur_addr/cur_ix
-                    cur_ix += chain_len
-                    if cur_ix < addr_len:
-                        cur_addr = addresses[cur_ix]
-                    else:
-                        cur_addr = maxaddr + 1
-                        break
-                    high_addr = int(cur_addr>>16)
-                    if high_addr > high_ofs:
-                        break
+                    cur_addr += chain_len
 
         # end-of-file record
         fwrite(":00000001FF\n")
@@ -718,9 +1216,7 @@ class IntelHex(object):
         """Put string of bytes at given address. Will overwrite any previous
         entries.
         """
-        a = array('B', asbytes(s))
-        for i in xrange(len(a)):
-            self._buf[addr+i] = a[i]
+        self._buf.write(addr, array('B', asbytes(s)))
 
     def getsz(self, addr):
         """Get zero-terminated string from given address. Will raise 
@@ -764,11 +1260,9 @@ class IntelHex(object):
             else:
                 tofile.write('start_addr = %r\n' % start_addr)
         # actual data
-        addresses = self._buf.keys()
-        if addresses:
-            addresses.sort()
-            minaddr = addresses[0]
-            maxaddr = addresses[-1]
+        if self._buf:
+            minaddr = self._buf.minaddr()
+            maxaddr = self._buf.maxaddr()
             startaddr = int(minaddr>>4)*16
             endaddr = int((maxaddr>>4)+1)*16
             maxdigits = max(len(str(endaddr)), 4)
@@ -817,15 +1311,17 @@ class IntelHex(object):
                 "'error', 'ignore' or 'replace'")
         # merge data
         this_buf = self._buf
-        other_buf = other._buf
-        for i in other_buf:
-            if i in this_buf:
-                if overlap == 'error':
-                    raise AddressOverlapError(
-                        'Data overlapped at address 0x%X' % i)
-                elif overlap == 'ignore':
-                    continue
-            this_buf[i] = other_buf[i]
+        for start, block in other._buf.segments():
+            i = this_buf.overlaps(start, len(block))
+            if i is None or overlap == 'replace':
+                this_buf.write(start, block)
+            elif overlap == 'error':
+                raise AddressOverlapError(
+                    'Data overlapped at address 0x%X' % i)
+            else:   # ignore
+                for i in xrange(len(block)):
+                    if start+i not in this_buf:
+                        this_buf[start+i] = block[i]
         # merge start_addr
         if self.start_addr != other.start_addr:
             if self.start_addr is None:     # set start addr from other
@@ -907,22 +1403,20 @@ class IntelHex16bit(IntelHex):
 
         @return         minimal address used in this object
         '''
-        aa = self._buf.keys()
-        if aa == []:
+        if not self._buf:
             return 0
         else:
-            return min(aa)>>1
+            return self._buf.minaddr()>>1
 
     def maxaddr(self):
         '''Get maximal address of HEX content in 16-bit mode.
 
         @return         maximal address used in this object 
         '''
-        aa = self._buf.keys()
-        if aa == []:
+        if not self._buf:
             return 0
         else:
-            return max(aa)>>1
+            return self._buf.maxaddr()>>1
 
     def tobinarray(self, start=None, end=None, size=None):
         '''Convert this object to binary form as array (of 2-bytes word data).
@@ -935,7 +1429,7 @@ class IntelHex16bit(IntelHex):
         '''
         bin = array('H')
 
-        if self._buf == {} and None in (start, end):
+        if not self._buf and None in (start, end):
             return bin
 
         if size is not None and size <= 0:
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+#------------------------------------------------------------------------------
+# Session instrumentation for the DFU server.
+#
+# A SessionMetrics records when each phase of an update started and ended
+# (connect, start, erase, init, transfer, validate, ...), the transfer rate
+# and a histogram of PKT_RCPT round trip times.  It can be dumped as a JSON
+# summary or as a Prometheus textfile for node_exporter's textfile collector.
+#------------------------------------------------------------------------------
+import os
+import time
+import json
+import ctypes
+import ctypes.util
+
+#------------------------------------------------------------------------------
+# Monotonic clock in seconds.  Python 2 has no time.monotonic, so
+# clock_gettime(CLOCK_MONOTONIC) is called through ctypes where possible.
+#------------------------------------------------------------------------------
+CLOCK_MONOTONIC = 1
+
+class _timespec(ctypes.Structure):
+    _fields_ = [
+        ('tv_sec',  ctypes.c_long),
+        ('tv_nsec', ctypes.c_long),
+    ]
+
+def _clock_gettime():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        clock_gettime = libc.clock_gettime
+    except (OSError, AttributeError):
+        return None
+
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+
+    def monotonic():
+        ts = _timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+            return time.time()
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+
+    return monotonic
+
+if hasattr(time, 'monotonic'):
+    monotonic = time.monotonic
+else:
+    monotonic = _clock_gettime() or time.time
+
+#------------------------------------------------------------------------------
+# Timings of one DFU session.
+#------------------------------------------------------------------------------
+class SessionMetrics(object):
+
+    # PKT_RCPT round trip histogram bucket bounds, in seconds
+    rtt_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+    def __init__(self, address):
+
+        self.address  = address
+        self.image    = None        # package image name, if sending a package
+        self.started  = monotonic()
+        self.wall     = time.time()
+        self.finished = None
+        self.error    = None
+
+        # [name, start, end] in the order the phases ran
+        self.phases  = []
+        self.current = None
+
+        self.rtt_counts = [0] * (len(self.rtt_buckets) + 1)
+        self.rtt_sum    = 0.0
+        self.rtt_count  = 0
+
+        self.transfer_bytes   = 0
+        self.transfer_seconds = 0.0
+
+        self.resume_attempts = 0
+        self.resumed_from    = 0
+
+        # Secure DFU data objects sent again after a failed CRC check
+        self.object_retries  = 0
+
+        # negotiated link: ATT MTU, data packet payload, LE data length
+        # (None if it could not be requested)
+        self.att_mtu      = 23
+        self.payload_size = 20
+        self.data_length  = None
+
+        # transport.ConnParams granted for the transfer, None if unknown
+        self.conn_params  = None
+
+    #--------------------------------------------------------------------------
+    # Begin phase 'name', ending the one in progress.
+    #--------------------------------------------------------------------------
+    def start_phase(self, name):
+        now = monotonic()
+        if self.current is not None:
+            self.current[2] = now
+        self.current = [name, now, None]
+        self.phases.append(self.current)
+
+    def end_phase(self):
+        if self.current is not None:
+            self.current[2] = monotonic()
+            self.current = None
+
+    #--------------------------------------------------------------------------
+    # Record one PKT_RCPT round trip (seconds from the receipt point being
+    # sent to the receipt arriving).
+    #--------------------------------------------------------------------------
+    def receipt(self, rtt):
+
+        index = 0
+        for bound in self.rtt_buckets:
+            if rtt <= bound:
+                break
+            index += 1
+
+        self.rtt_counts[index] += 1
+        self.rtt_sum   += rtt
+        self.rtt_count += 1
+
+    def transfer(self, nbytes, seconds):
+        self.transfer_bytes   += nbytes
+        self.transfer_seconds += seconds
+
+    #--------------------------------------------------------------------------
+    # Close the session; 'error' is None on success.
+    #--------------------------------------------------------------------------
+    def finish(self, error=None):
+        self.end_phase()
+        if self.finished is None:
+            self.finished = monotonic()
+            self.error = error
+
+    #--------------------------------------------------------------------------
+    # Seconds spent per phase name (a phase may run more than once).
+    #--------------------------------------------------------------------------
+    def phase_seconds(self):
+        seconds = {}
+        now = monotonic()
+        for name, start, stop in self.phases:
+            seconds[name] = seconds.get(name, 0.0) + ((stop or now) - start)
+        return seconds
+
+    def throughput(self):
+        if self.transfer_seconds <= 0:
+            return 0.0
+        return self.transfer_bytes / self.transfer_seconds
+
+    def summary(self):
+
+        end = self.finished or monotonic()
+
+        return {
+            "address"         : self.address,
+            "image"           : self.image,
+            "start_time"      : self.wall,
+            "seconds"         : end - self.started,
+            "success"         : self.finished is not None and self.error is None,
+            "error"           : self.error,
+            "phases"          : [{"phase"  : name,
+                                  "start"  : start - self.started,
+                                  "seconds": (stop or monotonic()) - start}
+                                 for name, start, stop in self.phases],
+            "transfer_bytes"  : self.transfer_bytes,
+            "bytes_per_second": self.throughput(),
+            "pkt_rcpt_rtt"    : {"buckets": list(self.rtt_buckets),
+                                 "counts" : list(self.rtt_counts),
+                                 "sum"    : self.rtt_sum,
+                                 "count"  : self.rtt_count},
+            "resume_attempts" : self.resume_attempts,
+            "resumed_from"    : self.resumed_from,
+            "object_retries"  : self.object_retries,
+            "att_mtu"         : self.att_mtu,
+            "payload_size"    : self.payload_size,
+            "data_length"     : self.data_length,
+            "conn_params"     : self.conn_params and self.conn_params._asdict(),
+        }
+
+    def to_json(self):
+        return json.dumps(self.summary(), indent=2, sort_keys=True)
+
+    #--------------------------------------------------------------------------
+    # Prometheus exposition lines for this session (without HELP/TYPE).
+    #--------------------------------------------------------------------------
+    def prometheus_samples(self):
+
+        label = 'address="{0}"'.format(self.address)
+        if self.image is not None:
+            label += ',image="{0}"'.format(self.image)
+        end   = self.finished or monotonic()
+
+        samples = {
+            "dfu_session_seconds"           : [(label, end - self.started)],
+            "dfu_session_success"           : [(label, int(self.finished is not None and self.error is None))],
+            "dfu_transfer_bytes"            : [(label, self.transfer_bytes)],
+            "dfu_transfer_bytes_per_second" : [(label, self.throughput())],
+            "dfu_resume_attempts"           : [(label, self.resume_attempts)],
+            "dfu_object_retries"            : [(label, self.object_retries)],
+            "dfu_att_mtu"                   : [(label, self.att_mtu)],
+            "dfu_packet_payload_bytes"      : [(label, self.payload_size)],
+            "dfu_phase_seconds"             : [('{0},phase="{1}"'.format(label, name), seconds)
+                                               for name, seconds in sorted(self.phase_seconds().items())],
+        }
+
+        buckets = []
+        cumulative = 0
+        for bound, count in zip(self.rtt_buckets + ('+Inf',), self.rtt_counts):
+            cumulative += count
+            buckets.append(('{0},le="{1}"'.format(label, bound), cumulative))
+
+        if self.data_length is not None:
+            samples["dfu_data_length_octets"] = [(label, self.data_length)]
+
+        if self.conn_params is not None:
+            samples["dfu_conn_interval_seconds"]      = [(label, self.conn_params.interval / 1000.0)]
+            samples["dfu_conn_latency"]               = [(label, self.conn_params.latency)]
+            samples["dfu_supervision_timeout_seconds"] = [(label, self.conn_params.timeout / 1000.0)]
+
+        samples["dfu_pkt_rcpt_rtt_seconds_bucket"] = buckets
+        samples["dfu_pkt_rcpt_rtt_seconds_sum"]    = [(label, self.rtt_sum)]
+        samples["dfu_pkt_rcpt_rtt_seconds_count"]  = [(label, self.rtt_count)]
+
+        return samples
+
+#------------------------------------------------------------------------------
+# Prometheus metric families: (name, type, help).
+#------------------------------------------------------------------------------
+prometheus_families = [
+    ("dfu_session_seconds",           "gauge",     "Wall time of the DFU session."),
+    ("dfu_session_success",           "gauge",     "1 if the DFU session completed."),
+    ("dfu_phase_seconds",             "gauge",     "Time spent in each DFU phase."),
+    ("dfu_transfer_bytes",            "gauge",     "Image bytes sent during RECEIVE_FIRMWARE_IMAGE."),
+    ("dfu_transfer_bytes_per_second", "gauge",     "Image transfer rate."),
+    ("dfu_resume_attempts",           "gauge",     "Transfers resumed from a checkpoint."),
+    ("dfu_object_retries",            "gauge",     "Secure DFU data objects sent again after a CRC mismatch."),
+    ("dfu_att_mtu",                   "gauge",     "Negotiated ATT MTU."),
+    ("dfu_packet_payload_bytes",      "gauge",     "Image bytes per data packet."),
+    ("dfu_data_length_octets",        "gauge",     "LE data length requested from the controller."),
+    ("dfu_conn_interval_seconds",     "gauge",     "Connection interval granted for the transfer."),
+    ("dfu_conn_latency",              "gauge",     "Slave latency granted for the transfer."),
+    ("dfu_supervision_timeout_seconds", "gauge",   "Supervision timeout granted for the transfer."),
+    ("dfu_pkt_rcpt_rtt_seconds",      "histogram", "PKT_RCPT round trip time."),
+]
+
+#------------------------------------------------------------------------------
+# Write 'text' to 'path' atomically, so a scraper never sees half a file.
+#------------------------------------------------------------------------------
+def _write_atomic(path, text):
+    with open(path + ".tmp", "w") as f:
+        f.write(text)
+    os.rename(path + ".tmp", path)
+
+def write_json(path, sessions):
+    _write_atomic(path, json.dumps([s.summary() for s in sessions], indent=2, sort_keys=True) + "\n")
+
+def write_prometheus(path, sessions):
+
+    collected = {}
+    for session in sessions:
+        for name, values in session.prometheus_samples().items():
+            collected.setdefault(name, []).extend(values)
+
+    lines = []
+    for family, kind, text in prometheus_families:
+        lines.append("# HELP {0} {1}".format(family, text))
+        lines.append("# TYPE {0} {1}".format(family, kind))
+        names = [family]
+        if kind == "histogram":
+            names = [family + "_bucket", family + "_sum", family + "_count"]
+        for name in names:
+            for labels, value in collected.get(name, []):
+                lines.append("{0}{{{1}}} {2}".format(name, labels, value))
+
+    _write_atomic(path, "\n".join(lines) + "\n")
@@ -0,0 +1,417 @@
+#!/usr/bin/env python
+#------------------------------------------------------------------------------
+# Secure DFU Server for Nordic nRF5 based systems.
+# Conforms to the object based BLE Secure DFU of nRF5 SDK 12 and later.
+#
+# The init packet (a command object) and the image (data objects of up to
+# 4 KB) are each created on the target, written through the DFU packet
+# characteristic and checked against the target's CRC32 before they are
+# executed.  A data object that fails its check is created and sent again
+# on its own instead of the whole image.
+#
+# SecureDfuServer builds on BleDfuServer: transports, MTU and connection
+# parameter handling, metrics and events are the same as for the legacy
+# flow; run it with dfu.py --secure.
+#------------------------------------------------------------------------------
+import zlib
+import struct
+
+from collections import deque
+from binascii    import hexlify
+from dfu         import BleDfuServer
+from metrics     import monotonic
+
+# Secure DFU control point opcodes
+class SecureCommands:
+    CREATE_OBJECT   = 0x01
+    SET_PRN         = 0x02
+    CALC_CRC        = 0x03
+    EXECUTE         = 0x04
+    SELECT_OBJECT   = 0x06
+    RESPONSE        = 0x60
+
+# Object types
+class ObjectTypes:
+    COMMAND         = 0x01
+    DATA            = 0x02
+
+# Secure DFU Operations values
+DFU_secure_oper_to_str = {
+    0x01 : "CREATE",
+    0x02 : "SET_PRN",
+    0x03 : "CALC_CRC",
+    0x04 : "EXECUTE",
+    0x06 : "SELECT",
+    0x60 : "RESPONSE",
+}
+
+# Secure DFU result values
+DFU_secure_result_to_str = {
+    0x00 : "INVALID_CODE",
+    0x01 : "SUCCESS",
+    0x02 : "OP_CODE_NOT_SUPPORTED",
+    0x03 : "INVALID_PARAMETER",
+    0x04 : "INSUFFICIENT_RESOURCES",
+    0x05 : "INVALID_OBJECT",
+    0x07 : "UNSUPPORTED_TYPE",
+    0x08 : "OPERATION_NOT_PERMITTED",
+    0x0A : "OPERATION_FAILED",
+    0x0B : "EXT_ERROR",
+}
+
+RESULT_SUCCESS   = 0x01
+RESULT_EXT_ERROR = 0x0B
+
+#------------------------------------------------------------------------------
+# Little endian request fields.
+#------------------------------------------------------------------------------
+def uint16_to_list(value):
+    return list(bytearray(struct.pack('<H', value)))
+
+def uint32_to_list(value):
+    return list(bytearray(struct.pack('<I', value)))
+
+#------------------------------------------------------------------------------
+# Define the SecureDfuServer class
+#------------------------------------------------------------------------------
+class SecureDfuServer(BleDfuServer):
+
+    #--------------------------------------------------------------------------
+    # Adjust these handle values to your peripheral device requirements.
+    #--------------------------------------------------------------------------
+    ctrlpt_handle      = 0x10
+    ctrlpt_cccd_handle = 0x11
+    data_handle        = 0x0e
+
+    #--------------------------------------------------------------------------
+    # A data object failing its CRC check is sent again up to object_retries
+    # times.  Control point requests are answered within response_timeout;
+    # EXECUTE, which writes flash (and for the last object validates the
+    # image), within validate_timeout.
+    #--------------------------------------------------------------------------
+    object_retries   = 3
+    response_timeout = 10
+
+    #--------------------------------------------------------------------------
+    # Write a control point request and wait for its response.  Returns the
+    # response payload after opcode and result; raises unless SUCCESS.
+    #--------------------------------------------------------------------------
+    def _secure_request(self, opcode, params=(), timeout=None):
+
+        name = DFU_secure_oper_to_str.get(opcode, opcode)
+
+        if timeout is None:
+            timeout = self.response_timeout
+
+        if not self.transport.write_req(self.ctrlpt_handle, [opcode] + list(params)):
+            raise Exception("{0} write failed".format(name))
+
+        deadline = monotonic() + timeout
+
+        while True:
+            notify = self._dfu_wait_for_notify(max(deadline - monotonic(), 0))
+
+            if notify == None:
+                raise Exception("no {0} response".format(name))
+
+            if len(notify) < 3 or notify[0] != SecureCommands.RESPONSE or notify[1] != opcode:
+                continue
+
+            if notify[2] != RESULT_SUCCESS:
+                status = DFU_secure_result_to_str.get(notify[2], notify[2])
+                if notify[2] == RESULT_EXT_ERROR and len(notify) > 3:
+                    status = "{0} 0x{1:02x}".format(status, notify[3])
+                raise Exception("{0} failed: {1}".format(name, status))
+
+            return notify[3:]
+
+    #--------------------------------------------------------------------------
+    # SELECT: returns (max object size, offset, crc) of the target's object
+    # of this type.
+    #--------------------------------------------------------------------------
+    def _secure_select(self, object_type):
+        payload = self._secure_request(SecureCommands.SELECT_OBJECT, [object_type])
+        return struct.unpack('<III', str(payload[:12]))
+
+    def _secure_create(self, object_type, size):
+        self._secure_request(SecureCommands.CREATE_OBJECT, [object_type] + uint32_to_list(size))
+
+    #--------------------------------------------------------------------------
+    # CALC_CRC: returns (offset, crc) of the current object type.
+    #--------------------------------------------------------------------------
+    def _secure_calc_crc(self):
+        payload = self._secure_request(SecureCommands.CALC_CRC)
+        return struct.unpack('<II', str(payload[:8]))
+
+    def _secure_execute(self):
+        self._secure_request(SecureCommands.EXECUTE, timeout=self.validate_timeout)
+
+    #--------------------------------------------------------------------------
+    # Secure DFU init packets are signed protobuf with no CRC16 to check
+    # against; the bootloader verifies the image hash on EXECUTE.
+    #--------------------------------------------------------------------------
+    def _dfu_check_init(self):
+        pass
+
+    #--------------------------------------------------------------------------
+    # Send the init packet (*.dat file contents) as the command object,
+    # unless the target already holds it.
+    #--------------------------------------------------------------------------
+    def _secure_send_init(self):
+
+        print "dfu_send_info"
+
+        init = self._dfu_read_init()
+        init_crc = zlib.crc32(buffer(init)) & 0xffffffff
+
+        max_size, offset, crc = self._secure_select(ObjectTypes.COMMAND)
+
+        if offset == len(init) and crc == init_crc:
+            # Executing it again keeps the image data the target has.
+            print "init packet already on target"
+            self._secure_execute()
+            return
+
+        if len(init) > max_size:
+            raise Exception("init packet of {0} bytes, target takes {1}".format(len(init), max_size))
+
+        self._secure_create(ObjectTypes.COMMAND, len(init))
+
+        for i in xrange(0, len(init), self.pkt_payload_size):
+            self.transport.write_cmd(self.data_handle, init[i:i + self.pkt_payload_size])
+
+        offset, crc = self._secure_calc_crc()
+        if offset != len(init) or crc != init_crc:
+            raise Exception("init packet CRC mismatch: peer has {0} bytes, crc 0x{1:08x}".format(offset, crc))
+
+        self._secure_execute()
+
+    #--------------------------------------------------------------------------
+    # Send the binary firmware image to peripheral device.
+    #--------------------------------------------------------------------------
+    def _dfu_send_image(self):
+
+        # Enable Notifications
+        self._dfu_phase("enable_cccd")
+        self._dfu_enable_cccd()
+
+        self._dfu_phase("init")
+        self._secure_send_init()
+
+        # Receipts (CRC notifications) every pkt_receipt_interval packets
+        self._secure_request(SecureCommands.SET_PRN, uint16_to_list(self.pkt_receipt_interval))
+
+        self._secure_send_firmware()
+
+        # The target resets into the new image once it has been executed.
+        self._dfu_phase("reset")
+        if not self.transport.wait_disconnect(self.reset_timeout):
+            print "no disconnect {0}s after activate".format(self.reset_timeout)
+        self.metrics.end_phase()
+
+    #--------------------------------------------------------------------------
+    # Transfer the image as data objects, carrying on from whatever part of
+    # it the target holds.
+    #--------------------------------------------------------------------------
+    def _secure_send_firmware(self):
+
+        '''
+        Every object is created, sent as packets of pkt_payload_size (the
+        packet plan keeps packets within objects), checked with CALC_CRC
+        and executed.  The receipt the target sends every
+        pkt_receipt_interval packets carries the offset and CRC32 so far;
+        up to pkt_receipt_window of them may be outstanding.  A receipt or
+        CRC that does not match the image sends the object again.  The last
+        object is executed in the "activate" phase: the target validates
+        the whole image and resets into it.
+        Checked data survives a lost link on the target, so a new session
+        selects the data object and continues after the last good byte
+        (the object it belongs to is finished or sent again).
+        '''
+        max_size, offset, crc = self._secure_select(ObjectTypes.DATA)
+
+        plan = self.image.packet_plan(self.transport, self.data_handle, self.pkt_payload_size, max_size)
+        per_object = (max_size + self.pkt_payload_size - 1) // self.pkt_payload_size
+
+        start     = 0
+        resume_at = None
+
+        if offset and offset <= self.hex_size and crc == self.image.crc32(0, offset):
+            print "resume: target holds {0} bytes".format(offset)
+            self.resume_attempts += 1
+            self.metrics.resume_attempts += 1
+            self.resumed_from = offset
+            self.metrics.resumed_from = offset
+
+            start = offset - offset % max_size
+            if offset % max_size:
+                resume_at = offset
+            elif offset < self.hex_size:
+                # a full object; executing it again does no harm
+                self._secure_execute()
+
+        elif offset:
+            # The data after the last executed object is not ours; the
+            # object it belongs to is created again.
+            start = (min(offset, self.hex_size) - 1) // max_size * max_size
+
+        self.bytes_sent      = start
+        self.bytes_confirmed = resume_at or start
+
+        self.metrics.conn_params = self._dfu_update_conn_params(self.fast_conn_params)
+
+        self._dfu_phase("transfer")
+        transfer_start = monotonic()
+
+        self.transfer_start  = transfer_start
+        self.transfer_offset = self.bytes_confirmed
+
+        done = False
+        try:
+            crc = self.image.crc32(0, start)
+
+            for obj_start in xrange(start, self.hex_size, max_size):
+                obj_end = min(obj_start + max_size, self.hex_size)
+
+                crc = self._secure_send_object(plan, obj_start // max_size * per_object,
+                                               obj_start, obj_end, resume_at, crc)
+                resume_at = None
+
+                self.bytes_confirmed = obj_end
+                self._dfu_progress(monotonic(), obj_end == self.hex_size)
+
+                if obj_end < self.hex_size:
+                    self._secure_execute()
+
+            transfer_time = monotonic() - transfer_start
+            self.metrics.transfer(self.hex_size - self.transfer_offset, transfer_time)
+            self.throughput = (self.hex_size - self.transfer_offset) / max(transfer_time, 1e-6)
+
+            conn_params = self.metrics.conn_params
+            print "PRN interval: {0}, object retries: {1}, connection interval: {2}, throughput: {3:.0f} bytes/s".format(
+                  self.pkt_receipt_interval, self.metrics.object_retries,
+                  "{0} ms".format(conn_params.interval) if conn_params else "unknown", self.throughput)
+            done = True
+
+        finally:
+            self._dfu_relax_conn_params(done)
+
+        # Executing the last object validates and activates the image.  The
+        # peer may reset before its response gets out, so a lost link here
+        # is taken as the reset.
+        self._dfu_phase("activate")
+        try:
+            self._secure_execute()
+        except Exception, e:
+            if not str(e).startswith('Connection Lost'):
+                raise
+
+    #--------------------------------------------------------------------------
+    # Send the object [obj_start, obj_end) until its CRC checks out.  Its
+    # packets start at plan segment 'first'; 'resume_at' continues an object
+    # the target already has part of.  'crc' is the CRC32 of the image up to
+    # obj_start.  Returns the CRC32 up to obj_end.
+    #--------------------------------------------------------------------------
+    def _secure_send_object(self, plan, first, obj_start, obj_end, resume_at, crc):
+
+        expected = self.image.crc32(obj_start, obj_end, crc)
+
+        for attempt in xrange(self.object_retries + 1):
+
+            if resume_at is None:
+                self._secure_create(ObjectTypes.DATA, obj_end - obj_start)
+                begin = obj_start
+            else:
+                begin = resume_at
+                resume_at = None
+
+            receipts_ok = self._secure_send_packets(plan, first, obj_start, begin, obj_end, crc)
+
+            offset, peer_crc = self._secure_calc_crc()
+            if receipts_ok and offset == obj_end and peer_crc == expected:
+                return expected
+
+            print "object at {0}: peer has {1} bytes, crc 0x{2:08x}, expected 0x{3:08x}; sending it again".format(
+                  obj_start, offset, peer_crc, expected)
+            self.metrics.object_retries += 1
+
+        raise Exception("object at {0} failed its CRC check {1} times".format(obj_start, self.object_retries + 1))
+
+    #--------------------------------------------------------------------------
+    # Packet loop of _secure_send_object.  Returns False if a receipt did not
+    # match the image.
+    #--------------------------------------------------------------------------
+    def _secure_send_packets(self, plan, first, obj_start, begin, obj_end, crc):
+
+        write_encoded = self.transport.write_encoded
+        interval      = self.pkt_receipt_interval
+        payload       = self.pkt_payload_size
+
+        # the object's packets from 'begin' on, starting with what is left
+        # of a packet the target has part of
+        packets = []
+        offset  = obj_start
+        for i in xrange(first, first + (obj_end - obj_start + payload - 1) // payload):
+            segment = plan.segments[i]
+            if offset >= begin:
+                packets.append((plan.wire[i], len(segment)))
+            elif offset + len(segment) > begin:
+                tail = segment[begin - offset:]
+                packets.append((self.transport.encode_cmd(self.data_handle, tail), len(tail)))
+            offset += len(segment)
+
+        crc   = self.image.crc32(obj_start, begin, crc)
+        point = begin
+        sent  = begin
+
+        outstanding = deque()
+        receipts_ok = True
+
+        for number, (wire, length) in enumerate(packets, 1):
+
+            write_encoded(wire)
+            sent += length
+
+            if interval and number % interval == 0:
+                crc = self.image.crc32(point, sent, crc)
+                point = sent
+                self.bytes_sent = sent
+                outstanding.append((sent, crc, monotonic()))
+
+                if len(outstanding) >= self.pkt_receipt_window:
+                    receipts_ok = self._secure_wait_for_receipt(outstanding) and receipts_ok
+
+        self.bytes_sent = sent
+
+        while outstanding:
+            receipts_ok = self._secure_wait_for_receipt(outstanding) and receipts_ok
+
+        return receipts_ok
+
+    #--------------------------------------------------------------------------
+    # Wait for the oldest outstanding receipt and check its offset and CRC.
+    #--------------------------------------------------------------------------
+    def _secure_wait_for_receipt(self, outstanding):
+
+        notify = self._dfu_wait_for_notify()
+
+        if notify == None:
+            raise Exception("no notification received: sent {0}, peer confirmed {1}".format(
+                            self.bytes_sent, self.bytes_confirmed))
+
+        if len(notify) < 11 or notify[0] != SecureCommands.RESPONSE or \
+           notify[1] != SecureCommands.CALC_CRC or notify[2] != RESULT_SUCCESS:
+            raise Exception("unexpected notification: {0}".format(hexlify(notify)))
+
+        offset, crc = struct.unpack('<II', str(notify[3:11]))
+        expected, expected_crc, sent_time = outstanding.popleft()
+
+        arrived = monotonic()
+        self.metrics.receipt(arrived - sent_time)
+
+        if offset != expected or crc != expected_crc:
+            return False
+
+        self.bytes_confirmed = offset
+        self._dfu_progress(arrived)
+        return True
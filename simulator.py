@@ -0,0 +1,877 @@
+#!/usr/bin/env python
+#------------------------------------------------------------------------------
+# In-process simulation of an nRF51 SDK 8.0 legacy DFU bootloader.
+#
+# SimulatedBootloader implements the control point state machine
+# (START / INIT / RECEIVE / VALIDATE / ACTIVATE), PKT_RCPT notifications and
+# the CRC16 check of the received image against the init packet.
+# SimulatedSecureBootloader does the same for the object based Secure DFU
+# of later SDKs (see secure_dfu.py).
+# SimTransport plugs either into a DFU server in place of a radio link, with
+# configurable per-packet latency and loss.
+#------------------------------------------------------------------------------
+import math
+import time
+import zlib
+import heapq
+import random
+import struct
+import hashlib
+import threading
+
+from crc16     import crc16_compute, init_packet_crc
+from transport import Transport, Notification, ConnParams, AttOpcodes, ATT_DEFAULT_MTU, ATT_MAX_MTU, LE_MAX_DATA_LENGTH
+
+# Bootloader states
+class States:
+    IDLE              = 0
+    RECEIVE_SIZES     = 1
+    ERASING           = 2
+    RECEIVE_INIT      = 3
+    INIT_DONE         = 4
+    RECEIVE_FW        = 5
+    FW_DONE           = 6
+    VALIDATED         = 7
+    RESET             = 8
+
+# Control point opcodes and response values (see dfu.py Commands)
+OP_START_DFU       = 0x01
+OP_RECEIVE_INIT    = 0x02
+OP_RECEIVE_FW      = 0x03
+OP_VALIDATE        = 0x04
+OP_ACTIVATE_RESET  = 0x05
+OP_SYS_RESET       = 0x06
+OP_IMAGE_SIZE_REQ  = 0x07
+OP_PKT_RCPT_REQ    = 0x08
+OP_RESPONSE        = 0x10
+OP_PKT_RCPT_NOTIF  = 0x11
+
+RSP_SUCCESS        = 0x01
+RSP_INVALID_STATE  = 0x02
+RSP_NOT_SUPPORTED  = 0x03
+RSP_DATA_SIZE      = 0x04
+RSP_CRC_ERROR      = 0x05
+RSP_OPER_FAILED    = 0x06
+
+INIT_RX            = 0x00
+INIT_COMPLETE      = 0x01
+
+IMAGE_SOFTDEVICE   = 0x01
+IMAGE_BOOTLOADER   = 0x02
+IMAGE_APPLICATION  = 0x04
+
+# START_DFU image types taken, with the (SoftDevice, bootloader,
+# application) sizes that must be non-zero for each
+image_parts = {
+    IMAGE_SOFTDEVICE                    : (True,  False, False),
+    IMAGE_BOOTLOADER                    : (False, True,  False),
+    IMAGE_SOFTDEVICE | IMAGE_BOOTLOADER : (True,  True,  False),
+    IMAGE_APPLICATION                   : (False, False, True),
+}
+
+#------------------------------------------------------------------------------
+# Simulated SDK 8 legacy DFU bootloader.
+#------------------------------------------------------------------------------
+class SimulatedBootloader(object):
+
+    ctrlpt_handle      = 0x19
+    ctrlpt_cccd_handle = 0x1a
+    data_handle        = 0x17
+
+    max_image_size     = 0x3b000
+
+    def __init__(self, erase_delay=0.0, supports_image_size=True, att_mtu=ATT_DEFAULT_MTU):
+
+        self.erase_delay = erase_delay
+
+        # The SDK 8 softdevice stays at the default MTU of 23; newer stacks
+        # answer an MTU exchange with up to 247.
+        self.att_mtu = att_mtu
+
+        # Bootloaders built without IMAGE_SIZE_REQ answer it NOT_SUPPORTED,
+        # and drop a partial image when the link goes down.
+        self.supports_image_size = supports_image_size
+
+        # Called as notify(value, delay) for every control point notification.
+        self.notify = None
+
+        # (image type, image) of every activated image, oldest first
+        self.installed = []
+
+        self.reset()
+
+    #--------------------------------------------------------------------------
+    # Power-on state.
+    #--------------------------------------------------------------------------
+    def reset(self):
+        self.state          = States.IDLE
+        self.cccd_enabled   = False
+        self.image_type     = 0
+        self.image_size     = 0
+        self.sizes          = bytearray()
+        self.init_packet    = bytearray()
+        self.init_crc       = None
+        self.image          = bytearray()
+        self.rcpt_interval  = 0
+        self.rcpt_count     = 0
+        self.activated      = False
+
+    #--------------------------------------------------------------------------
+    # Power up after a reset.  Once the SoftDevice or bootloader has been
+    # replaced there is no valid application, so the bootloader stays in
+    # DFU mode and takes the next image.
+    #--------------------------------------------------------------------------
+    def boot(self):
+        if self.state == States.RESET and self.installed and self.installed[-1][0] != IMAGE_APPLICATION:
+            self.reset()
+
+    #--------------------------------------------------------------------------
+    # The host went away.
+    #--------------------------------------------------------------------------
+    def disconnected(self):
+        self.cccd_enabled = False
+        if not self.supports_image_size and self.state != States.RESET:
+            self.reset()
+
+    #--------------------------------------------------------------------------
+    # Send a notification on the control point, if enabled.
+    #--------------------------------------------------------------------------
+    def _notify(self, value, delay=0.0):
+        if self.cccd_enabled and self.notify is not None:
+            self.notify(bytearray(value), delay)
+
+    def _response(self, procedure, status, delay=0.0):
+        self._notify([OP_RESPONSE, procedure, status], delay)
+
+    #--------------------------------------------------------------------------
+    # Entry point for every ATT write from the host.
+    #--------------------------------------------------------------------------
+    def write(self, handle, data):
+
+        data = bytearray(data)
+
+        if handle == self.ctrlpt_cccd_handle:
+            self.cccd_enabled = (len(data) >= 1 and (data[0] & 0x01) != 0)
+
+        elif handle == self.ctrlpt_handle:
+            self._ctrlpt_write(data)
+
+        elif handle == self.data_handle:
+            self._data_write(data)
+
+    #--------------------------------------------------------------------------
+    # A data packet which reached the bootloader but whose payload was
+    # dropped.  It still counts towards the receipt interval, so the next
+    # PKT_RCPT reports the short byte count, as an SDK 8 bootloader does.
+    #--------------------------------------------------------------------------
+    def drop(self, handle, data):
+
+        if handle == self.data_handle and self.state == States.RECEIVE_FW:
+            self.rcpt_count += 1
+            self._receipt_due()
+
+    #--------------------------------------------------------------------------
+    # Control point state machine.
+    #--------------------------------------------------------------------------
+    def _ctrlpt_write(self, data):
+
+        if not data:
+            return
+
+        opcode = data[0]
+
+        if opcode == OP_START_DFU:
+            if self.state != States.IDLE:
+                self._response(OP_START_DFU, RSP_INVALID_STATE)
+                return
+            self.image_type = data[1] if len(data) > 1 else IMAGE_APPLICATION
+            self.sizes = bytearray()
+            self.state = States.RECEIVE_SIZES
+
+        elif opcode == OP_RECEIVE_INIT:
+            option = data[1] if len(data) > 1 else INIT_RX
+            if option == INIT_RX:
+                if self.state != States.ERASING:
+                    self._response(OP_RECEIVE_INIT, RSP_INVALID_STATE)
+                    return
+                self.init_packet = bytearray()
+                self.state = States.RECEIVE_INIT
+            else:
+                if self.state != States.RECEIVE_INIT:
+                    self._response(OP_RECEIVE_INIT, RSP_INVALID_STATE)
+                    return
+                self.init_crc = init_packet_crc(self.init_packet)
+                if self.init_crc is None:
+                    self._response(OP_RECEIVE_INIT, RSP_OPER_FAILED)
+                    return
+                self.state = States.INIT_DONE
+                self._response(OP_RECEIVE_INIT, RSP_SUCCESS)
+
+        elif opcode == OP_PKT_RCPT_REQ:
+            # The packet count restarts whenever the interval is (re)set.
+            if len(data) >= 3:
+                self.rcpt_interval = data[1] | (data[2] << 8)
+            else:
+                self.rcpt_interval = 0
+            self.rcpt_count = 0
+
+        elif opcode == OP_RECEIVE_FW:
+            if self.state != States.INIT_DONE:
+                self._response(OP_RECEIVE_FW, RSP_INVALID_STATE)
+                return
+            self.image = bytearray()
+            self.rcpt_count = 0
+            self.state = States.RECEIVE_FW
+
+        elif opcode == OP_VALIDATE:
+            if self.state != States.FW_DONE:
+                self._response(OP_VALIDATE, RSP_INVALID_STATE)
+                return
+            if crc16_compute(self.image) != self.init_crc:
+                self._response(OP_VALIDATE, RSP_CRC_ERROR)
+                return
+            self.state = States.VALIDATED
+            self._response(OP_VALIDATE, RSP_SUCCESS)
+
+        elif opcode == OP_ACTIVATE_RESET:
+            if self.state != States.VALIDATED:
+                self._response(OP_ACTIVATE_RESET, RSP_INVALID_STATE)
+                return
+            self.activated = True
+            self.installed.append((self.image_type, str(self.image)))
+            self.state = States.RESET
+
+        elif opcode == OP_SYS_RESET:
+            self.state = States.RESET
+
+        elif opcode == OP_IMAGE_SIZE_REQ and self.supports_image_size:
+            self._notify([OP_RESPONSE, OP_IMAGE_SIZE_REQ, RSP_SUCCESS] +
+                         list(bytearray(struct.pack('<I', len(self.image)))))
+
+        else:
+            self._response(opcode, RSP_NOT_SUPPORTED)
+
+    #--------------------------------------------------------------------------
+    # Data (packet) characteristic.
+    #--------------------------------------------------------------------------
+    def _data_write(self, data):
+
+        if self.state == States.RECEIVE_SIZES:
+            self.sizes.extend(data)
+            if len(self.sizes) < 12:
+                return
+            sd_size, bl_size, app_size = struct.unpack('<III', str(self.sizes[:12]))
+            self.image_size = sd_size + bl_size + app_size
+            if self.image_type not in image_parts:
+                self.state = States.IDLE
+                self._response(OP_START_DFU, RSP_NOT_SUPPORTED)
+                return
+            # exactly the parts named by the image type may be non-empty
+            if self.image_size == 0 or self.image_size > self.max_image_size or \
+               image_parts[self.image_type] != (sd_size > 0, bl_size > 0, app_size > 0):
+                self.state = States.IDLE
+                self._response(OP_START_DFU, RSP_DATA_SIZE)
+                return
+            # START response goes out once the flash erase has completed.
+            self.state = States.ERASING
+            self._response(OP_START_DFU, RSP_SUCCESS, self.erase_delay)
+
+        elif self.state == States.RECEIVE_INIT:
+            self.init_packet.extend(data)
+
+        elif self.state == States.RECEIVE_FW:
+            self.image.extend(data)
+            self.rcpt_count += 1
+
+            if len(self.image) >= self.image_size:
+                del self.image[self.image_size:]
+                self.state = States.FW_DONE
+                self._response(OP_RECEIVE_FW, RSP_SUCCESS)
+                return
+
+            self._receipt_due()
+
+    def _receipt_due(self):
+        if self.rcpt_interval and (self.rcpt_count % self.rcpt_interval) == 0:
+            self._notify([OP_PKT_RCPT_NOTIF] +
+                         list(bytearray(struct.pack('<I', len(self.image)))))
+
+    #--------------------------------------------------------------------------
+    # Serve the bootloader over an ATT socket, e.g. the peer end returned by
+    # transport.att_socketpair().  Runs until the socket is closed or the
+    # bootloader resets; meant to be run on its own thread.
+    #--------------------------------------------------------------------------
+    def serve_att(self, sock):
+
+        def send_notify(value, delay):
+            if delay:
+                time.sleep(delay)
+            pdu = bytearray([AttOpcodes.HANDLE_VALUE_NTF,
+                             self.ctrlpt_handle & 0xFF, self.ctrlpt_handle >> 8])
+            pdu.extend(value)
+            sock.send(str(pdu))
+
+        self.notify = send_notify
+
+        while self.state != States.RESET:
+            pdu = bytearray(sock.recv(ATT_MAX_MTU))
+            if not pdu:
+                break
+
+            opcode = pdu[0]
+            handle = pdu[1] | (pdu[2] << 8)
+
+            if opcode == AttOpcodes.MTU_REQ:
+                sock.send(str(bytearray([AttOpcodes.MTU_RSP, self.att_mtu & 0xFF, self.att_mtu >> 8])))
+            elif opcode == AttOpcodes.WRITE_REQ:
+                sock.send(str(bytearray([AttOpcodes.WRITE_RSP])))
+                self.write(handle, pdu[3:])
+            elif opcode == AttOpcodes.WRITE_CMD:
+                self.write(handle, pdu[3:])
+
+        sock.close()
+
+#------------------------------------------------------------------------------
+# Secure DFU control point opcodes, object types and results
+# (see secure_dfu.py SecureCommands)
+#------------------------------------------------------------------------------
+OP_CREATE          = 0x01
+OP_SET_PRN         = 0x02
+OP_CALC_CRC        = 0x03
+OP_EXECUTE         = 0x04
+OP_SELECT          = 0x06
+OP_SECURE_RESPONSE = 0x60
+
+OBJ_COMMAND        = 0x01
+OBJ_DATA           = 0x02
+
+RES_SUCCESS                 = 0x01
+RES_OP_CODE_NOT_SUPPORTED   = 0x02
+RES_INVALID_PARAMETER       = 0x03
+RES_INSUFFICIENT_RESOURCES  = 0x04
+RES_INVALID_OBJECT          = 0x05
+RES_UNSUPPORTED_TYPE        = 0x07
+RES_OPERATION_NOT_PERMITTED = 0x08
+RES_EXT_ERROR               = 0x0b
+
+EXT_VERIFICATION_FAILED     = 0x0c
+
+#------------------------------------------------------------------------------
+# Just enough protobuf for the Secure DFU init packet (dfu-cc.proto):
+# varint and length delimited fields.
+#------------------------------------------------------------------------------
+def _pb_varint(value):
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return out
+
+def _pb_field(number, value):
+    if isinstance(value, (int, long)):
+        return _pb_varint(number << 3) + _pb_varint(value)
+    value = bytearray(value)
+    return _pb_varint((number << 3) | 2) + _pb_varint(len(value)) + value
+
+def _pb_fields(data):
+
+    data   = bytearray(data)
+    fields = {}
+    pos    = 0
+
+    def varint(pos):
+        value, shift = 0, 0
+        while True:
+            byte = data[pos]
+            pos += 1
+            value |= (byte & 0x7f) << shift
+            shift += 7
+            if not byte & 0x80:
+                return value, pos
+
+    while pos < len(data):
+        key, pos = varint(pos)
+        number, wire = key >> 3, key & 0x07
+        if wire == 0:
+            fields[number], pos = varint(pos)
+        elif wire == 2:
+            length, pos = varint(pos)
+            fields[number] = data[pos:pos + length]
+            pos += length
+        else:
+            raise ValueError("unsupported wire type {0}".format(wire))
+
+    return fields
+
+#------------------------------------------------------------------------------
+# Unsigned application init packet for 'firmware', as nrfutil would build
+# it (the SHA-256 hash is stored little endian).
+#------------------------------------------------------------------------------
+def secure_init_packet(firmware, fw_version=1, hw_version=52):
+
+    firmware = str(bytearray(firmware))
+
+    init = (_pb_field(1, fw_version) +
+            _pb_field(2, hw_version) +
+            _pb_field(4, 0) +                               # APPLICATION
+            _pb_field(7, len(firmware)) +
+            _pb_field(8, _pb_field(1, 3) +                  # SHA256
+                         _pb_field(2, hashlib.sha256(firmware).digest()[::-1])))
+
+    command = _pb_field(1, 1) + _pb_field(2, init)          # INIT
+
+    return str(_pb_field(1, command))
+
+#------------------------------------------------------------------------------
+# Simulated Secure DFU bootloader (nRF5 SDK 12 and later).
+#
+# The init packet and the image arrive as objects: each is created, written
+# through the data characteristic, CRC checked by the host and executed.
+# Executed data stays across disconnects, so a host can select the data
+# object and carry on.  'corrupt' is the probability that a data packet is
+# damaged on its way to flash, which only the CRC check can catch.
+#------------------------------------------------------------------------------
+class SimulatedSecureBootloader(SimulatedBootloader):
+
+    ctrlpt_handle      = 0x10
+    ctrlpt_cccd_handle = 0x11
+    data_handle        = 0x0e
+
+    max_object_size    = {OBJ_COMMAND: 256, OBJ_DATA: 4096}
+
+    def __init__(self, execute_delay=0.0, att_mtu=247, corrupt=0.0, seed=None):
+
+        self.execute_delay = execute_delay
+        self.corrupt       = corrupt
+        self.random        = random.Random(seed)
+
+        SimulatedBootloader.__init__(self, att_mtu=att_mtu)
+
+    def reset(self):
+        SimulatedBootloader.reset(self)
+        self.prn           = 0
+        self.current       = None
+        self.init_size     = 0
+        self.init_executed = False
+        self.app_size      = None
+        self.app_hash      = None
+        self.committed     = 0
+        self.object_start  = 0
+        self.object_size   = 0
+        self.corrupted     = 0
+
+    #--------------------------------------------------------------------------
+    # Objects survive the host going away.
+    #--------------------------------------------------------------------------
+    def disconnected(self):
+        self.cccd_enabled = False
+
+    def _secure_response(self, opcode, result, payload=(), delay=0.0):
+        self._notify([OP_SECURE_RESPONSE, opcode, result] + list(bytearray(payload)), delay)
+
+    def _crc_response(self, opcode):
+        if self.current == OBJ_COMMAND:
+            data = self.init_packet
+        else:
+            data = self.image
+        self._secure_response(opcode, RES_SUCCESS,
+                              struct.pack('<II', len(data), zlib.crc32(buffer(data)) & 0xffffffff))
+
+    #--------------------------------------------------------------------------
+    # Control point state machine.
+    #--------------------------------------------------------------------------
+    def _ctrlpt_write(self, data):
+
+        if not data:
+            return
+
+        opcode = data[0]
+
+        if opcode == OP_SELECT and len(data) >= 2:
+            kind = data[1]
+            if kind not in self.max_object_size:
+                self._secure_response(opcode, RES_UNSUPPORTED_TYPE)
+                return
+            self.current = kind
+            if kind == OBJ_COMMAND:
+                held = self.init_packet
+            else:
+                held = self.image
+            self._secure_response(opcode, RES_SUCCESS,
+                                  struct.pack('<III', self.max_object_size[kind], len(held),
+                                              zlib.crc32(buffer(held)) & 0xffffffff))
+
+        elif opcode == OP_CREATE and len(data) >= 6:
+            kind = data[1]
+            size = struct.unpack('<I', str(data[2:6]))[0]
+            if kind not in self.max_object_size:
+                self._secure_response(opcode, RES_UNSUPPORTED_TYPE)
+                return
+            if size == 0 or size > self.max_object_size[kind]:
+                self._secure_response(opcode, RES_INSUFFICIENT_RESOURCES)
+                return
+
+            if kind == OBJ_COMMAND:
+                self.init_packet   = bytearray()
+                self.init_size     = size
+                self.init_executed = False
+            else:
+                if not self.init_executed:
+                    self._secure_response(opcode, RES_OPERATION_NOT_PERMITTED)
+                    return
+                # anything after the last executed object is dropped
+                del self.image[self.committed:]
+                self.object_start = self.committed
+                self.object_size  = size
+
+            self.current    = kind
+            self.rcpt_count = 0
+            self._secure_response(opcode, RES_SUCCESS)
+
+        elif opcode == OP_SET_PRN and len(data) >= 3:
+            self.prn = data[1] | (data[2] << 8)
+            self.rcpt_count = 0
+            self._secure_response(opcode, RES_SUCCESS)
+
+        elif opcode == OP_CALC_CRC:
+            self._crc_response(opcode)
+
+        elif opcode == OP_EXECUTE:
+            if self.current == OBJ_COMMAND:
+                self._execute_command()
+            elif self.current == OBJ_DATA:
+                self._execute_data()
+            else:
+                self._secure_response(opcode, RES_OPERATION_NOT_PERMITTED)
+
+        else:
+            self._secure_response(opcode, RES_OP_CODE_NOT_SUPPORTED)
+
+    def _execute_command(self):
+
+        if self.init_executed:
+            # the same init packet again: keep the image received so far
+            self._secure_response(OP_EXECUTE, RES_SUCCESS)
+            return
+
+        if len(self.init_packet) != self.init_size:
+            self._secure_response(OP_EXECUTE, RES_OPERATION_NOT_PERMITTED)
+            return
+
+        # Packet { command | signed_command { command } }, Command { init }
+        try:
+            packet = _pb_fields(self.init_packet)
+            if 2 in packet:
+                packet = _pb_fields(packet[2])
+            init = _pb_fields(_pb_fields(packet[1])[2])
+            size = init.get(5, 0) + init.get(6, 0) + init.get(7, 0)
+            digest = str(_pb_fields(init[8])[2])
+        except (KeyError, IndexError, ValueError):
+            self._secure_response(OP_EXECUTE, RES_INVALID_OBJECT)
+            return
+
+        if size == 0 or size > self.max_image_size:
+            self._secure_response(OP_EXECUTE, RES_INSUFFICIENT_RESOURCES)
+            return
+
+        self.app_size      = size
+        self.app_hash      = digest
+        self.init_executed = True
+        self.image         = bytearray()
+        self.committed     = 0
+        self._secure_response(OP_EXECUTE, RES_SUCCESS)
+
+    def _execute_data(self):
+
+        received = len(self.image)
+
+        if received == self.committed and received > 0:
+            # already executed
+            self._secure_response(OP_EXECUTE, RES_SUCCESS)
+            return
+
+        if received != self.object_start + self.object_size:
+            self._secure_response(OP_EXECUTE, RES_OPERATION_NOT_PERMITTED)
+            return
+
+        self.committed = received
+
+        if received < self.app_size:
+            self._secure_response(OP_EXECUTE, RES_SUCCESS, delay=self.execute_delay)
+            return
+
+        if hashlib.sha256(str(self.image)).digest()[::-1] != self.app_hash:
+            self._secure_response(OP_EXECUTE, RES_EXT_ERROR, [EXT_VERIFICATION_FAILED])
+            return
+
+        # Image complete and verified: respond, then reset into it.
+        self._secure_response(OP_EXECUTE, RES_SUCCESS, delay=self.execute_delay)
+        self.activated = True
+        self.state = States.RESET
+
+    #--------------------------------------------------------------------------
+    # Data (packet) characteristic.
+    #--------------------------------------------------------------------------
+    def _data_write(self, data):
+
+        if self.current == OBJ_COMMAND:
+            self.init_packet.extend(data[:self.init_size - len(self.init_packet)])
+            return
+
+        if self.current != OBJ_DATA:
+            return
+
+        room = self.object_start + self.object_size - len(self.image)
+        data = data[:max(room, 0)]
+
+        if data and self.corrupt and self.random.random() < self.corrupt:
+            data[self.random.randrange(len(data))] ^= 0xff
+            self.corrupted += 1
+
+        self.image.extend(data)
+        self.rcpt_count += 1
+        self._receipt_due()
+
+    def drop(self, handle, data):
+
+        if handle == self.data_handle and self.current == OBJ_DATA:
+            self.rcpt_count += 1
+            self._receipt_due()
+
+    def _receipt_due(self):
+        # receipt notifications have the CALC_CRC response format
+        if self.prn and (self.rcpt_count % self.prn) == 0:
+            self._crc_response(OP_CALC_CRC)
+
+#------------------------------------------------------------------------------
+# Transport which delivers writes straight to a SimulatedBootloader.
+#
+#   latency  - one-way delay, in seconds, of every packet over the link.
+#              Write requests block for a round trip and notifications
+#              arrive a round trip after the write that caused them.
+#   loss     - probability that the payload of a write command on the data
+#              handle is lost.  The bootloader still counts the packet, so
+#              the loss shows in the byte count of its next receipt.
+#   drop_after - drop the link after this many data packets (None: never).
+#              The bootloader keeps its state, as it would across a
+#              supervision timeout, so a new SimTransport can resume.
+#
+# Link rate model (off when conn_interval is 0):
+#   conn_interval  - connection interval, in seconds.
+#   pkts_per_event - packets the link carries per connection event, so a
+#              packet takes conn_interval / pkts_per_event of air time.
+#   link_loss  - probability that a link layer packet has to be sent again;
+#              unlike 'loss' this only costs air time, as on a real link.
+#   tx_buffers - packets the host stack queues before write_cmd blocks.
+#   min_conn_interval - shortest interval, in seconds, the peripheral
+#              accepts in a connection parameter update.
+#   max_data_length - longest link layer payload the peer accepts; 27
+#              unless both ends support Data Length Extension.  An ATT
+#              packet longer than the data length goes out in fragments.
+#------------------------------------------------------------------------------
+class SimTransport(Transport):
+
+    name = 'sim'
+
+    def __init__(self, bootloader=None, latency=0.0, loss=0.0, seed=None, drop_after=None,
+                 conn_interval=0.0, pkts_per_event=4, link_loss=0.0, tx_buffers=8,
+                 max_data_length=27, min_conn_interval=0.0075):
+
+        if bootloader is None:
+            bootloader = SimulatedBootloader()
+
+        # everything but drop_after carries over to reopen()
+        self.settings = dict(latency=latency, loss=loss, seed=seed,
+                             conn_interval=conn_interval, pkts_per_event=pkts_per_event,
+                             link_loss=link_loss, tx_buffers=tx_buffers,
+                             max_data_length=max_data_length, min_conn_interval=min_conn_interval)
+
+        self.bootloader = bootloader
+        self.latency    = latency
+        self.loss       = loss
+        self.random     = random.Random(seed)
+        self.drop_after = drop_after
+
+        self.conn_interval  = conn_interval
+        self.pkts_per_event = pkts_per_event
+        self.packet_time    = conn_interval / float(pkts_per_event) if conn_interval else 0.0
+        self.link_loss     = link_loss
+        self.tx_buffers    = tx_buffers
+
+        self.mtu             = ATT_DEFAULT_MTU
+        self.data_length     = 27
+        self.max_data_length = max_data_length
+
+        self.min_conn_interval = min_conn_interval
+
+        # time at which the link will have sent everything queued so far
+        self.link_time = 0.0
+        self.link_retransmits = 0
+
+        self.connected  = False
+        self.cond       = threading.Condition()
+        self.queue      = []
+        self.sequence   = 0
+
+        self.packets_sent = 0
+        self.packets_lost = 0
+
+        bootloader.notify = self._on_notify
+
+    #--------------------------------------------------------------------------
+    # Queue a notification from the bootloader for delivery to the host.
+    #--------------------------------------------------------------------------
+    def _on_notify(self, value, delay):
+        with self.cond:
+            deliver_at = max(time.time(), self.link_time) + delay + 2 * self.latency
+            heapq.heappush(self.queue, (deliver_at, self.sequence, value))
+            self.sequence += 1
+            self.cond.notify_all()
+
+    #--------------------------------------------------------------------------
+    # Account for one data packet's air time; blocks once the host's
+    # transmit buffers are full, as the real stack does.
+    #--------------------------------------------------------------------------
+    def _link_send(self, size):
+
+        now = time.time()
+
+        # ATT and L2CAP headers on top of the payload
+        slots = int(math.ceil((size + 7) / float(self.data_length)))
+        while self.link_loss and self.random.random() < self.link_loss:
+            slots += 1
+        self.link_retransmits += slots - 1
+
+        self.link_time = max(self.link_time, now) + slots * self.packet_time
+
+        backlog = self.link_time - now - self.tx_buffers * self.packet_time
+        if backlog > 0:
+            time.sleep(backlog)
+
+    def connect(self):
+        self.bootloader.boot()
+        self.connected = self.bootloader.state != States.RESET
+        self.mtu = ATT_DEFAULT_MTU
+        self.data_length = 27
+        return self.connected
+
+    def exchange_mtu(self, mtu):
+
+        if not self.connected:
+            raise Exception('Connection Lost: link down')
+
+        if self.latency or self.conn_interval:
+            time.sleep(2 * self.latency + self.conn_interval)
+
+        self.mtu = max(ATT_DEFAULT_MTU, min(mtu, self.bootloader.att_mtu))
+        return self.mtu
+
+    def set_data_length(self, octets):
+        self.data_length = max(27, min(octets, self.max_data_length))
+        return min(octets, LE_MAX_DATA_LENGTH)
+
+    #--------------------------------------------------------------------------
+    # Grant the requested interval, or the peripheral's minimum if that is
+    # longer, from an instant six connection events on.  Only the link rate
+    # model is affected; with it off the grant is reported and nothing else.
+    #--------------------------------------------------------------------------
+    def update_conn_params(self, interval_min, interval_max, latency, timeout):
+
+        if not self.connected:
+            raise Exception('Connection Lost: link down')
+
+        units = int(math.ceil(max(interval_min, self.min_conn_interval * 1000) / 1.25 - 1e-9))
+        interval = units * 1.25
+
+        if self.conn_interval:
+            time.sleep(6 * self.conn_interval)
+            self.conn_interval = interval / 1000.0
+            self.packet_time   = self.conn_interval / self.pkts_per_event
+
+        return ConnParams(interval, latency, timeout)
+
+    def _check_size(self, data):
+        if len(data) > self.mtu - 3:
+            raise Exception("{0} byte write exceeds ATT MTU {1}".format(len(data), self.mtu))
+
+    def write_req(self, handle, data):
+
+        if not self.connected or self.bootloader.state == States.RESET:
+            raise Exception('Connection Lost: link down')
+
+        self._check_size(data)
+
+        # queued packets go first, then a connection event each way
+        wait = 2 * self.latency + self.conn_interval
+        if self.packet_time:
+            wait += max(self.link_time - time.time(), 0.0)
+        if wait:
+            time.sleep(wait)
+
+        self.bootloader.write(handle, data)
+        return True
+
+    def write_cmd(self, handle, data):
+
+        if not self.connected or self.bootloader.state == States.RESET:
+            return
+
+        self._check_size(data)
+
+        self.packets_sent += 1
+
+        if self.packet_time:
+            self._link_send(len(data))
+
+        if self.drop_after is not None and handle == self.bootloader.data_handle:
+            if self.drop_after <= 0:
+                self.disconnect()
+                return
+            self.drop_after -= 1
+
+        if self.loss and handle == self.bootloader.data_handle:
+            if self.random.random() < self.loss:
+                self.packets_lost += 1
+                self.bootloader.drop(handle, data)
+                return
+
+        self.bootloader.write(handle, data)
+
+    #--------------------------------------------------------------------------
+    # All notifications come from the control point; waiting on any other
+    # handle just times out.
+    #--------------------------------------------------------------------------
+    def wait_notify(self, timeout=30, handle=None):
+
+        deadline = time.time() + timeout
+        ctrlpt   = handle is None or handle == self.bootloader.ctrlpt_handle
+
+        with self.cond:
+            while True:
+                now = time.time()
+
+                if ctrlpt and self.queue and self.queue[0][0] <= now:
+                    value = heapq.heappop(self.queue)[2]
+                    return Notification(self.bootloader.ctrlpt_handle, value, now)
+
+                if not self.connected or self.bootloader.state == States.RESET:
+                    raise Exception('Connection Lost: link down')
+
+                if now >= deadline:
+                    return None
+
+                wait = deadline - now
+                if ctrlpt and self.queue:
+                    wait = min(wait, self.queue[0][0] - now)
+                self.cond.wait(wait)
+
+    def reopen(self):
+        return SimTransport(self.bootloader, **self.settings)
+
+    def disconnect(self):
+        with self.cond:
+            if self.connected:
+                self.bootloader.disconnected()
+            self.connected = False
+            self.cond.notify_all()
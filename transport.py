@@ -0,0 +1,1027 @@
+#!/usr/bin/env python
+#------------------------------------------------------------------------------
+# GATT transports for the DFU server.
+#
+# A transport carries ATT writes to the peripheral and hands back the
+# notifications it sends.  Two are provided:
+#
+#   GatttoolTransport - drives "gatttool --interactive" through pexpect.
+#   AttSocketTransport - speaks ATT directly over a Bluetooth LE L2CAP socket
+#                        (fixed channel 4), no text round trip involved.
+#------------------------------------------------------------------------------
+import os
+import re
+import time
+import errno
+import fcntl
+import Queue
+import socket
+import select
+import struct
+import ctypes
+import ctypes.util
+import threading
+import subprocess
+import pexpect
+
+from binascii    import hexlify, unhexlify
+from collections import deque, namedtuple
+
+#------------------------------------------------------------------------------
+# Convert a "XX:XX:XX:XX:XX:XX" address string into a bdaddr_t (LSB first).
+#------------------------------------------------------------------------------
+def str_to_bdaddr(address):
+    octets = [int(x, 16) for x in address.split(':')]
+    if len(octets) != 6:
+        raise Exception("invalid bluetooth address: {0}".format(address))
+    octets.reverse()
+    return octets
+
+#------------------------------------------------------------------------------
+# A notification (or indication) from the peripheral.
+#   handle - ATT attribute handle (int)
+#   value  - bytearray
+#   time   - arrival time, time.time()
+#------------------------------------------------------------------------------
+Notification = namedtuple('Notification', 'handle value time')
+
+#------------------------------------------------------------------------------
+# Connection parameters granted by the controller.
+#   interval - connection interval, ms
+#   latency  - slave latency, connection events
+#   timeout  - supervision timeout, ms
+#------------------------------------------------------------------------------
+ConnParams = namedtuple('ConnParams', 'interval latency timeout')
+
+#------------------------------------------------------------------------------
+# Notifications parsed by a transport's reader thread, queued per handle
+# until the session asks for them.  Nothing that arrives early is lost.
+#------------------------------------------------------------------------------
+class NotifyDispatcher(object):
+
+    def __init__(self):
+        self.cond   = threading.Condition()
+        self.queues = {}
+        self.closed = None
+
+    #--------------------------------------------------------------------------
+    # Queue a notification (called from the reader thread).
+    #--------------------------------------------------------------------------
+    def post(self, handle, value):
+        with self.cond:
+            queue = self.queues.get(handle)
+            if queue is None:
+                queue = self.queues[handle] = deque()
+            queue.append(Notification(handle, value, time.time()))
+            self.cond.notify_all()
+
+    #--------------------------------------------------------------------------
+    # The link is gone: wake every waiter.  Notifications already queued
+    # are still handed out before get() starts raising.
+    #--------------------------------------------------------------------------
+    def close(self, reason='Connection Lost'):
+        with self.cond:
+            if self.closed is None:
+                self.closed = reason
+            self.cond.notify_all()
+
+    def _pop(self, handle):
+        if handle is not None:
+            queue = self.queues.get(handle)
+            if queue:
+                return queue.popleft()
+            return None
+
+        # any handle: the oldest notification
+        heads = [queue for queue in self.queues.values() if queue]
+        if not heads:
+            return None
+        return min(heads, key=lambda queue: queue[0].time).popleft()
+
+    #--------------------------------------------------------------------------
+    # Next notification on 'handle' (any handle if None).  Returns None on
+    # timeout and raises Exception(reason) once the link is closed.
+    #--------------------------------------------------------------------------
+    def get(self, handle=None, timeout=30):
+
+        deadline = time.time() + timeout
+
+        with self.cond:
+            while True:
+                notify = self._pop(handle)
+                if notify is not None:
+                    return notify
+
+                if self.closed is not None:
+                    raise Exception(self.closed)
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self.cond.wait(remaining)
+
+#------------------------------------------------------------------------------
+# Interface every transport provides to BleDfuServer.
+# Handles are ATT attribute handles; data is any sequence of byte values.
+#------------------------------------------------------------------------------
+class Transport(object):
+
+    name = None
+
+    #--------------------------------------------------------------------------
+    # Bring up the link.  Returns True once connected.
+    #--------------------------------------------------------------------------
+    def connect(self):
+        raise NotImplementedError
+
+    #--------------------------------------------------------------------------
+    # Write with response.  Returns False if the write was not acknowledged,
+    # raises Exception('Connection Lost: <reason>') if the link is down.
+    #--------------------------------------------------------------------------
+    def write_req(self, handle, data):
+        raise NotImplementedError
+
+    #--------------------------------------------------------------------------
+    # Write without response.
+    #--------------------------------------------------------------------------
+    def write_cmd(self, handle, data):
+        raise NotImplementedError
+
+    #--------------------------------------------------------------------------
+    # Encode a write command ahead of time; write_encoded() then sends it.
+    # Transports with a wire format of their own override both, so that a
+    # packet plan can be encoded once and replayed without per-packet work.
+    #--------------------------------------------------------------------------
+    def encode_cmd(self, handle, data):
+        return handle, data
+
+    def write_encoded(self, wire):
+        self.write_cmd(*wire)
+
+    #--------------------------------------------------------------------------
+    # Wait for the next notification on 'handle' (any handle if None).
+    # Returns a Notification, None on timeout, and raises
+    # Exception('Connection Lost: <reason>') as soon as the link drops.
+    #--------------------------------------------------------------------------
+    def wait_notify(self, timeout=30, handle=None):
+        raise NotImplementedError
+
+    #--------------------------------------------------------------------------
+    # Negotiate the ATT MTU, asking for up to 'mtu' bytes.  Returns the MTU
+    # in effect afterwards; it stays at 23 if the peer (or the transport)
+    # cannot exchange it.
+    #--------------------------------------------------------------------------
+    def exchange_mtu(self, mtu):
+        return ATT_DEFAULT_MTU
+
+    #--------------------------------------------------------------------------
+    # Ask the controller to carry up to 'octets' bytes per link layer packet
+    # (LE Data Length Extension), so an ATT packet above 27 bytes is not
+    # split over several.  Returns the octets requested if the controller
+    # accepted the request, None if it could not be made.
+    #--------------------------------------------------------------------------
+    def set_data_length(self, octets):
+        return None
+
+    #--------------------------------------------------------------------------
+    # Ask for new connection parameters: interval range and supervision
+    # timeout in ms, slave latency in connection events.  Returns the
+    # ConnParams the link runs with afterwards, or None if they could not
+    # be requested or the change was not confirmed.
+    #--------------------------------------------------------------------------
+    def update_conn_params(self, interval_min, interval_max, latency, timeout):
+        return None
+
+    #--------------------------------------------------------------------------
+    # Wait for the peer to drop the link, e.g. when it resets.  Anything
+    # notified meanwhile is discarded.  Returns False on timeout.
+    #--------------------------------------------------------------------------
+    def wait_disconnect(self, timeout=10):
+
+        deadline = time.time() + timeout
+
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            try:
+                self.wait_notify(remaining)
+            except Exception, e:
+                if str(e).startswith('Connection Lost'):
+                    return True
+                raise
+
+    #--------------------------------------------------------------------------
+    # A new, unconnected transport to the same peer, for connecting again
+    # after the peer has reset; a transport is not reused once its link is
+    # down.
+    #--------------------------------------------------------------------------
+    def reopen(self):
+        raise NotImplementedError
+
+    #--------------------------------------------------------------------------
+    # Tear down the link and release the adapter.
+    #--------------------------------------------------------------------------
+    def disconnect(self):
+        raise NotImplementedError
+
+#------------------------------------------------------------------------------
+# Drive bluez gatttool in interactive mode.
+#
+# Once connected, a reader thread owns gatttool's output: it splits it into
+# lines as it arrives and turns them into notifications (posted to the
+# dispatcher), write acknowledgements and link state.  Senders only ever
+# write to gatttool.
+#
+# gatttool does not announce a dropped link; its prompt just changes from
+# '[CON]' to '[   ]' the next time it is drawn.  While a session waits, an
+# empty line is sent every probe_interval seconds to get the prompt redrawn,
+# so link loss is noticed within about one supervision timeout.
+#------------------------------------------------------------------------------
+class GatttoolTransport(Transport):
+
+    name = 'gatttool'
+
+    probe_interval = 1.0
+
+    # "Notification handle = 0x0019 value: 10 01 01"
+    notify_re  = re.compile(r'(?:Notification|Indication)\s+handle = 0x([0-9a-fA-F]+) value: ([0-9a-fA-F ]*)')
+    written_re = re.compile(r'Characteristic value was written successfully')
+    failed_re  = re.compile(r'Characteristic Write Request failed')
+    lost_re    = re.compile(r'Invalid file descriptor|Disconnected|Connection reset')
+    mtu_re     = re.compile(r'MTU was exchanged successfully: (\d+)')
+    mtu_err_re = re.compile(r'Exchange MTU Request failed|Error exchanging MTU|MTU exchange can only occur once|Minimum MTU size')
+
+    def __init__(self, target_mac, addr_type='random', adapter=None):
+
+        self.target_mac = target_mac
+        self.addr_type  = addr_type
+        self.adapter    = adapter
+        self.mtu        = ATT_DEFAULT_MTU
+
+        command = "gatttool -b '%s' -t %s --interactive" % (target_mac, addr_type)
+        if adapter:
+            command += " -i %s" % adapter
+
+        self.ble_conn = pexpect.spawn(command)
+
+        # pexpect sleeps 50ms before every send by default; the reader thread
+        # keeps up with gatttool's output, so packets can go out back to back.
+        self.ble_conn.delaybeforesend = None
+
+        # remove next line comment for pexpect detail tracing.
+        #self.ble_conn.logfile = sys.stdout
+
+        self.dispatcher = NotifyDispatcher()
+        self.reader     = None
+        self.running    = False
+
+        # write acknowledgements seen by the reader: (written, failed)
+        self.acks      = [0, 0]
+        self.acks_cond = threading.Condition()
+
+        # outcome of an 'mtu' command: the MTU, or 0 if it failed
+        self.mtu_reply = None
+
+    #--------------------------------------------------------------------------
+    # Connect to peripheral device.
+    #--------------------------------------------------------------------------
+    def connect(self):
+
+        try:
+            self.ble_conn.expect('\[LE\]>', timeout=10)
+        except pexpect.TIMEOUT, e:
+            print "Connect timeout"
+
+        self.ble_conn.sendline('connect')
+
+        try:
+            res = self.ble_conn.expect('\[CON\].*>', timeout=10)
+        except pexpect.TIMEOUT, e:
+            print "Connect timeout"
+            return False
+
+        self.running = True
+        self.reader = threading.Thread(target=self._read_loop,
+                                       name="gatttool-{0}".format(self.target_mac))
+        self.reader.daemon = True
+        self.reader.start()
+
+        return True
+
+    #--------------------------------------------------------------------------
+    # Reader thread: consume gatttool output line by line.
+    #--------------------------------------------------------------------------
+    def _read_loop(self):
+
+        # whatever expect() had already read past the connect prompt
+        partial = self.ble_conn.buffer
+        self.ble_conn.buffer = ''
+
+        while self.running:
+            try:
+                chunk = self.ble_conn.read_nonblocking(4096, timeout=0.5)
+            except pexpect.TIMEOUT:
+                continue
+            except (pexpect.EOF, OSError, ValueError):
+                if self.running:
+                    self._link_lost("gatttool exited")
+                break
+
+            lines = (partial + chunk).split('\n')
+            partial = lines.pop()
+
+            # A bare prompt has no newline; look at it straight away.
+            if '[   ]' in partial:
+                self._link_lost("link down")
+
+            for line in lines:
+                self._parse_line(line)
+
+        self.dispatcher.close()
+
+    #--------------------------------------------------------------------------
+    # Handle one line of gatttool output.
+    #--------------------------------------------------------------------------
+    def _parse_line(self, line):
+
+        match = self.notify_re.search(line)
+        if match:
+            self.dispatcher.post(int(match.group(1), 16),
+                                 bytearray(unhexlify(match.group(2).replace(' ', ''))))
+            return
+
+        if self.written_re.search(line):
+            self._ack(0)
+        elif self.failed_re.search(line):
+            self._ack(1)
+        elif self.mtu_re.search(line):
+            self._mtu_reply(int(self.mtu_re.search(line).group(1)))
+        elif self.mtu_err_re.search(line):
+            self._mtu_reply(0)
+        elif '[   ]' in line:
+            self._link_lost("link down")
+        elif self.lost_re.search(line):
+            self._link_lost(line.strip())
+
+    def _ack(self, index):
+        with self.acks_cond:
+            self.acks[index] += 1
+            self.acks_cond.notify_all()
+
+    def _mtu_reply(self, mtu):
+        with self.acks_cond:
+            self.mtu_reply = mtu
+            self.acks_cond.notify_all()
+
+    def _link_lost(self, reason):
+        if self.dispatcher.closed is None:
+            print 'Connection lost! {0}.{1}'.format(self.target_mac, os.getpid())
+        self.dispatcher.close('Connection Lost: {0}'.format(reason))
+        with self.acks_cond:
+            self.acks_cond.notify_all()
+
+    #--------------------------------------------------------------------------
+    # Write with response.  Returns False if the write was not acknowledged.
+    #--------------------------------------------------------------------------
+    def write_req(self, handle, data):
+
+        if self.dispatcher.closed:
+            raise Exception(self.dispatcher.closed)
+
+        with self.acks_cond:
+            written, failed = self.acks
+
+        self.ble_conn.sendline('char-write-req 0x%04x %s' % (handle, hexlify(bytearray(data))))
+
+        # Verify that value was successfully written
+        deadline = time.time() + 10
+        with self.acks_cond:
+            while self.acks[0] == written:
+                if self.dispatcher.closed:
+                    raise Exception(self.dispatcher.closed)
+                remaining = deadline - time.time()
+                if self.acks[1] != failed or remaining <= 0:
+                    return False
+                self.acks_cond.wait(min(remaining, self.probe_interval))
+
+        return True
+
+    #--------------------------------------------------------------------------
+    # Exchange the MTU with gatttool's 'mtu' command.
+    #--------------------------------------------------------------------------
+    def exchange_mtu(self, mtu):
+
+        if self.dispatcher.closed:
+            raise Exception(self.dispatcher.closed)
+
+        with self.acks_cond:
+            self.mtu_reply = None
+
+        self.ble_conn.sendline('mtu %d' % mtu)
+
+        deadline = time.time() + 10
+        with self.acks_cond:
+            while self.mtu_reply is None:
+                if self.dispatcher.closed:
+                    raise Exception(self.dispatcher.closed)
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.acks_cond.wait(min(remaining, self.probe_interval))
+
+            if self.mtu_reply:
+                self.mtu = self.mtu_reply
+
+        return self.mtu
+
+    def set_data_length(self, octets):
+        return hci_set_data_length(self.adapter, self.target_mac, octets)
+
+    def update_conn_params(self, interval_min, interval_max, latency, timeout):
+        return hci_update_conn_params(self.adapter, self.target_mac,
+                                      interval_min, interval_max, latency, timeout)
+
+    #--------------------------------------------------------------------------
+    # Write without response.
+    #--------------------------------------------------------------------------
+    def write_cmd(self, handle, data):
+        self.ble_conn.sendline(self.encode_cmd(handle, data))
+
+    def encode_cmd(self, handle, data):
+        return 'char-write-cmd 0x%04x %s' % (handle, hexlify(bytearray(data)))
+
+    def write_encoded(self, wire):
+        self.ble_conn.sendline(wire)
+
+    #--------------------------------------------------------------------------
+    # Wait for notification to arrive.
+    #--------------------------------------------------------------------------
+    def wait_notify(self, timeout=30, handle=None):
+
+        deadline = time.time() + timeout
+
+        while True:
+            remaining = deadline - time.time()
+            notify = self.dispatcher.get(handle, max(0, min(remaining, self.probe_interval)))
+            if notify is not None or remaining <= self.probe_interval:
+                return notify
+
+            # Quiet for a while: have gatttool redraw its prompt, which
+            # tells the reader whether the link is still up.
+            self.ble_conn.sendline('')
+
+    def reopen(self):
+        return GatttoolTransport(self.target_mac, self.addr_type, self.adapter)
+
+    #--------------------------------------------------------------------------
+    # Leave gatttool and release the adapter.
+    #--------------------------------------------------------------------------
+    def disconnect(self):
+        self.running = False
+        try:
+            self.ble_conn.sendline('exit')
+        except OSError:
+            pass
+        if self.reader is not None:
+            self.reader.join(2)
+        self.ble_conn.close()
+        self.dispatcher.close()
+
+#------------------------------------------------------------------------------
+# L2CAP socket constants (from bluez lib/bluetooth.h and lib/l2cap.h).
+# Not every python build exposes AF_BLUETOOTH, so they are spelled out here.
+#------------------------------------------------------------------------------
+AF_BLUETOOTH     = 31
+BTPROTO_L2CAP    = 0
+BTPROTO_HCI      = 1
+
+HCIGETDEVINFO    = 0x800448d3    # _IOR('H', 211, int)
+
+BDADDR_BREDR     = 0x00
+BDADDR_LE_PUBLIC = 0x01
+BDADDR_LE_RANDOM = 0x02
+
+ATT_CID          = 4
+ATT_DEFAULT_MTU  = 23
+ATT_MAX_MTU      = 517
+
+class sockaddr_l2(ctypes.Structure):
+    _fields_ = [
+        ('l2_family',      ctypes.c_ushort),
+        ('l2_psm',         ctypes.c_ushort),
+        ('l2_bdaddr',      ctypes.c_uint8 * 6),
+        ('l2_cid',         ctypes.c_ushort),
+        ('l2_bdaddr_type', ctypes.c_uint8),
+    ]
+
+# ATT opcodes (Bluetooth Core Spec, Vol 3, Part F, 3.4)
+class AttOpcodes:
+    ERROR_RSP         = 0x01
+    MTU_REQ           = 0x02
+    MTU_RSP           = 0x03
+    WRITE_REQ         = 0x12
+    WRITE_RSP         = 0x13
+    WRITE_CMD         = 0x52
+    HANDLE_VALUE_NTF  = 0x1b
+    HANDLE_VALUE_IND  = 0x1d
+    HANDLE_VALUE_CFM  = 0x1e
+
+ATT_ECODE_REQ_NOT_SUPP = 0x06
+
+#------------------------------------------------------------------------------
+# List local controllers (hci0, hci1, ...) in index order.
+#------------------------------------------------------------------------------
+def find_adapters(sysfs='/sys/class/bluetooth'):
+    try:
+        names = [name for name in os.listdir(sysfs) if re.match(r'^hci\d+$', name)]
+    except OSError:
+        return []
+    return sorted(names, key=lambda name: int(name[3:]))
+
+#------------------------------------------------------------------------------
+# Look up the bluetooth address of a local controller ("hciN").
+#------------------------------------------------------------------------------
+def adapter_address(adapter):
+
+    dev_id = int(adapter[3:])
+
+    # struct hci_dev_info: dev_id, name[8], bdaddr, ... (92 bytes)
+    info = bytearray(struct.pack('<H', dev_id) + '\0' * 90)
+
+    sock = socket.socket(AF_BLUETOOTH, socket.SOCK_RAW, BTPROTO_HCI)
+    try:
+        fcntl.ioctl(sock.fileno(), HCIGETDEVINFO, info, True)
+    finally:
+        sock.close()
+
+    return ':'.join('%02X' % octet for octet in reversed(info[10:16]))
+
+#------------------------------------------------------------------------------
+# HCI commands for link settings neither gatttool nor the L2CAP socket can
+# reach are sent with hcitool; events they lead to are read from a raw HCI
+# socket.  Both need CAP_NET_RAW (usually root).
+#------------------------------------------------------------------------------
+OGF_LE_CTL               = 0x08
+OCF_LE_CONN_UPDATE       = 0x0013
+OCF_LE_SET_DATA_LENGTH   = 0x0022
+
+SOL_HCI                  = 0
+HCI_FILTER               = 2
+HCI_CHANNEL_RAW          = 0
+HCI_EVENT_PKT            = 0x04
+EVT_LE_META_EVENT        = 0x3e
+EVT_LE_CONN_UPDATE_COMPLETE = 0x03
+
+LE_MAX_DATA_LENGTH       = 251
+
+# "> HCI Event: 0x0e plen 6\n  01 22 20 00 40 00"
+hci_event_re = re.compile(r'HCI Event: 0x(0e|0f) plen \d+\s+((?:[0-9a-fA-F]{2}\s+)+)')
+
+def _hcitool(adapter, args):
+    command = ['hcitool']
+    if adapter and adapter.startswith('hci'):
+        command += ['-i', adapter]
+    try:
+        return subprocess.check_output(command + args, stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+#------------------------------------------------------------------------------
+# Handle of the LE connection to 'address', or None if there is none.
+#------------------------------------------------------------------------------
+def hci_connection_handle(adapter, address):
+
+    output = _hcitool(adapter, ['con'])
+    if output is None:
+        return None
+
+    # "< LE CD:E3:4A:47:1C:E4 handle 64 state 1 lm MASTER"
+    match = re.search(r'LE\s+{0}\s+handle\s+(\d+)'.format(re.escape(address)), output, re.IGNORECASE)
+    if match is None:
+        return None
+    return int(match.group(1))
+
+#------------------------------------------------------------------------------
+# Send an HCI command.  Returns its status (0 is success) followed by any
+# return parameters, as a bytearray, or None if it could not be sent.
+#------------------------------------------------------------------------------
+def hci_command(adapter, ogf, ocf, params):
+
+    output = _hcitool(adapter, ['cmd', '0x%02x' % ogf, '0x%04x' % ocf] +
+                               ['0x%02x' % octet for octet in bytearray(params)])
+    if output is None:
+        return None
+
+    match = hci_event_re.search(output)
+    if match is None:
+        return None
+
+    event = bytearray(unhexlify(''.join(match.group(2).split())))
+
+    if match.group(1) == '0e':
+        # Command Complete: ncmd, opcode, return parameters
+        return event[3:]
+    # Command Status: status, ncmd, opcode
+    return event[:1]
+
+class sockaddr_hci(ctypes.Structure):
+    _fields_ = [
+        ('hci_family',  ctypes.c_ushort),
+        ('hci_dev',     ctypes.c_ushort),
+        ('hci_channel', ctypes.c_ushort),
+    ]
+
+#------------------------------------------------------------------------------
+# Raw HCI socket on 'adapter' receiving LE meta events, or None if it
+# cannot be opened.
+#------------------------------------------------------------------------------
+def _hci_event_socket(adapter):
+
+    dev_id = 0
+    if adapter and adapter.startswith('hci'):
+        dev_id = int(adapter[3:])
+
+    try:
+        sock = socket.socket(AF_BLUETOOTH, socket.SOCK_RAW, BTPROTO_HCI)
+    except socket.error:
+        return None
+
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+    local = sockaddr_hci(AF_BLUETOOTH, dev_id, HCI_CHANNEL_RAW)
+    if libc.bind(sock.fileno(), ctypes.byref(local), ctypes.sizeof(local)) < 0:
+        sock.close()
+        return None
+
+    # struct hci_filter: type mask, event mask, opcode
+    sock.setsockopt(SOL_HCI, HCI_FILTER, struct.pack('<IIIHxx', 1 << HCI_EVENT_PKT,
+                                                     0, 1 << (EVT_LE_META_EVENT - 32), 0))
+    return sock
+
+#------------------------------------------------------------------------------
+# LE Connection Update on the connection to 'address' (see
+# Transport.update_conn_params).  The controller applies the change some
+# connection events later and reports what it settled on in an LE
+# Connection Update Complete event, which is waited for up to 'wait'
+# seconds.
+#------------------------------------------------------------------------------
+def hci_update_conn_params(adapter, address, interval_min, interval_max, latency, timeout, wait=2.0):
+
+    handle = hci_connection_handle(adapter, address)
+    if handle is None:
+        return None
+
+    # listen before asking, so the event cannot slip past
+    sock = _hci_event_socket(adapter)
+    if sock is None:
+        return None
+
+    try:
+        # intervals in 1.25 ms units, timeout in 10 ms units
+        params = struct.pack('<HHHHHHH', handle,
+                             int(round(interval_min / 1.25)), int(round(interval_max / 1.25)),
+                             latency, int(timeout / 10), 0, 0)
+
+        result = hci_command(adapter, OGF_LE_CTL, OCF_LE_CONN_UPDATE, params)
+        if not result or result[0] != 0:
+            return None
+
+        deadline = time.time() + wait
+
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+
+            readable, _, _ = select.select([sock], [], [], remaining)
+            if not readable:
+                return None
+
+            # packet type, event code, length, subevent, status, handle,
+            # interval, latency, supervision timeout
+            event = bytearray(sock.recv(260))
+            if len(event) < 13 or event[1] != EVT_LE_META_EVENT or event[3] != EVT_LE_CONN_UPDATE_COMPLETE:
+                continue
+
+            status, event_handle, interval, event_latency, supervision = \
+                struct.unpack('<BHHHH', str(event[4:13]))
+            if (event_handle & 0x0fff) != handle:
+                continue
+            if status != 0:
+                return None
+
+            return ConnParams(interval * 1.25, event_latency, supervision * 10)
+
+    finally:
+        sock.close()
+
+#------------------------------------------------------------------------------
+# LE Set Data Length on the connection to 'address'.  Returns 'octets' if
+# the controller accepted it, None otherwise.  The peer may still grant
+# less; the controller settles that between the two link layers.
+#------------------------------------------------------------------------------
+def hci_set_data_length(adapter, address, octets):
+
+    handle = hci_connection_handle(adapter, address)
+    if handle is None:
+        return None
+
+    octets = min(octets, LE_MAX_DATA_LENGTH)
+    tx_time = (octets + 14) * 8     # microseconds on the 1M PHY
+
+    result = hci_command(adapter, OGF_LE_CTL, OCF_LE_SET_DATA_LENGTH,
+                         struct.pack('<HHH', handle, octets, tx_time))
+    if not result or result[0] != 0:
+        return None
+    return octets
+
+#------------------------------------------------------------------------------
+# Talk ATT directly over an LE L2CAP socket bound to the ATT fixed channel.
+#------------------------------------------------------------------------------
+class AttSocketTransport(Transport):
+
+    name = 'att'
+
+    # MTU offered when the peer starts the exchange
+    max_mtu = 247
+
+    def __init__(self, target_mac=None, addr_type='random', adapter=None, sock=None):
+
+        self.target_mac   = target_mac
+        self.addr_type    = addr_type
+        self.adapter      = adapter
+        self.sock         = sock
+        self.mtu          = ATT_DEFAULT_MTU
+
+        # a socket handed in (e.g. by att_socketpair) cannot be opened again
+        self.reopenable   = sock is None
+
+        # The reader thread posts notifications to the dispatcher and
+        # responses to our requests to 'responses'.
+        self.dispatcher = NotifyDispatcher()
+        self.responses  = Queue.Queue()
+        self.reader     = None
+        self.running    = False
+
+    #--------------------------------------------------------------------------
+    # Open and connect the L2CAP socket.  libc is called through ctypes
+    # since the socket module has no notion of LE address types or CIDs.
+    #--------------------------------------------------------------------------
+    def connect(self):
+
+        if self.sock is None:
+            self.sock = self._open_socket()
+            if self.sock is None:
+                return False
+
+        if self.reader is None:
+            self.running = True
+            self.reader = threading.Thread(target=self._read_loop,
+                                           name="att-{0}".format(self.target_mac))
+            self.reader.daemon = True
+            self.reader.start()
+
+        return True
+
+    def _open_socket(self):
+
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+        sock = socket.socket(AF_BLUETOOTH, socket.SOCK_SEQPACKET, BTPROTO_L2CAP)
+
+        local = sockaddr_l2()
+        local.l2_family = AF_BLUETOOTH
+        local.l2_cid = ATT_CID
+        local.l2_bdaddr_type = BDADDR_LE_PUBLIC
+        if self.adapter:
+            # either a controller name ("hci1") or its address
+            if self.adapter.startswith('hci'):
+                local.l2_bdaddr[:] = str_to_bdaddr(adapter_address(self.adapter))
+            else:
+                local.l2_bdaddr[:] = str_to_bdaddr(self.adapter)
+
+        if libc.bind(sock.fileno(), ctypes.byref(local), ctypes.sizeof(local)) < 0:
+            err = ctypes.get_errno()
+            sock.close()
+            raise Exception("L2CAP bind failed: {0}".format(os.strerror(err)))
+
+        remote = sockaddr_l2()
+        remote.l2_family = AF_BLUETOOTH
+        remote.l2_cid = ATT_CID
+        remote.l2_bdaddr[:] = str_to_bdaddr(self.target_mac)
+        if self.addr_type == 'public':
+            remote.l2_bdaddr_type = BDADDR_LE_PUBLIC
+        else:
+            remote.l2_bdaddr_type = BDADDR_LE_RANDOM
+
+        if libc.connect(sock.fileno(), ctypes.byref(remote), ctypes.sizeof(remote)) < 0:
+            err = ctypes.get_errno()
+            sock.close()
+            print "Connect failed: {0}".format(os.strerror(err))
+            return None
+
+        return sock
+
+    #--------------------------------------------------------------------------
+    # Reader thread: receive PDUs as they arrive and route them.
+    #--------------------------------------------------------------------------
+    def _read_loop(self):
+
+        sock   = self.sock
+        reason = "closed"
+
+        while self.running:
+            try:
+                readable, _, _ = select.select([sock], [], [], 0.5)
+                if not readable:
+                    continue
+                pdu = sock.recv(ATT_MAX_MTU)
+            except (socket.error, select.error), e:
+                # the kernel reports a supervision timeout as ETIMEDOUT
+                reason = self._link_error(e)
+                break
+            except ValueError:
+                break
+
+            if not pdu:
+                reason = "peer disconnected"
+                break
+
+            self._dispatch_pdu(bytearray(pdu))
+
+        if self.running:
+            print 'Connection lost! {0}.{1}'.format(self.target_mac, os.getpid())
+
+        self.dispatcher.close('Connection Lost: {0}'.format(reason))
+        self.responses.put(None)
+
+    def _link_error(self, e):
+        if e.args and e.args[0] == errno.ETIMEDOUT:
+            return "link supervision timeout"
+        if e.args:
+            return os.strerror(e.args[0])
+        return str(e)
+
+    #--------------------------------------------------------------------------
+    # Send one PDU; a dead link raises with the reason.
+    #--------------------------------------------------------------------------
+    def _send(self, pdu):
+        try:
+            self.sock.send(pdu)
+        except socket.error, e:
+            if self.dispatcher.closed:
+                raise Exception(self.dispatcher.closed)
+            raise Exception('Connection Lost: {0}'.format(self._link_error(e)))
+
+    #--------------------------------------------------------------------------
+    # Route one PDU from the peer.
+    #--------------------------------------------------------------------------
+    def _dispatch_pdu(self, pdu):
+
+        opcode = pdu[0]
+
+        if opcode == AttOpcodes.HANDLE_VALUE_NTF:
+            self.dispatcher.post(pdu[1] | (pdu[2] << 8), pdu[3:])
+
+        elif opcode == AttOpcodes.HANDLE_VALUE_IND:
+            self.sock.send(str(bytearray([AttOpcodes.HANDLE_VALUE_CFM])))
+            self.dispatcher.post(pdu[1] | (pdu[2] << 8), pdu[3:])
+
+        elif opcode == AttOpcodes.MTU_REQ:
+            self.sock.send(str(bytearray([AttOpcodes.MTU_RSP, self.max_mtu & 0xFF, self.max_mtu >> 8])))
+            self.mtu = max(ATT_DEFAULT_MTU, min(self.max_mtu, pdu[1] | (pdu[2] << 8)))
+
+        elif opcode == AttOpcodes.ERROR_RSP or (opcode & 0x01) == 1:
+            # a response to one of our requests
+            self.responses.put(pdu)
+
+        elif not (opcode & 0x40) and opcode != AttOpcodes.HANDLE_VALUE_CFM:
+            # Requests we do not serve get an error response, commands are dropped.
+            self.sock.send(str(bytearray([AttOpcodes.ERROR_RSP, opcode, 0, 0, ATT_ECODE_REQ_NOT_SUPP])))
+
+    #--------------------------------------------------------------------------
+    # Wait for the response to the request just sent, or None.
+    #--------------------------------------------------------------------------
+    def _wait_response(self, timeout):
+        try:
+            return self.responses.get(True, timeout)
+        except Queue.Empty:
+            return None
+
+    #--------------------------------------------------------------------------
+    # Write with response.  Returns False if the write was not acknowledged.
+    #--------------------------------------------------------------------------
+    def write_req(self, handle, data):
+
+        pdu = bytearray([AttOpcodes.WRITE_REQ, handle & 0xFF, handle >> 8])
+        pdu.extend(data)
+        self._send(str(pdu))
+
+        rsp = self._wait_response(10)
+        if rsp is None:
+            if self.dispatcher.closed:
+                raise Exception(self.dispatcher.closed)
+            return False
+        if rsp[0] == AttOpcodes.ERROR_RSP:
+            print "ATT error 0x{0:02x} on handle 0x{1:04x}".format(rsp[4], handle)
+            return False
+
+        return rsp[0] == AttOpcodes.WRITE_RSP
+
+    #--------------------------------------------------------------------------
+    # Exchange MTU request; the MTU is the smaller of the two offered.
+    # The kernel passes ATT through as is, so the result is ours to keep.
+    #--------------------------------------------------------------------------
+    def exchange_mtu(self, mtu):
+
+        self._send(str(bytearray([AttOpcodes.MTU_REQ, mtu & 0xFF, mtu >> 8])))
+
+        rsp = self._wait_response(10)
+        if rsp is None:
+            if self.dispatcher.closed:
+                raise Exception(self.dispatcher.closed)
+            return self.mtu
+        if rsp[0] != AttOpcodes.MTU_RSP or len(rsp) < 3:
+            # e.g. an error response from a peer without the request
+            return self.mtu
+
+        self.mtu = max(ATT_DEFAULT_MTU, min(mtu, rsp[1] | (rsp[2] << 8)))
+        return self.mtu
+
+    def set_data_length(self, octets):
+        if self.target_mac is None:
+            return None
+        return hci_set_data_length(self.adapter, self.target_mac, octets)
+
+    def update_conn_params(self, interval_min, interval_max, latency, timeout):
+        if self.target_mac is None:
+            return None
+        return hci_update_conn_params(self.adapter, self.target_mac,
+                                      interval_min, interval_max, latency, timeout)
+
+    #--------------------------------------------------------------------------
+    # Write without response.
+    #--------------------------------------------------------------------------
+    def write_cmd(self, handle, data):
+        self._send(self.encode_cmd(handle, data))
+
+    def encode_cmd(self, handle, data):
+        pdu = bytearray([AttOpcodes.WRITE_CMD, handle & 0xFF, handle >> 8])
+        pdu.extend(data)
+        return str(pdu)
+
+    def write_encoded(self, wire):
+        self._send(wire)
+
+    #--------------------------------------------------------------------------
+    # Wait for notification to arrive.
+    #--------------------------------------------------------------------------
+    def wait_notify(self, timeout=30, handle=None):
+        return self.dispatcher.get(handle, timeout)
+
+    def reopen(self):
+        if not self.reopenable:
+            raise Exception("transport cannot reconnect")
+        return AttSocketTransport(self.target_mac, self.addr_type, self.adapter)
+
+    #--------------------------------------------------------------------------
+    # Close the socket; the kernel drops the LE link with it.
+    #--------------------------------------------------------------------------
+    def disconnect(self):
+        self.running = False
+        if self.sock is not None:
+            try:
+                # wakes the reader out of select()
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        if self.reader is not None:
+            self.reader.join(2)
+            self.reader = None
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        self.dispatcher.close()
+
+#------------------------------------------------------------------------------
+# Loopback stand-in for the radio: returns an AttSocketTransport and the
+# peer end of a SEQPACKET socketpair, which keeps PDU boundaries like L2CAP.
+# Whatever answers ATT on the peer socket plays the part of the peripheral.
+#------------------------------------------------------------------------------
+def att_socketpair(target_mac='00:00:00:00:00:00'):
+    host, peer = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    return AttSocketTransport(target_mac, sock=host), peer
+
+#------------------------------------------------------------------------------
+# Transport factory used by dfu.py's --transport option.
+#------------------------------------------------------------------------------
+transports = {
+    'gatttool' : GatttoolTransport,
+    'att'      : AttSocketTransport,
+}
+
+def create_transport(name, target_mac, adapter=None):
+    if name not in transports:
+        raise Exception("unknown transport: {0}".format(name))
+    return transports[name](target_mac, adapter=adapter)
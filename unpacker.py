@@ -1,78 +1,180 @@
-#!/usr/bin/env python
-
-import os.path
-import zipfile
-import tempfile
-import random
-import string
-import shutil
-
-from os.path  import basename
-
-class Unpacker(object):
-
-   #--------------------------------------------------------------------------
-   # 
-   #--------------------------------------------------------------------------
-   def unzip(self, zip_src, unzip_dir):
-       try:
-           zip = zipfile.ZipFile(r'{0}'.format(zip_src))
-           zip.extractall(r'{0}'.format(unzip_dir))
-       except:
-           return False
-
-       return True
-
-   #--------------------------------------------------------------------------
-   # 
-   #--------------------------------------------------------------------------
-   def entropy(self, length):
-       return ''.join(random.choice(string.lowercase) for i in range (length))
-
-
-   #--------------------------------------------------------------------------
-   # 
-   #--------------------------------------------------------------------------
-   def unpack_zipfile(self, zipfile):
-
-        if not os.path.isfile(zipfile):
-            raise Exception("Error: zipfile, not found!")
-
-        # Create unique working direction into which the zip file is expanded
-
-        self.unzip_dir = "{0}/{1}_{2}".format(tempfile.gettempdir(),
-                                              os.path.splitext(basename(zipfile))[0],
-                                              self.entropy(6))
-
-        print("unzip_dir: {0}".format(self.unzip_dir))
-
-        if self.unzip(zipfile, self.unzip_dir) == False:
-            raise Exception("unzip failed")
-
-        # Check that "application.dat" exist in directory.
-
-        datfile = "{0}/{1}".format(self.unzip_dir, "application.dat")
-        if not os.path.isfile(datfile):
-            raise Exception("No DAT file found")
-
-        # Check that "application.[hex|bin]" exists in directory.
-
-        hexfile = "{0}/{1}".format(self.unzip_dir, "application.hex")
-        if not os.path.isfile(hexfile):
-            hexfile = "{0}/{1}".format(self.unzip_dir, "application.bin")
-            if not os.path.isfile(hexfile):
-                raise Exception("No HEX or BIN file found")
-
-        #print("hex: {0}".format(hexfile))
-        #print("dat: {0}".format(datfile))
-
-        return hexfile, datfile
-
-   #--------------------------------------------------------------------------
-   # 
-   #--------------------------------------------------------------------------
-   def delete(self):
-       # delete self.unzip_dir and its contents
-       shutil.rmtree(self.unzip_dir)
-
-
+#!/usr/bin/env python
+#------------------------------------------------------------------------------
+# Reader for DFU zip packages.
+#
+# A package either follows Nordic's manifest.json format, listing any of a
+# SoftDevice, a bootloader, both combined and an application, each as an
+# image and init packet (dat) file; or it just holds application.[hex|bin]
+# and application.dat.
+#
+# The members are read straight from the zip file into memory; nothing is
+# extracted to disk.  The zip's own CRC-32 of each member is checked as it
+# is read, so a damaged package fails here rather than on the target.
+#------------------------------------------------------------------------------
+import json
+import os.path
+
+from collections import namedtuple
+from zipfile     import ZipFile, BadZipfile
+from firmware    import FirmwareImage
+
+# Legacy DFU image types (START_DFU)
+class ImageTypes:
+    SOFTDEVICE            = 0x01
+    BOOTLOADER            = 0x02
+    SOFTDEVICE_BOOTLOADER = 0x03
+    APPLICATION           = 0x04
+
+# Manifest entries in the order they are sent: the SoftDevice ahead of the
+# bootloader built against it, the application last.
+manifest_images = [
+    ("softdevice_bootloader", ImageTypes.SOFTDEVICE_BOOTLOADER),
+    ("softdevice",            ImageTypes.SOFTDEVICE),
+    ("bootloader",            ImageTypes.BOOTLOADER),
+    ("application",           ImageTypes.APPLICATION),
+]
+
+#------------------------------------------------------------------------------
+# One image of a package.
+#   name       - manifest entry ("softdevice_bootloader", "application", ...)
+#   image_type - one of ImageTypes
+#   image      - FirmwareImage
+#   init       - init packet (bytearray)
+#   sd_size    - SoftDevice part of a combined image, in bytes
+#   bl_size    - bootloader part of a combined image, in bytes
+#------------------------------------------------------------------------------
+PackageImage = namedtuple('PackageImage', 'name image_type image init sd_size bl_size')
+
+class Unpacker(object):
+
+   #--------------------------------------------------------------------------
+   # Contents of member 'name' of the open package 'package', or None if the
+   # package has no such member.
+   #--------------------------------------------------------------------------
+   def read_member(self, package, name):
+
+        try:
+            info = package.getinfo(name)
+        except KeyError:
+            return None
+
+        try:
+            return package.read(info)
+        except (BadZipfile, IOError, RuntimeError, NotImplementedError), e:
+            raise Exception("{0}: {1}".format(name, e))
+
+   #--------------------------------------------------------------------------
+   # Read the package 'zipfile'.  Returns its PackageImages in the order they
+   # are to be sent.
+   #--------------------------------------------------------------------------
+   def unpack_package(self, zipfile):
+
+        if not os.path.isfile(zipfile):
+            raise Exception("Error: zipfile, not found!")
+
+        try:
+            package = ZipFile(zipfile)
+        except (BadZipfile, IOError), e:
+            raise Exception("unzip failed: {0}".format(e))
+
+        try:
+            manifest = self.read_member(package, "manifest.json")
+            if manifest != None:
+                images = self.read_manifest(package, manifest)
+            else:
+                images = [self.read_application(package)]
+        finally:
+            package.close()
+
+        return images
+
+   #--------------------------------------------------------------------------
+   # Images listed in manifest.json.
+   #--------------------------------------------------------------------------
+   def read_manifest(self, package, text):
+
+        try:
+            manifest = json.loads(text)["manifest"]
+        except (ValueError, KeyError, TypeError):
+            raise Exception("manifest.json invalid")
+
+        images = []
+
+        for name, image_type in manifest_images:
+            entry = manifest.get(name)
+            if entry == None:
+                continue
+
+            if "bin_file" not in entry or "dat_file" not in entry:
+                raise Exception("manifest.json: {0} lacks bin_file or dat_file".format(name))
+
+            source = self.read_member(package, entry["bin_file"])
+            init   = self.read_member(package, entry["dat_file"])
+            if source == None or init == None:
+                raise Exception("manifest.json: {0} files missing from package".format(name))
+
+            extent = os.path.splitext(entry["bin_file"])[1]
+            image  = FirmwareImage.from_bytes(source, extent)
+
+            sd_size, bl_size = 0, 0
+            if image_type == ImageTypes.SOFTDEVICE_BOOTLOADER:
+                # nRF5 SDK 12+ packages keep the sizes under info_read_only_metadata
+                sizes = entry.get("info_read_only_metadata", entry)
+                sd_size = sizes.get("sd_size", 0)
+                bl_size = sizes.get("bl_size", 0)
+                if sd_size + bl_size != image.size:
+                    raise Exception("manifest.json: {0} sizes do not add up to its image".format(name))
+            elif image_type == ImageTypes.SOFTDEVICE:
+                sd_size = image.size
+            elif image_type == ImageTypes.BOOTLOADER:
+                bl_size = image.size
+
+            images.append(PackageImage(name, image_type, image, bytearray(init), sd_size, bl_size))
+
+        if not images:
+            raise Exception("manifest.json lists no images")
+
+        return images
+
+   #--------------------------------------------------------------------------
+   # application.dat and application.[hex|bin] of a package without manifest.
+   #--------------------------------------------------------------------------
+   def read_application(self, package):
+
+        # Check that "application.dat" exists in the package.
+
+        init = self.read_member(package, "application.dat")
+        if init == None:
+            raise Exception("No DAT file found")
+
+        # Check that "application.[hex|bin]" exists in the package.
+
+        for extent in (".hex", ".bin"):
+            source = self.read_member(package, "application" + extent)
+            if source != None:
+                break
+        else:
+            raise Exception("No HEX or BIN file found")
+
+        return PackageImage("application", ImageTypes.APPLICATION,
+                            FirmwareImage.from_bytes(source, extent), bytearray(init), 0, 0)
+
+   #--------------------------------------------------------------------------
+   # Read the application of package 'zipfile'.  Returns (image, init): the
+   # FirmwareImage and the init packet as a bytearray, which BleDfuServer
+   # takes in place of the hex and dat file paths.
+   #--------------------------------------------------------------------------
+   def unpack_zipfile(self, zipfile):
+
+        for item in self.unpack_package(zipfile):
+            if item.image_type == ImageTypes.APPLICATION:
+                return item.image, item.init
+
+        raise Exception("No application in package")
+
+   #--------------------------------------------------------------------------
+   # Nothing is written to disk, so there is nothing to clean up; kept for
+   # callers written against the extracting unpacker.
+   #--------------------------------------------------------------------------
+   def delete(self):
+       pass
@@ -5,6 +5,9 @@
 #------------------------------------------------------------------------------
 
 import os
+import time
+import Queue
+import threading
 
 from Tkinter import *
 
@@ -14,8 +17,10 @@ import tkMessageBox
 import tkFileDialog
 from tkFileDialog import askopenfilename
 
-from scan import Scan
-from dfu2 import *
+from scan     import Scan
+from dfu      import BleDfuServer
+from events   import DfuEvent, EventKinds
+from unpacker import Unpacker
 
 #------------------------------------------------------------------------------
 #
@@ -27,6 +32,8 @@ class Application(Frame):
         self.file = None
         self.addr = None
         self.device = None
+        self.events = Queue.Queue()
+        self.worker = None
         self.grid()
         self.create_widgets()
 
@@ -107,17 +114,95 @@ class Application(Frame):
         selected = widget.curselection()
         self.addr = widget.get(selected[0])
 
+        if self.worker is not None and self.worker.is_alive():
+            tkMessageBox.showwarning("Error", "Update already in progress")
+            return
+
         if self.addr and self.file:
             print "addr: {0}".format(self.addr)
             print "file: {0}".format(self.file)
 
-            # dfu_server("-z {0} -a {1}".format(self.file, self.addr))
+            self.progress3['value'] = 0
+            self.text3["text"] = "Starting"
+
+            self.worker = threading.Thread(target=self.run_update,
+                                           args=(self.file, self.addr.upper()))
+            self.worker.daemon = True
+            self.worker.start()
+
+            self.after(100, self.poll_events)
 
         else:
             tkMessageBox.showwarning("Error", "Missing application file")
 
         return
 
+    #--------------------------------------------------------------------------
+    # Runs on the worker thread; Tk is only touched from poll_events().
+    #--------------------------------------------------------------------------
+    def run_update(self, zipfile, addr):
+
+        unpacker = Unpacker()
+        sending  = False
+
+        try:
+            hexfile, datfile = unpacker.unpack_zipfile(zipfile)
+
+            ble_dfu = BleDfuServer(addr, hexfile, datfile)
+            ble_dfu.add_listener(self.events)
+
+            ble_dfu.input_setup()
+            ble_dfu.scan_and_connect()
+
+            sending = True
+            ble_dfu.dfu_send_image()
+            sending = False
+
+            ble_dfu.disconnect()
+
+        except Exception, e:
+            print e
+
+            # dfu_send_image() reports its own failures; anything else
+            # (unpacking, setup, connecting) is reported here.
+            if not sending:
+                self.events.put(DfuEvent(EventKinds.ERROR, addr, None, 0, 0, 0.0,
+                                         None, str(e), time.time(), None))
+
+        finally:
+            unpacker.delete()
+
+    #--------------------------------------------------------------------------
+    # Feed the session's events into the progress bar.
+    #--------------------------------------------------------------------------
+    def poll_events(self):
+
+        while True:
+            try:
+                event = self.events.get_nowait()
+            except Queue.Empty:
+                break
+
+            if event.kind == EventKinds.PHASE:
+                self.text3["text"] = event.phase.replace('_', ' ').capitalize()
+
+            elif event.kind == EventKinds.PROGRESS:
+                self.progress3['maximum'] = event.total
+                self.progress3['value'] = event.confirmed
+                if event.eta is not None:
+                    self.text3["text"] = "Transfer: {0:.0f}s left".format(event.eta)
+
+            elif event.kind == EventKinds.DONE:
+                self.progress3['value'] = self.progress3['maximum']
+                self.text3["text"] = "Done"
+
+            elif event.kind == EventKinds.ERROR:
+                self.text3["text"] = "Failed"
+                tkMessageBox.showwarning("Error", event.error)
+
+        if self.worker.is_alive() or not self.events.empty():
+            self.after(100, self.poll_events)
+
 
 #------------------------------------------------------------------------------
 #